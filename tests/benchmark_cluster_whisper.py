@@ -0,0 +1,109 @@
+#!/bin/env python3
+#
+# Benchmark the cluster_whisper submit/check/cleanup cycle on this machine,
+# using the local transport and whisper_spool.py with the fake engine as the
+# cluster.  Needs the amp python library, but not the cluster.
+#
+import argparse
+import os
+import sys
+import tempfile
+import time
+import wave
+from pathlib import Path
+
+sys.path.append(sys.path[0] + "/../tools/mgms")
+from amp.lwlw import LWLW
+from cluster_transport import LocalSession
+from batch_registry import BatchRegistry
+from cluster_whisper import Cluster_Whisper, workdir_key
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=20, help="Number of jobs")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of audio in each job")
+    parser.add_argument("--fake_rtf", type=float, default=0.01, help="Fraction of the audio duration the fake engine takes")
+    parser.add_argument("--batch_window", type=float, default=0, help="Seconds to collect jobs into a batch")
+    parser.add_argument("--poll", type=float, default=0.5, help="Seconds between checks")
+    parser.add_argument("--poll_schedule", default=False, action="store_true", help="Use the adaptive poll schedule")
+    parser.add_argument("--fail", type=int, default=0, help="Number of jobs with audio the engine can't transcribe")
+    args = parser.parse_args()
+    tools = Path(sys.path[0], "../tools/mgms").resolve()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir, "work")
+        workdir.mkdir()
+        submit_script = Path(tmpdir, "submit")
+        submit_script.write_text("# nothing to submit\n")
+        jobs = []
+        for i in range(args.jobs):
+            audio = Path(tmpdir, f"audio{i}.wav")
+            if i < args.fail:
+                # not audio at all, so the engine leaves a .whisper.failed
+                audio.write_bytes(f"not audio {i}\n".encode('utf-8') * 1000)
+            else:
+                with wave.open(str(audio), "wb") as w:
+                    w.setnchannels(1)
+                    w.setsampwidth(2)
+                    w.setframerate(16000)
+                    # different audio so the uploads aren't deduplicated
+                    w.writeframes(bytes([i % 256, i // 256]) * int(16000 * args.duration))
+            cw = Cluster_Whisper(str(audio), amp_transcript=f"{tmpdir}/transcript{i}.json", web_vtt=f"{tmpdir}/subtitles{i}.vtt")
+            cw.remote = LocalSession()
+            cw.hpcworkdir = str(workdir)
+            cw.hpcscript = f"{sys.executable} {tools}/whisper_spool.py --engine fake --fake_rtf {args.fake_rtf}"
+            cw.hpcsubmit = str(submit_script)
+            cw.upload_format = 'wav'
+            cw.batch_window = args.batch_window
+            cw.status_ttl = min(cw.status_ttl, args.poll)
+            cw.batches = BatchRegistry('cluster_whisper', workdir_key(cw.hpchost, cw.hpcworkdir))
+            cw.polls.enabled = args.poll_schedule
+            cw.polls.min_interval = args.poll
+            jobs.append(cw)
+
+        start = time.time()
+        for cw in jobs:
+            if cw.submit() == LWLW.ERROR:
+                print(f"Submitting {cw.input_file} failed")
+                return
+        submitted = time.time()
+        failing = {cw.jobid for cw in jobs[:args.fail]}
+        latency = {}
+        failed = {}
+        checks = 0
+        while len(latency) + len(failed) < len(jobs):
+            time.sleep(args.poll)
+            for cw in jobs:
+                if cw.jobid in latency or cw.jobid in failed:
+                    continue
+                checks += 1
+                rc = cw.check()
+                if rc == LWLW.OK and cw.jobid not in failing:
+                    latency[cw.jobid] = time.time() - start
+                elif rc == LWLW.ERROR and cw.jobid in failing:
+                    failed[cw.jobid] = time.time() - start
+                elif rc != LWLW.WAIT:
+                    print(f"Checking {cw.input_file} returned {rc}, which is wrong")
+                    return
+        finished = time.time()
+        for cw in jobs:
+            cw.cleanup()
+        cleaned = time.time()
+
+        audio_hours = (args.jobs - args.fail) * args.duration / 3600
+        print(f"{args.jobs} jobs of {args.duration}s, batch window {args.batch_window}s: "
+              f"submit {submitted - start:.3f}s, {checks} checks, cleanup {cleaned - finished:.3f}s")
+        if latency:
+            times = sorted(latency.values())
+            print(f"latency min {times[0]:.2f}s, median {times[len(times) // 2]:.2f}s, max {times[-1]:.2f}s, "
+                  f"throughput {audio_hours / ((finished - start) / 3600):.1f} hours of audio per hour")
+        if failed:
+            print(f"{len(failed)} failed jobs reported after at most {max(failed.values()):.2f}s")
+        leftovers = [n for n in os.listdir(workdir) if not n.startswith('.') and n != 'jobinfo.yaml']
+        if leftovers:
+            print(f"Left in the work directory: {leftovers}")
+
+
+if __name__ == "__main__":
+    main()
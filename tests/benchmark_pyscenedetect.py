@@ -0,0 +1,126 @@
+#!/bin/env python3
+#
+# Benchmark the pyscenedetect shot detection engines on a synthetic video
+# with known cuts:  the content detector on every frame, the content
+# detector with frame skipping and cut refinement, and the histogram engine.
+# Reports the speed of each and how many of the true cuts it found.  The
+# engines are also run on a real video (the test fixture by default), where
+# the cuts the content detector finds on every frame are the reference.
+# Needs PySceneDetect, OpenCV, ffmpeg and the amp python library.
+#
+import argparse
+import logging
+import random
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.append(sys.path[0] + "/../tools/mgms")
+from pyscenedetect import find_shots, find_shots_histogram
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shots", type=int, default=60, help="Number of shots in the video")
+    parser.add_argument("--min_shot", type=int, default=30, help="Shortest shot in frames")
+    parser.add_argument("--max_shot", type=int, default=150, help="Longest shot in frames")
+    parser.add_argument("--width", type=int, default=640, help="Frame width")
+    parser.add_argument("--height", type=int, default=360, help="Frame height")
+    parser.add_argument("--fps", type=float, default=30, help="Frame rate")
+    parser.add_argument("--frame_skip", type=int, default=4, help="Frames skipped by the skipping content detector")
+    parser.add_argument("--tolerance", type=int, default=1, help="Frames a detected cut may be off by")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--video", default=str(Path(sys.path[0], "fixtures/video.m4v")), help="Real video to run the engines on")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger("pyscenedetect").setLevel(logging.ERROR)
+    # newer PySceneDetect versions deprecate get_frames(), which the MGM uses
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        video = str(Path(tmpdir, "video.mp4"))
+        (cuts, frames) = make_video(video, args)
+        print(f"Synthetic video: {args.shots} shots, {frames} frames ({frames / args.fps:.1f}s) at {args.width}x{args.height}")
+        run_engines(video, frames, cuts, tmpdir, args)
+
+        if args.video:
+            capture = cv2.VideoCapture(args.video)
+            frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            print(f"{args.video}: {frames} frames at {int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))}, "
+                  f"compared with the content detector")
+            capture.release()
+            run_engines(args.video, frames, None, tmpdir, args)
+
+
+def run_engines(video, frames, cuts, tmpdir, args):
+    """Time each engine on the video and score its cuts against the true
+       cuts, or the content detector's cuts if they aren't known"""
+    engines = [("content", lambda: find_shots(video, f"{tmpdir}/stats.csv", 30)),
+               (f"content, frame_skip {args.frame_skip}",
+                lambda: find_shots(video, f"{tmpdir}/stats.csv", 30, frame_skip=args.frame_skip)),
+               ("histogram", lambda: find_shots_histogram(video, f"{tmpdir}/stats.csv", 30))]
+    for (name, engine) in engines:
+        t = time.time()
+        shots = engine()
+        elapsed = time.time() - t
+        found = [s[0].get_frames() for s in shots[1:]]
+        if cuts is None:
+            cuts = found
+        (precision, recall) = score(cuts, found, args.tolerance)
+        print(f"{name:24s} {elapsed:7.2f}s  {frames / elapsed:7.1f} frames/s  {len(shots) / elapsed:6.1f} shots/s  "
+              f"{len(shots):4d} shots  precision {precision:.3f}  recall {recall:.3f}")
+
+
+def make_video(filename, args):
+    """Write a video of shots with different colors and a moving shape, with
+       noise in every frame, returning the frame numbers of the cuts and the
+       number of frames"""
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*"mp4v"), args.fps, (args.width, args.height))
+    rng = np.random.default_rng(args.seed)
+    y, x = np.mgrid[0:args.height, 0:args.width]
+    cuts = []
+    frame_num = 0
+    for shot in range(args.shots):
+        if shot:
+            cuts.append(frame_num)
+        # a gradient between two random colors, with a shape of a third
+        # color moving across it
+        (c1, c2, c3) = rng.integers(0, 256, (3, 3))
+        angle = rng.uniform(0, np.pi)
+        ramp = ((np.cos(angle) * x + np.sin(angle) * y) / (args.width + args.height) + 0.5)[..., None]
+        background = (c1 * (1 - ramp) + c2 * ramp).astype(np.int16)
+        (px, py) = rng.integers(0, [args.width, args.height])
+        (vx, vy) = rng.uniform(-4, 4, 2)
+        radius = int(rng.integers(20, 80))
+        for i in range(random.randint(args.min_shot, args.max_shot)):
+            frame = background.copy()
+            cv2.circle(frame, (int(px + vx * i) % args.width, int(py + vy * i) % args.height), radius, c3.tolist(), -1)
+            frame += rng.integers(-8, 9, frame.shape, dtype=np.int16)
+            writer.write(np.clip(frame, 0, 255).astype(np.uint8))
+            frame_num += 1
+    writer.release()
+    return (cuts, frame_num)
+
+
+def score(cuts, found, tolerance):
+    "Return the precision and recall of the found cuts, matching each true cut at most once"
+    matched = 0
+    unmatched = sorted(found)
+    for cut in cuts:
+        near = [f for f in unmatched if abs(f - cut) <= tolerance]
+        if near:
+            unmatched.remove(min(near, key=lambda f: abs(f - cut)))
+            matched += 1
+    precision = matched / len(found) if found else 1.0
+    recall = matched / len(cuts) if cuts else 1.0
+    return (precision, recall)
+
+
+if __name__ == "__main__":
+    main()
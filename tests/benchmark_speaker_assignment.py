@@ -0,0 +1,51 @@
+#!/bin/env python3
+#
+# Benchmark assigning diarization speakers to transcript words against the
+# linear search of every segment for every word.
+#
+import argparse
+import random
+import sys
+import time
+
+sys.path.append(sys.path[0] + "/../tools/mgms")
+from speaker_assignment import assign_speakers
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, default=4, help="Length of the recording in hours")
+    parser.add_argument("--speakers", type=int, default=40, help="Number of speakers")
+    parser.add_argument("--turn", type=float, default=8, help="Average speaker turn in seconds")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # about 2.5 words per second, with speaker turns of random length
+    duration = args.hours * 3600
+    times = [i * 0.4 for i in range(int(duration / 0.4))]
+    segments = []
+    start = 0
+    while start < duration:
+        end = start + random.uniform(1, 2 * args.turn)
+        segments.append({'start': start, 'end': end, 'speaker': f"spk_{random.randrange(args.speakers)}"})
+        start = end + random.uniform(0, 1)
+    print(f"{len(times)} words, {len(segments)} segments, {args.speakers} speakers")
+
+    t = time.time()
+    speakers = assign_speakers(times, segments)
+    print(f"assign_speakers: {time.time() - t:.3f}s")
+
+    t = time.time()
+    linear = []
+    for w in times:
+        speaker = [x['speaker'] for x in segments if x['start'] <= w <= x['end']]
+        linear.append(speaker[0] if speaker else None)
+    print(f"linear search: {time.time() - t:.3f}s")
+    if speakers != linear:
+        print("Results differ!")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
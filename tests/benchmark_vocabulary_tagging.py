@@ -0,0 +1,41 @@
+#!/bin/env python3
+#
+# Benchmark the vocabulary tagging phrase matcher with large synthetic
+# vocabularies and transcripts.
+#
+import argparse
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(sys.path[0] + "/../tools/mgms")
+from vocabulary_tagging import get_words, match_words
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocabulary", type=int, nargs="+", default=[500, 5000, 50000], help="Vocabulary sizes to test")
+    parser.add_argument("--words", type=int, default=30000, help="Number of transcript words (about 3 hours of speech)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    tokens = [f"word{i}" for i in range(20000)]
+    transcript_words = [{'type': 'pronunciation', 'text': random.choice(tokens), 'start': i * 0.4, 'end': i * 0.4 + 0.3}
+                        for i in range(args.words)]
+    for size in args.vocabulary:
+        with tempfile.NamedTemporaryFile("w") as f:
+            for _ in range(size):
+                f.write(" ".join(random.choices(tokens, k=random.choice([1, 1, 2, 3]))) + "\n")
+            f.flush()
+            start = time.time()
+            words_to_flag = get_words(f.name)
+            loaded = time.time()
+            matches = match_words(words_to_flag.values(), transcript_words)
+            finished = time.time()
+        print(f"vocabulary {size:6d}, words {args.words}: load {loaded - start:.3f}s, match {finished - loaded:.3f}s, {len(matches)} matches")
+
+
+if __name__ == "__main__":
+    main()
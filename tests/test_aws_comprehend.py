@@ -0,0 +1,136 @@
+#!/bin/env python3
+#
+# Check the short transcript route of aws_comprehend, which finds the entities
+# with batch_detect_entities on sentence chunks instead of with a job:  the
+# chunking itself, and that the chunk offsets are moved back to the document
+# so the AMP entities are the same as from one request for the whole
+# document.  Comprehend is replaced by a client which finds capitalized words.
+# Needs the amp library and boto3, like the MGM.  Runs on its own or under
+# pytest.
+#
+import json
+import random
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(sys.path[0] + "/../tools/aws")
+import aws_comprehend
+from aws_comprehend import AWS_Comprehend, sentence_chunks
+import amp.nerutils
+from amp.lwlw import LWLW
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+class FakeComprehend:
+    "batch_detect_entities with capitalized words as entities, returned out of order"
+    def __init__(self):
+        self.requests = 0
+
+    def batch_detect_entities(self, TextList, LanguageCode):
+        self.requests += 1
+        assert len(TextList) <= aws_comprehend.SYNC_BATCH_SIZE
+        results = [{'Index': i, 'Entities': [{'Text': m.group(), 'Type': 'PERSON', 'Score': 1.0,
+                                              'BeginOffset': m.start(), 'EndOffset': m.end()}
+                                             for m in re.finditer(r"[A-Z]\w+", text)]}
+                   for i, text in enumerate(TextList)]
+        return {'ResultList': results[::-1], 'ErrorList': []}
+
+
+def comprehend(tmpdir, name):
+    "Return an AWS_Comprehend for the fixture transcript, without any config or AWS clients"
+    mgm = AWS_Comprehend.__new__(AWS_Comprehend)
+    mgm.transcript = str(FIXTURES / "amp_transcript_aws.json")
+    mgm.aws_entities = f"{tmpdir}/{name}.aws.json"
+    mgm.amp_entities = f"{tmpdir}/{name}.amp.json"
+    mgm.ignore_types = "QUANTITY,DATE"
+    mgm.job_name = f"AWSC-{name}"
+    mgm.state_file = Path(tmpdir, f"{name}.state.json")
+    mgm.batches = None
+    mgm.job = None
+    mgm.job_time = 0
+    mgm.comprehend_client = FakeComprehend()
+    return mgm
+
+
+def detect(tmpdir, name, chunk_size, batch_size=aws_comprehend.SYNC_BATCH_SIZE):
+    """Find the entities with the chunk and request sizes and return the MGM,
+       the document, and the outputs"""
+    saved = (aws_comprehend.SYNC_CHUNK_SIZE, aws_comprehend.SYNC_BATCH_SIZE)
+    (aws_comprehend.SYNC_CHUNK_SIZE, aws_comprehend.SYNC_BATCH_SIZE) = (chunk_size, batch_size)
+    try:
+        mgm = comprehend(tmpdir, name)
+        (amp_transcript_obj, _, _) = amp.nerutils.initialize_amp_entities(mgm.transcript, mgm.amp_entities, mgm.ignore_types)
+        document = aws_comprehend.document_text(amp_transcript_obj)
+        assert mgm.detect_now(document) == LWLW.OK
+    finally:
+        (aws_comprehend.SYNC_CHUNK_SIZE, aws_comprehend.SYNC_BATCH_SIZE) = saved
+    with open(mgm.aws_entities) as f:
+        aws_entities = json.load(f)
+    with open(mgm.amp_entities) as f:
+        amp_entities = json.load(f)
+    return (mgm, document, aws_entities, amp_entities)
+
+
+def check_chunks(text, size):
+    chunks = sentence_chunks(text, size)
+    assert "".join(chunk for _, chunk in chunks) == text, (text, size)
+    offset = 0
+    for start, chunk in chunks:
+        assert start == offset and 0 < len(chunk) <= size, (text, size, chunks)
+        offset += len(chunk)
+    return chunks
+
+
+def test_sentence_chunks():
+    assert sentence_chunks("", 10) == []
+    assert check_chunks("Short.", 10) == [(0, "Short.")]
+    assert check_chunks("Exactly 10", 10) == [(0, "Exactly 10")]
+    # at the last sentence end in the chunk, then the last space, then anywhere
+    assert check_chunks("One. Two. Three four.", 12) == [(0, "One. Two. "), (10, "Three four.")]
+    assert check_chunks("one two three four", 10) == [(0, "one two "), (8, "three four")]
+    assert check_chunks("abcdefghijklmnopqrstuvwxyz", 10) == [(0, "abcdefghij"), (10, "klmnopqrst"), (20, "uvwxyz")]
+    # a sentence end or space at the very start of a chunk doesn't make an empty chunk
+    check_chunks(". " * 20, 3)
+    check_chunks(" " + "x" * 30, 10)
+    rng = random.Random(1)
+    words = ["a", "Bb", "ccc.", "dddd!", "e?", "f\n", "été", "x" * 40]
+    for _ in range(200):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(0, 60)))
+        check_chunks(text, rng.randint(1, 50))
+
+
+def test_detect_now_offsets():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        (whole, document, whole_aws, whole_amp) = detect(tmpdir, "whole", 1 << 20)
+        assert whole.comprehend_client.requests == 1
+        (chunked, _, chunked_aws, chunked_amp) = detect(tmpdir, "chunked", 40, batch_size=3)
+        # several chunks, in more than one request
+        assert chunked.comprehend_client.requests > 1
+        assert whole_aws['Entities']
+        for entity in chunked_aws['Entities']:
+            assert document[entity['BeginOffset']:entity['EndOffset']] == entity['Text'], entity
+        assert chunked_aws['Entities'] == whole_aws['Entities']
+        assert chunked_amp == whole_amp
+
+
+def test_sync_state():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        (mgm, _, _, _) = detect(tmpdir, "sync", aws_comprehend.SYNC_CHUNK_SIZE)
+        # there isn't a job to find, but it is done
+        assert mgm.exists()['JobStatus'] == 'COMPLETED'
+        assert mgm.check_job() == LWLW.OK
+        assert mgm.cleanup() == LWLW.OK
+        assert not mgm.state_file.exists()
+
+
+def main():
+    for test in [test_sentence_chunks, test_detect_now_offsets, test_sync_state]:
+        test()
+        print(f"{test.__name__}: ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/bin/env python3
+#
+# Check the incremental JSON reader and writer in json_stream against the json
+# module, with chunk sizes small enough that every value is split across
+# reads somewhere.  Runs on its own or under pytest.
+#
+import json
+import random
+import sys
+import tempfile
+
+sys.path.append(sys.path[0] + "/../tools/mgms")
+import json_stream
+from json_stream import iter_json_array, read_json_without, walk_json, write_json_stream
+
+CHUNK_SIZES = [1, 2, 3, 5, 7, 16, 1 << 16]
+
+
+def random_number(rng):
+    return rng.choice([rng.randint(-10 ** 6, 10 ** 6), rng.uniform(-1000, 1000), rng.uniform(0, 1) * 1e-7,
+                       rng.uniform(0, 1) * 1e20, 0, 0.0, 1.5])
+
+
+def random_document(rng):
+    return {'results': {'transcript': "some \"quoted\" text\\ with escapes é",
+                        'numbers': [random_number(rng) for _ in range(500)],
+                        'words': [{'text': rng.choice(["a", "b\"c", "d\\e", "[{]}"]), 'start': random_number(rng),
+                                   'tags': [], 'extra': {'x': [1, 2, {'y': None}]}} for _ in range(200)],
+                        'count': random_number(rng)},
+            'Fps': 29.97,
+            'flag': True,
+            'last': 12345}
+
+
+def check(doc, filename):
+    with open(filename, "w") as f:
+        json.dump(doc, f)
+    for size in CHUNK_SIZES:
+        json_stream.CHUNK_SIZE = size
+        assert list(iter_json_array(filename, "results.numbers")) == doc['results']['numbers'], size
+        assert list(iter_json_array(filename, "results.words")) == doc['results']['words'], size
+        expected = json.loads(json.dumps(doc))
+        expected['results']['numbers'] = []
+        expected['results']['words'] = []
+        assert read_json_without(filename, "results.numbers", "results.words") == expected, size
+        found = {}
+        paths = walk_json(filename, {'results.numbers': lambda items: found.setdefault('numbers', list(items)),
+                                     'results.count': lambda value: found.setdefault('count', value),
+                                     'Fps': lambda value: found.setdefault('Fps', value),
+                                     'last': lambda value: found.setdefault('last', value)})
+        assert paths == {'results.numbers', 'results.count', 'Fps', 'last'}, size
+        assert found == {'numbers': doc['results']['numbers'], 'count': doc['results']['count'],
+                         'Fps': doc['Fps'], 'last': doc['last']}, size
+
+
+def test_numbers_across_chunks():
+    rng = random.Random(1)
+    with tempfile.NamedTemporaryFile(suffix=".json") as f:
+        for _ in range(5):
+            check(random_document(rng), f.name)
+
+
+def test_bare_numbers():
+    with tempfile.NamedTemporaryFile(suffix=".json") as f:
+        for text in ["0.5", "1e10", "-12.25E-3", "[0.0, 1e5, -3]", '{"a": 10.75, "b": [2.5e-3]}']:
+            with open(f.name, "w") as out:
+                out.write(text)
+            for size in CHUNK_SIZES:
+                json_stream.CHUNK_SIZE = size
+                assert read_json_without(f.name) == json.loads(text), (text, size)
+
+
+def test_write_json_stream():
+    rng = random.Random(2)
+    doc = random_document(rng)
+    with tempfile.NamedTemporaryFile(suffix=".json") as f:
+        write_json_stream(doc, f.name, "results.words", iter(doc['results']['words']))
+        with open(f.name) as g:
+            assert json.load(g) == doc
+
+
+def main():
+    for test in [test_numbers_across_chunks, test_bare_numbers, test_write_json_stream]:
+        test()
+        print(f"{test.__name__}: ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,18 @@
 #!/usr/bin/env amp_python.sif
 
+import os
+import re
 import tempfile
 import tarfile
+import time
+import uuid
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import argparse
 import tempfile
 import logging
-from amp.config import load_amp_config, get_config_value, get_cloud_credentials
+from amp.config import load_amp_config, get_config_value, get_cloud_credentials, get_work_dir
 import amp.logging
 from amp.fileutils import read_json_file, write_json_file
 import amp.nerutils
@@ -14,6 +20,36 @@ from amp.lwlw import LWLW
 from amp.cloudutils import generate_persistent_name
 import json
 from amp.schema.speech_to_text import SpeechToText
+from pathlib import Path
+
+# poll_schedule and batch_registry are shared with the MGMs: they are
+# symlinked from ../mgms and mgm_build.sh installs copies next to this script
+from poll_schedule import PollSchedule, s3_object_exists
+from batch_registry import BatchRegistry
+
+# without any history, a job is expected to take about seven minutes, since
+# the asynchronous jobs take a while to start no matter how short the text is
+EXPECTED_OVERHEAD = 420
+
+# Comprehend throttles its control plane calls, so they are retried with
+# jittered backoff and client side rate limiting
+RETRY_CONFIG = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+
+# seconds a description of the job is reused within a run
+DESCRIBE_TTL = 10
+
+# default limit on the number of transcripts in a batch
+DEFAULT_BATCH_MAX_FILES = 25
+
+# Transcripts up to this many characters are sent to batch_detect_entities
+# instead of an asynchronous job, in chunks of sentences up to the chunk
+# size, with up to SYNC_BATCH_SIZE chunks per call
+DEFAULT_SYNC_MAX_SIZE = 125000
+SYNC_CHUNK_SIZE = 5000
+SYNC_BATCH_SIZE = 25
+
+# the end of a sentence
+SENTENCE_END = re.compile(r"[.!?]+\s+")
 
 
 class AWS_Comprehend(LWLW):
@@ -36,33 +72,128 @@ class AWS_Comprehend(LWLW):
             exit(1)
 
         aws_creds = get_cloud_credentials(self.config, "aws")
-        self.comprehend_client = boto3.client('comprehend', **aws_creds)
+        self.comprehend_client = boto3.client('comprehend', config=RETRY_CONFIG, **aws_creds)
         self.s3_client = boto3.client("s3", **aws_creds)
 
         self.job_name = generate_persistent_name("AWSC", transcript, amp_entities)
+        self.polls = PollSchedule('aws_comprehend', self.job_name, overhead=EXPECTED_OVERHEAD)
+        # the id of the submitted job is kept so it can be looked up directly
+        self.state_file = Path(get_work_dir("aws_comprehend"), f"{self.job_name}.json")
+        self.job = None
+        self.job_time = 0
+
+        # transcripts can be collected into batches which are one job, since
+        # every job takes minutes to start no matter how small it is
+        self.batch_window = get_config_value(self.config, ['mgms', 'aws_comprehend', 'batch_window'], 0)
+        self.batch_max_files = get_config_value(self.config, ['mgms', 'aws_comprehend', 'batch_max_files'], DEFAULT_BATCH_MAX_FILES)
+        # without a window the registry is never used, so it isn't read either
+        self.batches = BatchRegistry('aws_comprehend', self.s3_bucket) if self.batch_window > 0 else None
+        self.sync_max_size = get_config_value(self.config, ['mgms', 'aws_comprehend', 'sync_max_size'], DEFAULT_SYNC_MAX_SIZE)
 
 
     def exists(self):
         "get comprehend job information"
+        if self.job is not None and time.time() - self.job_time < DESCRIBE_TTL:
+            return self.job
         try:
-            response = self.comprehend_client.list_entities_detection_jobs(Filter={"JobName": self.job_name})
-            for job in response['EntitiesDetectionJobPropertiesList']:
-                if job['JobName'] == self.job_name:
-                    return job
-            return None
+            (batchid, batch) = self.batch_of_job()
+            state = self.read_state()
+            job_id = state.get('JobId')
+            if state.get('Sync'):
+                # the entities were found when it was submitted, without a job
+                job = {'JobStatus': 'COMPLETED', 'Sync': True}
+            elif batch is not None:
+                job = self.batch_job(batchid, batch)
+            elif job_id is not None:
+                job = self.describe_job(job_id)
+            else:
+                # the job was submitted without keeping its id, so look
+                # for it by name
+                job = self.find_job()
+                if job is not None:
+                    self.write_job_id(job['JobId'])
+            self.job = job
+            self.job_time = time.time()
+            return job
         except Exception as e:
             logging.error(f"Cannot get job list or comprehend job: {e}")
+
+
+    def batch_of_job(self):
+        "Return the id and record of the job's batch, or (None, None) if it isn't in one"
+        if self.batches is None:
+            return (None, None)
+        return self.batches.batch_of(self.job_name)
+
+
+    def describe_job(self, job_id):
+        "Return the properties of the job with the id, or None if it doesn't exist"
+        try:
+            return self.comprehend_client.describe_entities_detection_job(JobId=job_id)['EntitiesDetectionJobProperties']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'JobNotFoundException':
+                raise
+            return None
+
+
+    def batch_job(self, batchid, batch):
+        "Return the properties of the batch's job, with the batch id, or just a status if it wasn't submitted"
+        if batch['failed']:
+            return {'JobStatus': 'FAILED', 'Batch': batchid}
+        elif not batch['submitted']:
+            return {'JobStatus': 'QUEUED', 'Batch': batchid}
+        job = self.describe_job(batch['job_id'])
+        if job is not None:
+            job['Batch'] = batchid
+        return job
+
+
+    def find_job(self):
+        "Find the job by name in the job list"
+        response = self.comprehend_client.list_entities_detection_jobs(Filter={"JobName": self.job_name})
+        for job in response['EntitiesDetectionJobPropertiesList']:
+            if job['JobName'] == self.job_name:
+                return job
+        return None
+
+
+    def read_state(self):
+        "Return the job's saved state:  its JobId, or Sync if it was done without a job"
+        try:
+            return json.loads(self.state_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+
+    def read_job_id(self):
+        return self.read_state().get('JobId')
+
+
+    def write_state(self, state):
+        tmpfile = self.state_file.with_name(f".{self.state_file.name}.{os.getpid()}")
+        tmpfile.write_text(json.dumps(state))
+        os.replace(tmpfile, self.state_file)
+
+
+    def write_job_id(self, job_id):
+        self.write_state({'JobId': job_id})
         
 
     def submit(self):
-        "Submit the comprehension job"
+        "Submit the comprehension job, or find the entities right away if the transcript is short"
+        inputs3uri = f"s3://{self.s3_bucket}/{self.job_name}.json"
         try:
             # get things formatted correctly
             (amp_transcript_obj, amp_entities_obj, ignore_types_list) = amp.nerutils.initialize_amp_entities(self.transcript, self.amp_entities, self.ignore_types)
-            self.s3_client.put_object(Body=json.dumps(amp_transcript_obj.results.transcript, default=lambda x: x.__dict__), Bucket=self.s3_bucket, Key=self.job_name + ".json")
+            document = document_text(amp_transcript_obj)
+            # a short transcript is quicker to do directly than as a job
+            if len(document) <= self.sync_max_size:
+                return self.detect_now(document)
+            if self.batch_window > 0:
+                return self.submit_batched(document)
+            self.s3_client.put_object(Body=document, Bucket=self.s3_bucket, Key=self.job_name + ".json")
 
             # submit the job
-            inputs3uri = f"s3://{self.s3_bucket}/{self.job_name}.json"
             response = self.comprehend_client.start_entities_detection_job(
                 InputDataConfig={
                     'S3Uri': inputs3uri,
@@ -75,18 +206,149 @@ class AWS_Comprehend(LWLW):
                 JobName=self.job_name,
                 LanguageCode='en'
             )
+            self.write_job_id(response['JobId'])
+            self.job = None
             logging.info(f"Successfully submitted AWS Comprehend job with input {inputs3uri}.")
+            self.polls.start()
             return LWLW.WAIT
         except Exception as e:
             logging.exception(f"Exception while submitting AWS Comprehend job with input {inputs3uri}")
             return LWLW.ERROR
         
 
+    def detect_now(self, document):
+        """Find the entities in the document with batch_detect_entities and
+           write the outputs, which are the same as a job's"""
+        chunks = sentence_chunks(document, SYNC_CHUNK_SIZE)
+        logging.info(f"Finding the entities in {self.transcript} in {len(chunks)} chunks")
+        entities = []
+        for i in range(0, len(chunks), SYNC_BATCH_SIZE):
+            batch = chunks[i:i + SYNC_BATCH_SIZE]
+            response = self.comprehend_client.batch_detect_entities(TextList=[text for _, text in batch], LanguageCode='en')
+            if response['ErrorList']:
+                raise Exception(f"Cannot find the entities: {response['ErrorList']}")
+            # the offsets are in the chunks, so move them to the document
+            for result in sorted(response['ResultList'], key=lambda r: r['Index']):
+                offset = batch[result['Index']][0]
+                for entity in result['Entities']:
+                    entity['BeginOffset'] += offset
+                    entity['EndOffset'] += offset
+                    entities.append(entity)
+        outdata = json.dumps({'Entities': entities, 'File': f"{self.job_name}.json"}).encode('utf-8')
+        rc = self.write_outputs(outdata)
+        # there is no job to look for when it is checked or cleaned up
+        self.write_state({'Sync': True})
+        self.job = None
+        return rc
+
+
+    def submit_batched(self, document):
+        """Add the transcript's document to an open batch, which is submitted
+           as one job when it is full or its window has passed"""
+        try:
+            # the document is uploaded before the registry is locked, so other
+            # jobs don't wait on the upload, and copied into the batch (within
+            # S3) once the batch is chosen
+            self.s3_client.put_object(Body=document, Bucket=self.s3_bucket, Key=self.job_name + ".json")
+            with self.batches.locked() as state:
+                batchid = self.find_open_batch(state)
+                if batchid is None:
+                    batchid = f"AWSC-BATCH-{uuid.uuid4()}"
+                    state['batches'][batchid] = {'opened': time.time(), 'files': {}, 'job_id': None,
+                                                 'submitted': False, 'failed': False}
+                batch = state['batches'][batchid]
+                # the documents are named for the jobs, which is how their
+                # results are told apart
+                logging.info(f"Adding {self.transcript} to batch {batchid}")
+                self.s3_client.copy_object(Bucket=self.s3_bucket, Key=f"{batchid}/{self.job_name}.json",
+                                           CopySource={'Bucket': self.s3_bucket, 'Key': self.job_name + ".json"})
+                batch['files'][self.job_name] = f"{self.job_name}.json"
+                state['jobs'][self.job_name] = batchid
+                if len(batch['files']) >= self.batch_max_files:
+                    self.submit_batch(batchid, batch)
+            try:
+                self.s3_client.delete_object(Bucket=self.s3_bucket, Key=self.job_name + ".json")
+            except Exception as e:
+                logging.warning(f"Cannot remove the uploaded document {self.job_name}.json: {e}")
+            return LWLW.ERROR if batch['failed'] else LWLW.WAIT
+        except Exception as e:
+            logging.exception(f"Exception while adding {self.transcript} to a batch")
+            return LWLW.ERROR
+
+
+    def find_open_batch(self, state):
+        "Return the id of an unsubmitted batch which the job can join, or None"
+        for batchid, batch in state['batches'].items():
+            if (not batch['submitted'] and time.time() - batch['opened'] < self.batch_window
+                and len(batch['files']) < self.batch_max_files):
+                return batchid
+        return None
+
+
+    def submit_batch(self, batchid, batch):
+        "Submit all of the transcripts in the batch as one job"
+        logging.info(f"Submitting batch {batchid} with {len(batch['files'])} transcripts")
+        try:
+            response = self.comprehend_client.start_entities_detection_job(
+                InputDataConfig={
+                    'S3Uri': f"s3://{self.s3_bucket}/{batchid}/",
+                    "InputFormat": "ONE_DOC_PER_FILE"
+                },
+                OutputDataConfig={
+                    'S3Uri': f"s3://{self.s3_bucket}/"
+                },
+                DataAccessRoleArn=self.role_arn,
+                JobName=batchid,
+                LanguageCode='en'
+            )
+            batch['job_id'] = response['JobId']
+            for job_name in batch['files']:
+                self.polls.for_job(job_name).start()
+        except Exception as e:
+            logging.exception(f"Cannot submit batch {batchid}")
+            batch['failed'] = True
+        batch['submitted'] = True
+        self.job = None
+
+
+    def submit_due_batch(self):
+        "Submit the job's batch if its window has passed, returning whether it failed"
+        with self.batches.locked() as state:
+            batch = state['batches'][state['jobs'][self.job_name]]
+            if not batch['submitted'] and time.time() - batch['opened'] >= self.batch_window:
+                self.submit_batch(state['jobs'][self.job_name], batch)
+            return batch['failed']
+
+
     def check(self):
+        "Check on the job when a poll is due"
+        return self.polls.poll(self.check_job, ready=self.output_in_s3)
+
+
+    def output_in_s3(self):
+        """Return whether the job's output is in S3, which is cheaper than
+           asking Comprehend.  The output goes to <account>-NER-<job id>, and
+           the account is the one in the role ARN."""
+        (batchid, batch) = self.batch_of_job()
+        job_id = batch['job_id'] if batch is not None else self.read_job_id()
+        if job_id is None:
+            return False
+        account = self.role_arn.split(':')[4]
+        return s3_object_exists(self.s3_client, self.s3_bucket, f"{account}-NER-{job_id}/output/output.tar.gz")
+
+
+    def check_job(self):
         job = self.exists()
         if job is None:
             logging.error(f"The job {self.job_name} should exist but it doesn't!")
             return LWLW.ERROR
+
+        if job.get('Sync'):
+            # the outputs were written when it was submitted
+            return LWLW.OK
+
+        if job['JobStatus'] == 'QUEUED':
+            return LWLW.ERROR if self.submit_due_batch() else LWLW.WAIT
         
         if job['JobStatus'] not in ('COMPLETED', 'FAILED', 'STOP_REQUESTED', 'STOPPED'):
             # if it isn't one of these then it's still busy.
@@ -97,15 +359,18 @@ class AWS_Comprehend(LWLW):
             return LWLW.ERROR
 
         # if we're here, then the job actually completed and we can gather our content.
+        if 'EndTime' in job:
+            self.polls.completed(job['EndTime'].timestamp())
         # Grab the content from S3
-        outputuri = job['OutputDataConfig']['S3Uri']
-        logging.info(f"Result in: {outputuri}")
-        with tempfile.TemporaryDirectory() as tmpdir:
-            (_, _, bucket, key) = outputuri.split('/', 3)
-            self.s3_client.download_file(bucket, key, tmpdir + "/output.tar.gz")
-            with tarfile.open(tmpdir + "/output.tar.gz") as tfile:
-                outdata = tfile.extractfile(tfile.getmember("output")).read()
-        
+        if 'Batch' in job:
+            outdata = self.batch_output(job)
+        else:
+            outdata = self.download_output(job)
+        return self.write_outputs(outdata)
+
+
+    def write_outputs(self, outdata):
+        "Write the aws entities output and the amp entities made from it"
         # output the aws entities data
         with open(self.aws_entities, "wb") as f:
             f.write(outdata)
@@ -128,9 +393,45 @@ class AWS_Comprehend(LWLW):
         return LWLW.OK
 
 
+    def download_output(self, job):
+        "Return the output of the job"
+        outputuri = job['OutputDataConfig']['S3Uri']
+        logging.info(f"Result in: {outputuri}")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (_, _, bucket, key) = outputuri.split('/', 3)
+            self.s3_client.download_file(bucket, key, tmpdir + "/output.tar.gz")
+            with tarfile.open(tmpdir + "/output.tar.gz") as tfile:
+                return tfile.extractfile(tfile.getmember("output")).read()
+
+
+    def batch_output(self, job):
+        """Return this transcript's line of the output of the batch's job.  The
+           output is downloaded once and kept for the other jobs in the batch"""
+        output_file = Path(get_work_dir("aws_comprehend"), f"{job['Batch']}.output")
+        if not output_file.exists():
+            tmpfile = output_file.with_name(f".{output_file.name}.{os.getpid()}")
+            tmpfile.write_bytes(self.download_output(job))
+            os.replace(tmpfile, output_file)
+        name = f"{self.job_name}.json"
+        with open(output_file, "rb") as f:
+            for line in f:
+                if line.strip() and json.loads(line).get('File') == name:
+                    return line.strip()
+        raise Exception(f"There is no output for {name} in batch {job['Batch']}")
+
+
     def cleanup(self):
         "Clean up the input, output, and job"
+        (batchid, batch) = self.batch_of_job()
+        if batch is not None:
+            return self.cleanup_batched()
+
         job = self.exists()
+        if job is not None and job.get('Sync'):
+            # the entities were found without a job
+            self.state_file.unlink(missing_ok=True)
+            self.job = None
+            return LWLW.OK
         if job is None:
             logging.error(f"The job {self.job_name} should exist but it doesn't!")
             return LWLW.ERROR
@@ -146,6 +447,8 @@ class AWS_Comprehend(LWLW):
             # delete the job
             # TODO: not sure how to do this.
             #self.comprehend_client.delete_job(jobId=job['JobId'])     
+            self.state_file.unlink(missing_ok=True)
+            self.job = None
             return LWLW.OK
         
         except Exception as e:
@@ -153,6 +456,54 @@ class AWS_Comprehend(LWLW):
             return LWLW.ERROR
 
 
+    def cleanup_batched(self):
+        "Remove this transcript from its batch, and the batch's output and job once it is the last one"
+        job = self.exists()
+        try:
+            with self.batches.locked() as state:
+                batchid = state['jobs'].pop(self.job_name)
+                batch = state['batches'][batchid]
+                self.s3_client.delete_object(Bucket=self.s3_bucket, Key=f"{batchid}/{batch['files'].pop(self.job_name)}")
+                if not batch['files']:
+                    logging.info(f"Removing batch {batchid}")
+                    if job is not None and 'OutputDataConfig' in job:
+                        (_, _, bucket, key) = job['OutputDataConfig']['S3Uri'].split('/', 3)
+                        self.s3_client.delete_object(Bucket=bucket, Key=key)
+                    Path(get_work_dir("aws_comprehend"), f"{batchid}.output").unlink(missing_ok=True)
+                    del state['batches'][batchid]
+            self.job = None
+            return LWLW.OK
+        except Exception as e:
+            logging.error(f"Error removing {self.job_name} from its batch: {e}")
+            return LWLW.ERROR
+
+
+def document_text(amp_transcript_obj):
+    "Return the text which Comprehend is given for the transcript"
+    return json.dumps(amp_transcript_obj.results.transcript, default=lambda x: x.__dict__)
+
+
+def sentence_chunks(text, size):
+    """Split the text into a list of (offset, chunk) with chunks of whole
+       sentences up to size characters.  Sentences which are too long are
+       split between words, or anywhere as a last resort."""
+    chunks = []
+    start = 0
+    while len(text) - start > size:
+        end = start + size
+        # the last sentence end in the chunk, or else the last space
+        breaks = [m.end() for m in SENTENCE_END.finditer(text, start, end)]
+        if breaks and breaks[-1] > start:
+            end = breaks[-1]
+        elif text.rfind(" ", start, end) > start:
+            end = text.rfind(" ", start, end) + 1
+        chunks.append((start, text[start:end]))
+        start = end
+    if start < len(text):
+        chunks.append((start, text[start:]))
+    return chunks
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
@@ -6,17 +6,56 @@
 # https://docs.aws.amazon.com/code-samples/latest/catalog/python-transcribe-getting_started.py.html
 # as a basis.
 import argparse
+import math
+import re
+import subprocess
+import time
 from pathlib import Path
 import logging
 import amp.logging
-from amp.config import load_amp_config, get_cloud_credentials, get_config_value
+from amp.config import load_amp_config, get_cloud_credentials, get_config_value, get_work_dir
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
 
 from amp.lwlw import LWLW
 from amp.cloudutils import generate_persistent_name
 
+# poll_schedule and file_hash are shared with the MGMs: they are symlinked
+# from ../mgms and mgm_build.sh installs copies next to this script
+from poll_schedule import PollSchedule, media_duration, s3_object_exists
+from file_hash import file_sha256
+
+# without any history, a job is expected to take a minute plus a third of the
+# audio duration
+EXPECTED_RATE = 0.3
+EXPECTED_OVERHEAD = 60
+
+# S3 allows 10000 parts in an upload, and the parts are at least this big
+MAX_PARTS = 10000
+MIN_PART_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 10
+
+# default hours that staged audio is kept for other jobs with the same audio
+DEFAULT_UPLOAD_RETENTION = 72
+
+# names of staged audio:  the sha256 of the audio and the format
+STAGED_AUDIO = re.compile(r"[0-9a-f]{64}(\.\w+)+")
+
+# staged audio is kept under its own prefix, each next to an empty marker
+# object which is rewritten whenever a job uses the audio
+STAGING_PREFIX = "staged_audio"
+USED_MARKER = ".used"
+
+# the staged audio is pruned at most this many times per retention period
+PRUNES_PER_RETENTION = 12
+
+# speech recognition doesn't need more than 16kHz mono, so audio is converted
+# to that as FLAC before it is uploaded
+TRANSCODE_RATE = 16000
+TRANSCODE_ARGS = ['-ac', '1', '-ar', str(TRANSCODE_RATE), '-c:a', 'flac', '-f', 'flac']
+
 
 class AWS_Transcribe(LWLW):
     def __init__(self, audio, transcript, format="wav"):
@@ -31,12 +70,21 @@ class AWS_Transcribe(LWLW):
             logging.error("mgms.aws_transcribe.s3_bucket is not specified in the config file")
             exit(1)    
         self.job_name = generate_persistent_name('AWST', self.audio, transcript)
+        # the audio is staged under its content hash so jobs with the same
+        # audio share one upload
+        self.s3_directory = get_config_value(self.config, ['mgms', 'aws_transcribe', 's3_directory'], None)
+        self.upload_retention = get_config_value(self.config, ['mgms', 'aws_transcribe', 'upload_retention'], DEFAULT_UPLOAD_RETENTION)
+        self.transcode = get_config_value(self.config, ['mgms', 'aws_transcribe', 'transcode'], True)
          
         # get our cloud clients
         aws_creds = get_cloud_credentials(self.config, 'aws')
         self.transcribe_client = boto3.client('transcribe', **aws_creds)
         self.s3_client = boto3.client('s3', **aws_creds)
 
+        # the job is polled when it should be done, when an S3 event
+        # notification for its output arrives, or once its output is in S3
+        self.polls = PollSchedule('aws_transcribe', self.job_name, rate=EXPECTED_RATE, overhead=EXPECTED_OVERHEAD)
+
 
     def exists(self):
         "Return the transcription job data or None if it doesn't exist"        
@@ -50,35 +98,118 @@ class AWS_Transcribe(LWLW):
 
     def submit(self):        
         "Upload the audio file to S3 and submit the transcription job"
-        # upload the file to S3
-        input_uri = f"s3://{self.s3_bucket}/{self.job_name}"
- 
+        # upload the file to S3, unless another job already did
         try:
-            logging.info(f"Uploading file {str(self.audio)} to {input_uri}")
-            self.s3_client.upload_file(str(self.audio), self.s3_bucket, self.job_name)
+            key = self.stage_audio()
         except Exception as e:
             logging.exception(f"Failed to upload file {self.audio}: {e}!")
-            return 1
+            return LWLW.ERROR
+        input_uri = f"s3://{self.s3_bucket}/{key}"
         
         # transcribe the file
+        media = {'MediaFormat': self.format}
+        if self.transcode:
+            media = {'MediaFormat': 'flac', 'MediaSampleRateHertz': TRANSCODE_RATE}
         try:
             logging.info(f"Starting transcription job {self.job_name}")            
             self.transcribe_client.start_transcription_job(
                 TranscriptionJobName=self.job_name,
                 Media={'MediaFileUri': input_uri},
-                MediaFormat=self.format,
+                **media,
                 LanguageCode="en-US",
                 OutputBucketName=self.s3_bucket,
                 Settings={"ShowSpeakerLabels": True, "MaxSpeakerLabels": 10 }
             )
             logging.info(f"Waiting for transcription job {self.job_name} to complete")
+            self.polls.start(media_duration(self.audio))
             return LWLW.WAIT
         except Exception as e:
             logging.exception(f"Failed to submit transcription job!")
             return LWLW.ERROR
 
 
+    def stage_audio(self):
+        """Upload the audio (converted, unless transcoding is off) to its
+           content addressed key, unless it is already there, and return the key"""
+        digest = file_sha256(self.audio)
+        name = f"{digest}.{TRANSCODE_RATE // 1000}k.flac" if self.transcode else f"{digest}.{self.format}"
+        key = self.staging_prefix() + name
+        # marking it used before looking for it keeps it from being pruned
+        # while this job uses it
+        self.s3_client.put_object(Bucket=self.s3_bucket, Key=key + USED_MARKER, Body=b"")
+        if s3_object_exists(self.s3_client, self.s3_bucket, key):
+            logging.info(f"{self.audio} is already staged as s3://{self.s3_bucket}/{key}")
+            return key
+        # the converted audio is at most the size of the input
+        config = transfer_config(self.audio.stat().st_size)
+        if not self.transcode:
+            logging.info(f"Uploading file {self.audio} to s3://{self.s3_bucket}/{key}")
+            self.s3_client.upload_file(str(self.audio), self.s3_bucket, key, Config=config)
+            return key
+        logging.info(f"Converting {self.audio} to FLAC and uploading it to s3://{self.s3_bucket}/{key}")
+        # the conversion is uploaded as ffmpeg writes it, without a temporary file
+        with subprocess.Popen(['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', str(self.audio), '-vn', *TRANSCODE_ARGS, '-'],
+                              stdin=subprocess.DEVNULL, stdout=subprocess.PIPE) as ffmpeg:
+            try:
+                self.s3_client.upload_fileobj(ProcessOutput(ffmpeg), self.s3_bucket, key, Config=config)
+            finally:
+                ffmpeg.kill()
+        return key
+
+
+    def staging_prefix(self):
+        "Return the S3 prefix of the staged audio"
+        if self.s3_directory:
+            return f"{self.s3_directory.strip('/')}/{STAGING_PREFIX}/"
+        return f"{STAGING_PREFIX}/"
+
+
+    def prune_staged_audio(self):
+        """Remove staged audio which no job has used for the retention period,
+           unless it was pruned recently"""
+        stamp = Path(get_work_dir("aws_transcribe"), f"pruned-{self.s3_bucket}")
+        if stamp.exists() and time.time() - stamp.stat().st_mtime < self.upload_retention * 3600 / PRUNES_PER_RETENTION:
+            return
+        stamp.touch()
+        prefix = self.staging_prefix()
+        cutoff = time.time() - self.upload_retention * 3600
+        # the audio was last used when it or its marker was last written
+        last_used = {}
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=prefix, Delimiter='/'):
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(prefix):]
+                if name.endswith(USED_MARKER):
+                    name = name[:-len(USED_MARKER)]
+                if STAGED_AUDIO.fullmatch(name):
+                    last_used[name] = max(last_used.get(name, 0), obj['LastModified'].timestamp())
+        for name, used in last_used.items():
+            if used >= cutoff:
+                continue
+            # a job may have started using it since it was listed
+            try:
+                marker = self.s3_client.head_object(Bucket=self.s3_bucket, Key=prefix + name + USED_MARKER)
+                if marker['LastModified'].timestamp() >= cutoff:
+                    continue
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise
+            logging.info(f"Removing staged audio {prefix + name}")
+            self.s3_client.delete_object(Bucket=self.s3_bucket, Key=prefix + name)
+            self.s3_client.delete_object(Bucket=self.s3_bucket, Key=prefix + name + USED_MARKER)
+
+
     def check(self):
+        "Check on the status of the running job when a poll is due"
+        return self.polls.poll(self.check_job, ready=self.output_in_s3)
+
+
+    def output_in_s3(self):
+        "Return whether the transcript is in S3, which is cheaper than asking Transcribe"
+        return s3_object_exists(self.s3_client, self.s3_bucket, self.job_name + ".json")
+
+
+    def check_job(self):
         "Check on the status of the running job"
         job = self.exists()
         if job is None:
@@ -88,6 +219,8 @@ class AWS_Transcribe(LWLW):
         job_status = job['TranscriptionJob']['TranscriptionJobStatus']
         logging.debug(f"Transcoding job status: {job_status}")
         if job_status == 'COMPLETED':
+            if 'CompletionTime' in job['TranscriptionJob']:
+                self.polls.completed(job['TranscriptionJob']['CompletionTime'].timestamp())
             transcription_uri = job['TranscriptionJob']['Transcript']['TranscriptFileUri']
             logging.info(f"Result URI: {transcription_uri}.  Result bucket: {self.s3_bucket}, Key: {self.job_name + '.json'}")
             try:
@@ -105,13 +238,13 @@ class AWS_Transcribe(LWLW):
 
 
     def cleanup(self):
-        "Remove the job and generated data (on aws), and the input file (in s3)"    
-        # remove the source data from S3
+        "Remove the job and generated data (on aws), and the staged audio that isn't used anymore (in s3)"    
+        # the audio is shared with other jobs, so it's only removed once it
+        # hasn't been used for a while
         try:
-            self.s3_client.delete_object(Bucket=self.s3_bucket, Key=self.job_name)
-            logging.info(f"Removed {self.job_name} from S3 bucket {self.s3_bucket}")
+            self.prune_staged_audio()
         except Exception as e:
-            logging.warning(f"Cannot remove source file {self.s3_bucket}/{self.job_name} for job {self.job_name}:\n{e}")
+            logging.warning(f"Cannot prune the staged audio in {self.s3_bucket}:\n{e}")
             
         # remove the job (and generated data) from AWS
         job = self.exists()
@@ -126,6 +259,29 @@ class AWS_Transcribe(LWLW):
                 pass
 
 
+class ProcessOutput:
+    """The output of a process as a file object which fails at the end if the
+       process failed, so a partial output is never uploaded"""
+    def __init__(self, process):
+        self.process = process
+
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data or size < 0:
+            rc = self.process.wait()
+            if rc != 0:
+                raise Exception(f"{self.process.args[0]} failed with exit code {rc}")
+        return data
+
+
+def transfer_config(size):
+    "Return the S3 transfer configuration for uploading a file of the given size"
+    part_size = max(MIN_PART_SIZE, math.ceil(size / MAX_PARTS))
+    return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                          max_concurrency=max(1, min(MAX_CONCURRENCY, math.ceil(size / part_size))))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
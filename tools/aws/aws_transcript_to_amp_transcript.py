@@ -1,11 +1,18 @@
 #!/usr/bin/env amp_python.sif
 import argparse
+import itertools
 import logging
+import math
+from array import array
 import amp.logging
-from amp.fileutils import read_json_file, write_json_file, valid_file
-from amp.schema.speech_to_text import SpeechToText, SpeechToTextMedia, SpeechToTextResult
+from amp.fileutils import write_json_file, valid_file
 from amp.schema.segmentation import Segmentation, SegmentationMedia
 
+# json_stream and transcript_columns are shared with the MGMs: they are
+# symlinked from ../mgms and mgm_build.sh installs copies next to this script
+from json_stream import walk_json, write_json_stream
+from transcript_columns import WordColumnsBuilder
+
 def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
@@ -17,105 +24,155 @@ def main():
 	amp.logging.setup_logging("aws_transcript_to_amp_transcript", args.debug)
 	logging.info(f"Starting with args {args}")
 
-	# read the AWS transcribe json file
+	# read the AWS transcribe json file in one pass.  The items (words) are
+	# as long as the media, so they are kept as columns instead of a dict
+	# for each one, and the speaker segments go straight to the
+	# segmentation.
 	if not valid_file(args.aws_transcript):
 		logging.error(f"{args.aws_transcript} is not a valid file")
 		exit(1)
-	aws = read_json_file(args.aws_transcript)		
+	transcripts = []
+	items = ItemColumns()
+	segmentation = Segmentation()
+	def add_segments(segments):
+		# For each segment, get the start time, end time and speaker label
+		for segment in segments:
+			segmentation.addDiarizationSegment(float(segment["start_time"]), float(segment["end_time"]), segment["speaker_label"])
+	def set_speakers(speakers):
+		segmentation.numSpeakers = speakers
+	found = walk_json(args.aws_transcript, {"results.transcripts": transcripts.extend,
+											"results.items": items.read,
+											"results.speaker_labels.speakers": set_speakers,
+											"results.speaker_labels.segments": add_segments})
 
 	# Fail if we don't have results
-	if "results" not in aws.keys():
+	if not found:
 		logging.error("no results in keys")
 		exit(1)
 
-	amp_results = SpeechToTextResult()
-	aws_results = aws["results"]
-
-	if "transcripts" not in aws_results.keys():
+	if "results.transcripts" not in found:
 		logging.error("no transcripts in aws_results")
 		exit(1)
 
 	# Parse transcript
-	transcripts = aws_results["transcripts"]
+	transcript = ""
 	for t in transcripts:
 		# assuming each transcript doesn't include space or newline at the end, to keep the format consistent with word list,
 		# we should separate transcripts with newline in between
-		if not amp_results.transcript:
+		if not transcript:
 			# for the first transcript
-			amp_results.transcript = t["transcript"]
+			transcript = t["transcript"]
 		else:
-			amp_results.transcript = amp_results.transcript + "\n" + t["transcript"]		
+			transcript = transcript + "\n" + t["transcript"]
 
 	# Fail if we don't have any items
-	if "items" not in aws_results.keys():
+	if "results.items" not in found:
 		logging.error("no items in aws_results")
 		exit(1)
 
-	# Parse items (words)
-	items = aws_results["items"]
-	duration = 0.00
-	
-	# For each item, get the necessary parts and store as a word
-	for item in items:
-		alternatives = item["alternatives"]
-		# Choose an alternative
-		max_confidence = 0.00
-		text = ""
-
-		# Each word is stored as an "alternative".  Get the one with the maximum confidence
-		for a in alternatives:
-			if float(a["confidence"]) >= max_confidence:
-				max_confidence = float(a["confidence"])
-				text = a["content"]
-
-		end_time = -1
-		start_time = -1
-
-		# Two types (punctionation, pronunciation).  Only keep times for pronunciation
-		if item["type"] == "pronunciation":
-			end_time = float(item["end_time"])
-			start_time = float(item["start_time"])
-
-			# If this is the greatest end time, store it as duration
-			if end_time > duration:
-				duration = end_time
-		
-		# Add the word to the results
-		amp_results.addWord(item["type"], text, None, start_time, end_time, "confidence", max_confidence)
-		
-	# compute offset for all words in the list
-	amp_results.compute_offset()
-	
-	# Create the media object
-	media = SpeechToTextMedia(duration, args.input_audio)
+	# the duration is the greatest end time
+	duration = items.duration()
 
-	# Create the final object
-	outputFile = SpeechToText(media, amp_results)
-
-	# Write the output
-	write_json_file(outputFile, args.amp_transcript)
+	# Write the output, and the word sidecar for the MGMs downstream
+	offsets = items.offsets(transcript)
+	outputFile = {'media': {'duration': duration, 'filename': args.input_audio},
+				  'results': {'transcript': transcript, 'words': []}}
+	write_json_stream(outputFile, args.amp_transcript, "results.words", items.words(offsets))
+	columns = WordColumnsBuilder()
+	items.add_to(columns, offsets)
+	columns.save(args.amp_transcript)
 
 	# Start segmentation schema with diarization data
-	# Create a segmentation object to serialize
-	segmentation = Segmentation()
-
 	# Create the media object
 	segMedia = SegmentationMedia(duration, args.input_audio)
 	segmentation.media = segMedia
-	
-	if "speaker_labels" in aws_results.keys():
-		speakerLabels = aws_results["speaker_labels"]
-		segmentation.numSpeakers = speakerLabels["speakers"]
-
-		# For each segment, get the start time, end time and speaker label
-		segments = speakerLabels["segments"]
-		for segment in segments:
-			segmentation.addDiarizationSegment(float(segment["start_time"]), float(segment["end_time"]), segment["speaker_label"])
 		
 	# Write the output
 	write_json_file(segmentation, args.amp_diarization)
 	logging.info(f"Successfully converted {args.aws_transcript} to {args.amp_transcript} and {args.amp_diarization}.")
 
 
+class ItemColumns:
+	"The AWS items (words and punctuation) as columns"
+	def __init__(self):
+		self.types = []
+		self.texts = []
+		# punctuation has no times, which is NaN in the columns
+		self.starts = array('d')
+		self.ends = array('d')
+		self.scores = array('d')
+		# the same word is the same string object, which saves a lot of memory
+		self.strings = {}
+
+
+	def read(self, items):
+		"Add the items to the columns"
+		strings = self.strings
+		for item in items:
+			alternatives = item["alternatives"]
+			# Choose an alternative
+			max_confidence = 0.00
+			text = ""
+
+			# Each word is stored as an "alternative".  Get the one with the maximum confidence
+			for a in alternatives:
+				if float(a["confidence"]) >= max_confidence:
+					max_confidence = float(a["confidence"])
+					text = a["content"]
+
+			item_type = item["type"]
+			self.types.append(strings.setdefault(item_type, item_type))
+			self.texts.append(strings.setdefault(text, text))
+			self.scores.append(max_confidence)
+
+			# Two types (punctionation, pronunciation).  Only keep times for pronunciation
+			if item_type == "pronunciation":
+				self.starts.append(float(item["start_time"]))
+				self.ends.append(float(item["end_time"]))
+			else:
+				self.starts.append(math.nan)
+				self.ends.append(math.nan)
+
+
+	def duration(self):
+		"Return the greatest end time"
+		# NaN isn't greater than anything, so punctuation is left out
+		return max((end for end in self.ends if end > 0), default=0.00)
+
+
+	def offsets(self, transcript):
+		"Return the offset of each word in the transcript, or -1 if it can't be found"
+		# Words appear in the transcript in order, so each word's offset is
+		# found by searching forward from the end of the previous one.
+		offsets = array('q')
+		offset = 0
+		find = transcript.find
+		for text in self.texts:
+			word_offset = find(text, offset)
+			if word_offset >= 0:
+				offset = word_offset + len(text)
+			offsets.append(word_offset)
+		return offsets
+
+
+	def words(self, offsets):
+		"Yield the AMP transcript words"
+		for (item_type, text, start, end, score, offset) in zip(self.types, self.texts, self.starts, self.ends, self.scores, offsets):
+			word = {'type': item_type, 'text': text}
+			if item_type == "pronunciation":
+				word['start'] = start
+				word['end'] = end
+			word['score'] = {'type': "confidence", 'value': score}
+			if offset >= 0:
+				word['offset'] = offset
+			yield word
+
+
+	def add_to(self, columns, offsets):
+		"Add the words to the WordColumnsBuilder"
+		columns.add_columns(self.types, self.texts, self.starts, self.ends, offsets,
+							itertools.repeat("confidence", len(self.texts)), self.scores)
+
+
 if __name__ == "__main__":
 	main()
\ No newline at end of file
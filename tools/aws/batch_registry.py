@@ -0,0 +1 @@
+../mgms/batch_registry.py
\ No newline at end of file
@@ -0,0 +1 @@
+../mgms/file_hash.py
\ No newline at end of file
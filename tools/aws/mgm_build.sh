@@ -8,5 +8,7 @@ if [ $destdir == "unspecified" ]; then
 fi
 
 mkdir -p $destdir/tools/aws
-cp -av *.py *.xml $destdir/tools/aws
+# -L installs copies of the modules symlinked from ../mgms, so the package
+# doesn't depend on the mgms package being installed next to it
+cp -avL *.py *.xml $destdir/tools/aws
 
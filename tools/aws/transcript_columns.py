@@ -0,0 +1 @@
+../mgms/transcript_columns.py
\ No newline at end of file
@@ -1,5 +1,7 @@
 #!/usr/bin/env amp_python.sif
 import argparse
+import fcntl
+import os
 import requests
 import logging
 import time
@@ -10,20 +12,40 @@ import logging
 import http.client as http_client
 from pathlib import Path
 from azure.identity import ClientSecretCredential
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pprint import pprint
 
 import amp.logging
-from amp.config import load_amp_config, get_config_value, get_cloud_credentials
+from amp.config import load_amp_config, get_config_value, get_cloud_credentials, get_work_dir
 from amp.fileutils import write_json_file
 from amp.lwlw import LWLW
 from amp.cloudutils import generate_persistent_name
 
+# poll_schedule is shared with the MGMs: it is symlinked from ../mgms and
+# mgm_build.sh installs a copy next to this script
+from poll_schedule import PollSchedule, media_duration
+
 # chunks shamelessly stolen from 
 # https://github.com/Azure-Samples/azure-video-indexer-samples/blob/master/API-Samples/Python/
 
 API_ENDPOINT = "https://api.videoindexer.ai"
 ARM_ENDPOINT = "https://management.azure.com"
 
+# without any history, indexing is expected to take three minutes plus half
+# of the video duration
+EXPECTED_RATE = 0.5
+EXPECTED_OVERHEAD = 180
+
+# seconds the account metadata (location and account id) is cached for
+ACCOUNT_TTL = 24 * 3600
+
+# seconds before a cached token expires that a new one is requested
+TOKEN_MARGIN = 120
+
+# size of the pieces the insights and the OCR artifact are written in
+DOWNLOAD_CHUNK = 1024 * 1024
+
 
 
 
@@ -61,8 +83,15 @@ class AzureVideoIndexer(LWLW):
         self.aws_creds = get_cloud_credentials(self.config, 'aws')
         self.s3_client = boto3.client("s3", **self.aws_creds)
 
-        # Azure Stuff
+        # Azure Stuff.  The requests share keep-alive connections, and the
+        # idempotent ones are retried when the service is throttling or
+        # having trouble.
+        self.session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        self.session.mount("https://", HTTPAdapter(max_retries=retries))
         self.azure_creds = get_cloud_credentials(self.config, 'azure')
+        self.workdir = Path(get_work_dir("azure_video_indexer"))
+        self.token_cache = self.workdir / f"token-{self.azure_creds['subscription_id']}-{self.azure_creds['resource_group']}-{self.azure_creds['account_name']}.json"
         self.auth_token = None
         self.auth_token_expire = 0
         self.account = None
@@ -71,23 +100,47 @@ class AzureVideoIndexer(LWLW):
         logging.debug(f"API URL Base: {self.api_url_base}")
 
         self.job_name = generate_persistent_name("AzureVideoIndexer-", self.input_video, self.azure_video_index)
+        self.polls = PollSchedule('azure_video_indexer', self.job_name, rate=EXPECTED_RATE, overhead=EXPECTED_OVERHEAD)
+        # the id of the video is kept here once it's known, so the job can be
+        # looked up directly rather than by listing the videos in the account
+        self.state_file = self.workdir / f"{self.job_name}.json"
 
 
     def exists(self):
         "Get information about the job or None if it doesn't exist"
-        check_url = f"{self.api_url_base}/Videos"
-        r = requests.get(check_url,
-                            params={'accessToken': self._get_request_token()})
+        # search by the video id if submit recorded it, otherwise by the
+        # external id.  Either way it's one small request, no matter how many
+        # videos are in the account.
+        video_id = self.read_video_id()
+        params = {'accessToken': self._get_request_token()}
+        if video_id is not None:
+            params['id'] = video_id
+        else:
+            params['externalId'] = self.job_name
+        r = self.session.get(f"{self.api_url_base}/Videos/Search", params=params)
         r.raise_for_status()
         data = json.loads(r.text)
         for r in data['results']:
             logging.debug(f"{r['id']}: {r['name']} ({r['externalId']}) {r['state']}")
             if r['externalId'] == self.job_name:
+                if video_id is None:
+                    self.write_video_id(r['id'])
                 return r
 
         return None        
 
 
+    def read_video_id(self):
+        try:
+            return json.loads(self.state_file.read_text())['id']
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+    def write_video_id(self, video_id):
+        write_state(self.state_file, {'id': video_id})
+
+
     def submit(self):
         "Submit the job to AVI"
         # upload the source video
@@ -104,7 +157,7 @@ class AzureVideoIndexer(LWLW):
             # construct an AWS S3 video URL for AVI
             video_url = f"https://{self.s3_bucket}.s3.{self.aws_creds['region_name']}.amazonaws.com/{self.job_name}"
             upload_url = self.api_url_base + "/Videos"
-            r = requests.post(upload_url,
+            r = self.session.post(upload_url,
                             params={
                                 'accessToken': self._get_request_token(),
                                 'name': Path(self.input_video).name,
@@ -121,6 +174,8 @@ class AzureVideoIndexer(LWLW):
             # log the ID of the job.
             data = json.loads(r.text)
             logging.info(f"Azure Video Indexer job id: {data['id']}")
+            self.write_video_id(data['id'])
+            self.polls.start(media_duration(self.input_video))
             return LWLW.WAIT
         
         except Exception as e:
@@ -129,6 +184,11 @@ class AzureVideoIndexer(LWLW):
         
 
     def check(self):
+        "Check on the status when a poll is due"
+        return self.polls.poll(self.check_job)
+
+
+    def check_job(self):
         "Check on the status and handle results if ready"
         job = self.exists()
         if job is None:
@@ -140,22 +200,19 @@ class AzureVideoIndexer(LWLW):
             return LWLW.WAIT
         
         # write the Azure Video Index data to a file
-        r = requests.get(url=f"{self.api_url_base}/Videos/{job['id']}/Index",
-                         params={
-                            'accessToken': self._get_request_token(),
-                            'language': 'English',
-                            'includeSummarizedInsights': 'true',
-                        })       
-        if r.status_code != 200:
-            logging.error(f"Cannot retrieve insights for {job['id']}: {r.text}")
+        if not self.download(f"{self.api_url_base}/Videos/{job['id']}/Index", self.azure_video_index,
+                             params={
+                                'accessToken': self._get_request_token(),
+                                'language': 'English',
+                                'includeSummarizedInsights': 'true',
+                             }):
+            logging.error(f"Cannot retrieve insights for {job['id']}")
             return LWLW.ERROR
-        with open(self.azure_video_index, "wb") as f:
-            f.write(r.content)
 
         # if OCR was requested, handle it.
         if self.azure_artifact_ocr:
             get_artifact_url = f"{self.api_url_base}/Videos/{job['id']}/ArtifactUrl"
-            r = requests.get(url=get_artifact_url, 
+            r = self.session.get(url=get_artifact_url, 
                              params={'type': 'ocr',
                                      'accessToken': self._get_request_token()})
             if r.status_code != 200:
@@ -163,14 +220,33 @@ class AzureVideoIndexer(LWLW):
                 return LWLW.ERROR
             ocr_url = json.loads(r.text)
             logging.info(f"OCR URL: {ocr_url}")
-            r = requests.get(url=ocr_url)
-            with open(self.azure_artifact_ocr, "wb") as f:
-                f.write(r.content)
+            if not self.download(ocr_url, self.azure_artifact_ocr):
+                logging.error(f"Cannot download the OCR output for {job['id']}")
+                return LWLW.ERROR
             logging.info(f"OCR output written to {self.azure_artifact_ocr}")
 
         return LWLW.OK
         
 
+    def download(self, url, filename, params=None):
+        """Stream a response into a file rather than holding it in memory,
+           returning whether it worked"""
+        # requests asks for gzip by default and decompresses as it goes, so
+        # the large JSON documents come over the wire compressed
+        try:
+            with self.session.get(url, params=params, stream=True) as r:
+                if r.status_code != 200:
+                    logging.error(f"Download of {r.url} failed with status {r.status_code}: {r.text}")
+                    return False
+                with open(filename, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                        f.write(chunk)
+            return True
+        except Exception as e:
+            logging.error(f"Cannot download to {filename}: {e}")
+            return False
+
+
     def cleanup(self):
         "Clean up the job artifacts"
         try:
@@ -183,8 +259,9 @@ class AzureVideoIndexer(LWLW):
             job = self.exists()
             if job:
                 video_url = f"{self.api_url_base}/Videos/{job['id']}"
-                requests.delete(url=video_url,
+                self.session.delete(url=video_url,
                                 params={'accessToken': self._get_request_token()})
+            self.state_file.unlink(missing_ok=True)
             return LWLW.OK    
         except Exception as e:
             logging.error(f"Failed to clean up job artifacts: {e}")
@@ -193,49 +270,96 @@ class AzureVideoIndexer(LWLW):
 
     def _get_request_token(self):
         "Request an auth token"        
-        if time.time() > self.auth_token_expire or self.auth_token is None:
-            logging.info("Requesting new auth token")
-
-            # Get an Azure credential.  As luck would have it,
-            # we have that in the form of the tenant_id, client_id, and
-            # client_secret fields in the azure credentials configuration.
-            tenant_id = self.azure_creds['tenant_id']
-            client_id = self.azure_creds['client_id']
-            client_secret = self.azure_creds['client_secret']
-            credential = ClientSecretCredential(tenant_id, client_id, client_secret)
-            
-            # Get an ARM access token.  We'll just get a default one.
-            scope = "https://management.azure.com/.default" 
-            arm_access_token = credential.get_token(scope).token
-            logging.debug(f"Retrieved ARM token: {arm_access_token}")
-
-            # Now, get a video indexer account access token
-            subscription_id = self.azure_creds['subscription_id']
-            resource_group = self.azure_creds['resource_group']
-            account_name = self.azure_creds['account_name']
-            url = (f'https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}' + 
-                    f'/providers/Microsoft.VideoIndexer/accounts/{account_name}/generateAccessToken?api-version=2024-01-01')
-            params = {'permissionType': 'Contributor',
-                      'scope': 'Account'}
-            headers = {'Authorization': f"Bearer {arm_access_token}",
-                       'Content-Type': 'application/json'}
-            response = requests.post(url, json=params, headers=headers)
-            response.raise_for_status()                
-            self.auth_token = response.json()['accessToken']                
-            self.auth_token_expire = time.time() + 1800  # 30 minutes
-            logging.debug(f"Retrieved VI Account Access Token: {self.auth_token}")
-
-            # while we're here, we're going to grab the account information so
-            # we can get the region and accountid  automatically.
+        if self.auth_token is None or time.time() > self.auth_token_expire - TOKEN_MARGIN:
+            # every poll is a new process, so the token and the account
+            # information are shared through a cache in the work directory.
+            # The lock keeps concurrent processes from all minting tokens
+            # when it runs out.
+            with self._token_lock():
+                cache = self._read_token_cache()
+                now = time.time()
+                if cache.get('expires', 0) - TOKEN_MARGIN < now or cache.get('account_expires', 0) < now:
+                    cache = self._refresh_token_cache(cache)
+                    write_state(self.token_cache, cache, private=True)
+            self.auth_token = cache['accessToken']
+            self.auth_token_expire = cache['expires']
+            self.account = cache['account']
+
+        return self.auth_token
+
+
+    def _refresh_token_cache(self, cache):
+        "Get a new token, and the account information if it's stale, returning the new cache contents"
+        logging.info("Requesting new auth token")
+
+        # Get an Azure credential.  As luck would have it,
+        # we have that in the form of the tenant_id, client_id, and
+        # client_secret fields in the azure credentials configuration.
+        tenant_id = self.azure_creds['tenant_id']
+        client_id = self.azure_creds['client_id']
+        client_secret = self.azure_creds['client_secret']
+        credential = ClientSecretCredential(tenant_id, client_id, client_secret)
+        
+        # Get an ARM access token.  We'll just get a default one.
+        scope = "https://management.azure.com/.default" 
+        arm_access_token = credential.get_token(scope).token
+        logging.debug(f"Retrieved ARM token: {arm_access_token}")
+
+        # Now, get a video indexer account access token
+        subscription_id = self.azure_creds['subscription_id']
+        resource_group = self.azure_creds['resource_group']
+        account_name = self.azure_creds['account_name']
+        url = (f'https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}' + 
+                f'/providers/Microsoft.VideoIndexer/accounts/{account_name}/generateAccessToken?api-version=2024-01-01')
+        params = {'permissionType': 'Contributor',
+                  'scope': 'Account'}
+        headers = {'Authorization': f"Bearer {arm_access_token}",
+                   'Content-Type': 'application/json'}
+        response = self.session.post(url, json=params, headers=headers)
+        response.raise_for_status()                
+        now = time.time()
+        cache = {**cache,
+                 'accessToken': response.json()['accessToken'],
+                 'expires': now + 1800}  # 30 minutes
+        logging.debug(f"Retrieved VI Account Access Token: {cache['accessToken']}")
+
+        # while we're here, we're going to grab the account information so
+        # we can get the region and accountid  automatically.  It hardly
+        # ever changes, so it's kept for a day.
+        if cache.get('account_expires', 0) < now:
             headers = {'Authorization': f'Bearer {arm_access_token}',
                        'Content-Type': 'application/json'}
             url = (f'https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}' + 
                     f'/providers/Microsoft.VideoIndexer/accounts/{account_name}?api-version=2024-01-01')
-            response = requests.get(url, headers=headers)
+            response = self.session.get(url, headers=headers)
             response.raise_for_status()
-            self.account = response.json()            
+            cache['account'] = response.json()
+            cache['account_expires'] = now + ACCOUNT_TTL
+        return cache
 
-        return self.auth_token
+
+    def _read_token_cache(self):
+        try:
+            return json.loads(self.token_cache.read_text())
+        except (OSError, ValueError):
+            return {}
+
+
+    def _token_lock(self):
+        lockfile = open(str(self.token_cache) + ".lock", "w")
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        # closing the file releases the lock
+        return lockfile
+
+
+def write_state(filename, data, private=False):
+    "Write a file in the work directory so other processes never see it half written"
+    tmpfile = filename.with_name(f".{filename.name}.{os.getpid()}")
+    if private:
+        # only readable by us, since it holds a token
+        tmpfile.touch(mode=0o600)
+    tmpfile.write_text(json.dumps(data))
+    os.replace(tmpfile, filename)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,19 @@
 #!/usr/bin/env amp_python.sif
 import logging
 import argparse
+import contextlib
+import itertools
 import logging
 import amp.logging
 from amp.timeutils import frameToSecond
-from amp.fileutils import read_json_file, write_json_file, valid_file
+from amp.fileutils import read_json_file, valid_file
 from amp.schema.video_ocr import VideoOcr, VideoOcrMedia, VideoOcrResolution, VideoOcrFrame, VideoOcrObject, VideoOcrObjectScore, VideoOcrObjectVertices
 from amp.miscutils import strtobool
 
+# json_stream is shared with the MGMs: it is symlinked from ../mgms and
+# mgm_build.sh installs a copy next to this script
+from json_stream import walk_json, JsonStreamWriter
+
 def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
@@ -25,35 +31,76 @@ def main():
 	# get Azure video indexer json
 	azure_index_json = read_json_file(args.azure_video_index)
 
-	# get Azure artifact OCR json
-	# in case Azure Indexer didn't produce OCR artifact, pass in empty json
-	azure_ocr_json = read_json_file(args.azure_artifact_ocr) if valid_file(args.azure_artifact_ocr) else None
-
-	# create AMP Video OCR object
-	vocr = create_amp_vocr(args.input_video, azure_index_json, azure_ocr_json)
-	
-	# write AMP Video OCR JSON file
-	write_json_file(vocr, args.amp_vocr)
-	logging.info(f"Successfully generated AMP VOCR with {len(vocr.frames)} original frames.")
-	
-	# if dedupe, create the deduped AMP VOCR
+	# read the Azure artifact OCR json in one pass, writing the outputs as its
+	# results are read, since the artifact for a long video can be hundreds of
+	# MB.  The frames need the frame rate, so if it comes after the results
+	# they are kept until it has been read.
+	# in case Azure Indexer didn't produce OCR artifact, there are no frames
+	if valid_file(args.azure_artifact_ocr):
+		artifact = {}
+		def read_results(results):
+			if "Fps" in artifact:
+				artifact["counts"] = write_amp_vocr(args, azure_index_json, artifact["Fps"], results)
+			else:
+				artifact["Results"] = list(results)
+		def set_fps(fps):
+			artifact["Fps"] = fps
+		found = walk_json(args.azure_artifact_ocr, {"Fps": set_fps, "Results": read_results})
+		missing = {"Fps", "Results"} - found
+		if missing:
+			logging.error(f"{args.azure_artifact_ocr} has no {' or '.join(sorted(missing))}")
+			exit(1)
+		if "Results" in artifact:
+			artifact["counts"] = write_amp_vocr(args, azure_index_json, artifact["Fps"], artifact["Results"])
+		(nframes, ndeduped) = artifact["counts"]
+	else:
+		(nframes, ndeduped) = write_amp_vocr(args, azure_index_json, 0, [])
+	logging.info(f"Successfully generated AMP VOCR with {nframes} original frames.")
 	if args.dedupe:
-		vocr_dedupe = vocr.dedupe(args.dup_gap)
-		write_json_file(vocr_dedupe, args.amp_vocr_dedupe)
-		logging.info(f"Successfully deduped AMP VOCR to {len(vocr_dedupe.frames)} frames.")			
-	
-	
+		logging.info(f"Successfully deduped AMP VOCR to {ndeduped} frames.")
+
+
+# Write the AMP VOCR JSON file, and the deduped one if wanted, as the frames are created
+# from the given iterable of Azure OCR artifact results.  Returns the numbers of frames written.
+def write_amp_vocr(args, azure_index_json, frameRate, results):
+	# the resolution comes from the first result
+	results = iter(results)
+	first = next(results, None)
+	results = itertools.chain([first], results) if first is not None else results
+	vocr = create_amp_vocr_media(args.input_video, azure_index_json, frameRate, first)
+	nframes = 0
+	ndeduped = 0
+	with JsonStreamWriter(vars(vocr), args.amp_vocr, "frames") as writer, \
+			(JsonStreamWriter(vars(vocr), args.amp_vocr_dedupe, "frames") if args.dedupe else contextlib.nullcontext()) as dedupe_writer:
+		for (frame, duplicate) in dedupeVocrFrames(iterVocrFrames(results, frameRate), args.dup_gap):
+			writer.write(frame)
+			nframes += 1
+			if dedupe_writer and not duplicate:
+				dedupe_writer.write(frame)
+				ndeduped += 1
+	return (nframes, ndeduped)
+
+
 # Create AMP VOCR object from the given Azure indexer json and the OCR artifact json.
 def create_amp_vocr(input_video, azure_index_json, azure_ocr_json):
+	results = azure_ocr_json["Results"] if azure_ocr_json else []
+	frameRate = azure_ocr_json["Fps"] if azure_ocr_json else 0
+	vocr = create_amp_vocr_media(input_video, azure_index_json, frameRate, results[0] if results else None)
+	vocr.frames = createVocrFrames(results, frameRate)
+	return vocr
+
+
+# Create AMP VOCR object without frames from the given Azure indexer json, the frame rate
+# of the OCR artifact and the first artifact result.
+def create_amp_vocr_media(input_video, azure_index_json, frameRate, first_result):
 	# create the resolution object
 	# Recent versions of azure return the width/height for every frame.  
 	# Let"s assume that the data for the first image is indicative of the rest.
-	width = azure_ocr_json["Results"][0]["Ocr"]["pages"][0]["width"] if azure_ocr_json else 0
-	height = azure_ocr_json["Results"][0]["Ocr"]["pages"][0]["height"] if azure_ocr_json else 0
+	width = first_result["Ocr"]["pages"][0]["width"] if first_result else 0
+	height = first_result["Ocr"]["pages"][0]["height"] if first_result else 0
 	resolution = VideoOcrResolution(width, height)
 
 	# create the media object
-	frameRate = azure_ocr_json["Fps"] if azure_ocr_json else 0
 	duration = azure_index_json["summarizedInsights"]["duration"]["seconds"]
 	numFrames = int(frameRate * duration)
 	media  = VideoOcrMedia(input_video, duration, frameRate, numFrames, resolution)
@@ -64,31 +111,35 @@ def create_amp_vocr(input_video, azure_index_json, azure_ocr_json):
 	insights = azure_index_json["videos"][0]["insights"]
 	ocr_json = insights["ocr"] if insights and "ocr" in insights.keys() else None
 	texts = createVocrTexts(ocr_json) if ocr_json else []
-	
-	# Create AMP VOCR frames from Azure OCR artifact
-	# in case Azure Indexer didn't produce OCR artifact, generate empty frames
-	frames = createVocrFrames(azure_ocr_json["Results"], frameRate) if azure_ocr_json else []
 
-	vocr = VideoOcr(media, texts, frames)
-	return vocr
+	return VideoOcr(media, texts, [])
 
 
 # Create a list of AMP VOCR texts from the texts list in the given Azure indexer ocr insight json.
 def createVocrTexts(ocr_json):
-	# BDW: this function doesn't really do anything.
+	# the insight has an entry for each place a text appears; the texts list
+	# has each text and its language once, in order of first appearance.
+	# This is where the language lives, since the artifact doesn't give it
+	# for the words in the frames.
 	texts = []
+	seen = set()
 	for ocr in ocr_json:
-		for instance in ocr["instances"]:
-			text = None
+		key = (ocr["text"], ocr.get("language", ""))
+		if key not in seen:
+			seen.add(key)
+			texts.append({"text": key[0], "language": key[1]})
 	return texts
 
 
 # Create a list of AMP VOCR frames from the given Azure OCR artifact results json and the given frame rate.
 def createVocrFrames(results_json, fps):
-	frames = []
-	
+	return list(iterVocrFrames(results_json, fps))
+
+
+# Generate AMP VOCR frames from the given iterable of Azure OCR artifact results and the given frame rate.
+def iterVocrFrames(results, fps):
 	# for each result with text, generate an AMP VOCR frame
-	for result in results_json:
+	for result in results:
 		# skip this frame if there is no content (words/lines) in it
 		content = result["Ocr"]["content"]
 		if not content:
@@ -113,10 +164,18 @@ def createVocrFrames(results_json, fps):
 				object = VideoOcrObject(text, "", score, vertices)
 				objects.append(object)
 				
-		frame = VideoOcrFrame(start, content, objects)
-		frames.append(frame)
-	
-	return frames
+		yield VideoOcrFrame(start, content, objects)
+
+
+# Generate (frame, duplicate) for the given AMP VOCR frames, where a frame is a duplicate if
+# it is one of the last frame which was kept within dup_gap seconds, like VideoOcr.dedupe.
+def dedupeVocrFrames(frames, dup_gap):
+	kept = None
+	for frame in frames:
+		duplicate = kept is not None and kept.duplicate(frame, dup_gap)
+		if not duplicate:
+			kept = frame
+		yield (frame, duplicate)
 
 
 if __name__ == "__main__":
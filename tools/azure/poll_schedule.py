@@ -0,0 +1 @@
+../mgms/poll_schedule.py
\ No newline at end of file
@@ -14,6 +14,10 @@ sys.path.append(os.environ['AMP_ROOT'] + "/amp_bootstrap")
 import amp.logging
 from amp.fileutils import write_json_file, read_json_file
 
+# transcript_columns is shared with the MGMs: it is symlinked from ../mgms and
+# the Makefile installs a copy next to this script
+from transcript_columns import write_word_columns
+
 def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
@@ -129,8 +133,9 @@ def gentle_transcript_to_amp_transcript(gentle_transcript, amp_transcript_unalig
 	updated = update_confidence(words, uwords)
 	logging.info(f"Successfully updated confidence for {updated} words in AMP aligned transcript.")
 	
-	# write final amp_transcript_aligned_json to file
+	# write final amp_transcript_aligned_json to file, along with its word sidecar
 	write_json_file(amp_transcript_aligned_json, amp_transcript_aligned)
+	write_word_columns(amp_transcript_aligned, words)
 		
 		
 # Find the next success match in the given words list starting at the given current index, return the last and next match index,
@@ -0,0 +1 @@
+../mgms/json_stream.py
\ No newline at end of file
@@ -7,6 +7,10 @@ import logging
 from amp.fileutils import read_json_file, write_json_file, valid_file
 from amp.schema.speech_to_text import SpeechToText, SpeechToTextMedia, SpeechToTextResult, SpeechToTextWord, SpeechToTextScore
 
+# transcript_columns is shared with the MGMs: it is symlinked from ../mgms and
+# the Makefile installs a copy next to this script
+from transcript_columns import write_word_columns
+
 
 def main():
 	#(input_audio, kaldi_transcript_json, kaldi_transcript_text, amp_transcript) = sys.argv[1:5]
@@ -60,8 +64,9 @@ def convert(input_audio, kaldi_transcript_json, kaldi_transcript_text, amp_trans
 	# Create the final object
 	stt = SpeechToText(media, results)
 
-	#write the output
+	#write the output and its word sidecar
 	write_json_file(stt, amp_transcript)
+	write_word_columns(amp_transcript)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,12 @@
 #!/usr/bin/env amp_python.sif
 
 import argparse
-from amp.schema.speech_to_text import SpeechToText
 from amp.adjustment import Adjustment
 import logging
 import amp.logging
-from amp.fileutils import write_json_file, read_json_file
+from amp.fileutils import read_json_file
+from json_stream import read_json_without, write_json_stream
+from transcript_columns import WordColumnsBuilder, read_words
 
 
 def main():
@@ -21,8 +22,8 @@ def main():
     # Turn adjustment data into list of kept segments
     adj_data = read_json_file(args.adj_json)
 
-    # Turn stt json into objects
-    stt = SpeechToText().from_json(read_json_file(args.stt_json))
+    # Read everything but the words, which are streamed through the adjustment
+    stt = read_json_without(args.stt_json, "results.words")
     
     # List of adjustments (start, end, adjustment)
     offset_adj = []
@@ -45,24 +46,26 @@ def main():
         # Keep track of the last segment end
         last_end = end
     
-    # For each word, find the corresponding adjustment
-    for word in stt.results.words:
-        adjust_word(word, offset_adj)
-        
-    # Write the resulting json
-    write_json_file(stt, args.output_json)
+    # For each word, find the corresponding adjustment and write the resulting
+    # json, along with its word sidecar
+    columns = WordColumnsBuilder()
+    words = (adjust_word(word, offset_adj) for word in read_words(args.stt_json))
+    write_json_stream(stt, args.output_json, "results.words", columns.collect(words))
+    columns.save(args.output_json)
     logging.info("Finished.")
 
 def adjust_word(word, offset_adj):
-    logging.debug(f"WORD: {word.start} : {word.end}")
+    start = word.get("start")
+    logging.debug(f"WORD: {start} : {word.get('end')}")
     # Get the adjustment for which the word falls within it's start and end
     for adj in offset_adj:
-        if word.start is not None and word.start >= adj.start and word.start <= adj.end:
-            logging.debug("STT Offset:" + str(word.start) + " Adjusted Offset:" + str(word.start + adj.adjustment))
-            word.start = word.start + adj.adjustment
-            word.end = word.end + adj.adjustment
-            return
+        if start is not None and start >= adj.start and start <= adj.end:
+            logging.debug("STT Offset:" + str(start) + " Adjusted Offset:" + str(start + adj.adjustment))
+            word["start"] = start + adj.adjustment
+            word["end"] = word["end"] + adj.adjustment
+            return word
     logging.debug("No adjustment found")
+    return word
     
     
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+# Local record of batches of jobs which are submitted to a service together.
+#
+# Concurrent Galaxy jobs of an MGM join an open batch, and whichever job finds
+# the batch full (or its window passed) submits it.  The registry is a JSON
+# file of {'batches': {batchid: batch}, 'jobs': {jobid: batchid}} in the AMP
+# work directory.  Every change is made while holding its lock, and lookups
+# only share the lock and don't write the file back.
+
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from amp.config import get_work_dir
+
+
+class BatchRegistry:
+    "Local record of the batches of jobs which are submitted together"
+    def __init__(self, mgm, key):
+        self.file = Path(get_work_dir(mgm), f"batches-{key}.json")
+
+
+    @contextmanager
+    def locked(self):
+        """Hold the registry lock and yield its state, which is saved
+           afterward unless there was an exception"""
+        with open(str(self.file) + ".lock", "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            state = self.read_state()
+            yield state
+            tmpfile = self.file.with_name(f".{self.file.name}.{os.getpid()}")
+            tmpfile.write_text(json.dumps(state))
+            os.replace(tmpfile, self.file)
+
+
+    def read_state(self):
+        "Return the saved state, or an empty one if there isn't any"
+        try:
+            return json.loads(self.file.read_text())
+        except (OSError, ValueError):
+            return {'batches': {}, 'jobs': {}}
+
+
+    def batch_of(self, jobid):
+        """Return the id and record of the job's batch, or (None, None) if it
+           isn't in one.  This only shares the lock, so concurrent lookups
+           don't wait on each other."""
+        with open(str(self.file) + ".lock", "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_SH)
+            state = self.read_state()
+        batchid = state['jobs'].get(jobid)
+        return (batchid, state['batches'].get(batchid))
@@ -0,0 +1,97 @@
+# Transports for the work directory of MGMs which run jobs on a cluster.
+#
+# A transport has the operations of ssh_broker.RemoteSession:  file
+# operations on the work directory and running commands on the host that
+# holds it.  The "ssh" transport goes to the cluster's login node (through
+# the connection broker unless it is disabled) and the "local" transport
+# works on a local directory with local commands, which together with
+# whisper_spool.py lets the whole submit/poll/fetch cycle run on one machine.
+
+import os
+import shutil
+import subprocess
+
+from ssh_broker import connect_remote
+
+
+def open_transport(transport, host=None, user=None, broker=True):
+    "Return the named transport"
+    if transport == 'ssh':
+        return connect_remote(host, user, broker=broker)
+    elif transport == 'local':
+        return LocalSession()
+    raise ValueError(f"Unknown transport {transport}")
+
+
+class LocalSession:
+    "The RemoteSession operations on the local file system"
+    def call(self, op, *args):
+        return getattr(self, op)(*args)
+
+
+    def close(self):
+        pass
+
+
+    def stat(self, path):
+        s = os.stat(path)
+        return {'mode': s.st_mode, 'size': s.st_size, 'mtime': s.st_mtime}
+
+
+    def listdir(self, path):
+        results = []
+        for entry in os.scandir(path):
+            s = entry.stat(follow_symlinks=False)
+            results.append({'name': entry.name, 'mode': s.st_mode, 'size': s.st_size, 'mtime': s.st_mtime})
+        return results
+
+
+    def read(self, path, offset=0, size=-1):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+
+    def write(self, path, data, append=False):
+        with open(path, "ab" if append else "wb") as f:
+            f.write(data)
+
+
+    def put(self, local_path, path):
+        shutil.copyfile(local_path, path)
+
+
+    def resume_put(self, local_path, path):
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        with open(local_path, "rb") as src, open(path, "ab") as dst:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst)
+
+
+    def symlink(self, target, path):
+        os.symlink(target, path)
+
+
+    def utime(self, path):
+        os.utime(path)
+
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+
+    def unlink(self, path):
+        os.unlink(path)
+
+
+    def rename(self, path, new_path):
+        os.replace(path, new_path)
+
+
+    def run(self, command):
+        p = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL, capture_output=True)
+        return (p.returncode, p.stdout, p.stderr)
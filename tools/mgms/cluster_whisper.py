@@ -1,21 +1,89 @@
 #!/usr/bin/env amp_python.sif
 
 import argparse
-import paramiko
+import fcntl
+import hashlib
 import logging
 import getpass
+import os
+import shlex
+import subprocess
+import threading
+import time
 import uuid
+import wave
 from pathlib import Path
 import yaml
 from stat import S_ISDIR
-from amp.config import load_amp_config, get_config_value
+from amp.config import load_amp_config, get_config_value, get_work_dir
 import amp.logging
 from amp.lwlw import LWLW
 from amp.cloudutils import generate_persistent_name
-from amp.fileutils import read_json_file, write_json_file
+from amp.fileutils import write_json_file
 from amp.vtt_helper import gen_vtt, words2phrases
+from transcript_columns import write_word_columns
+from ssh_broker import RemoteError
+from cluster_transport import open_transport
+from json_stream import iter_json_members
+from poll_schedule import PollSchedule, media_duration
+from batch_registry import BatchRegistry
+from file_hash import file_sha256
 import json
-from tempfile import NamedTemporaryFile
+from tempfile import TemporaryDirectory
+
+# Remote helper which scans the whole work directory at once and prints the
+# whisper.job, results and failure markers of every job as JSON, so the status
+# of all of the waiting jobs costs one round trip instead of a stat per file
+# per job.
+STATUS_SCRIPT = '''
+import json, os, sys
+workdir = sys.argv[1]
+def text(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+jobs = {}
+for entry in os.scandir(workdir):
+    if entry.is_dir() and not entry.name.startswith('.'):
+        job = text(os.path.join(entry.path, 'whisper.job'))
+        if job is not None:
+            names = os.listdir(entry.path)
+            jobs[entry.name] = {'job': job, 'results': [n for n in names if n.endswith('.whisper.json')],
+                                'failed': [n for n in names if n.endswith('.whisper.failed')]}
+print(json.dumps({'jobinfo': text(os.path.join(workdir, 'jobinfo.yaml')), 'jobs': jobs}))
+'''
+
+# default number of seconds a work directory scan is reused
+DEFAULT_STATUS_TTL = 30
+
+# without any history, a job is expected to take a minute plus a tenth of
+# the audio duration
+EXPECTED_RATE = 0.1
+EXPECTED_OVERHEAD = 60
+
+# default limits on the size of a batch of jobs
+DEFAULT_BATCH_MAX_FILES = 20
+DEFAULT_BATCH_MAX_MINUTES = 240
+
+# Audio is converted before it is uploaded, since whisper resamples everything
+# to 16kHz mono anyway.  Each format is the extension and ffmpeg encoding
+# arguments, and "wav" uploads the input as it is.
+UPLOAD_FORMATS = {
+    'flac': ('.flac', ['-ac', '1', '-ar', '16000', '-c:a', 'flac']),
+    'opus': ('.opus', ['-ac', '1', '-ar', '16000', '-c:a', 'libopus', '-b:a', '32k']),
+    'wav': (None, None)
+}
+
+# size of the blocks the whisper result is downloaded in
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+# how many times an upload is resumed before giving up
+UPLOAD_ATTEMPTS = 3
+
+# default hours an uploaded file is kept for other jobs with the same audio
+DEFAULT_UPLOAD_RETENTION = 72
 
 class Cluster_Whisper(LWLW):
     def __init__(self, input_file, model="medium", language="en", prompt=None,
@@ -41,6 +109,14 @@ class Cluster_Whisper(LWLW):
         self.hpcworkdir = get_config_value(self.config, ['mgms', 'cluster_whisper', 'hpcworkdir'])
         self.hpcscript = get_config_value(self.config, ['mgms', 'cluster_whisper', 'hpcscript'])
         self.hpcsubmit = get_config_value(self.config, ['mgms', 'cluster_whisper', 'hpcsubmit'])
+        transport = get_config_value(self.config, ['mgms', 'cluster_whisper', 'transport'], 'ssh')
+        broker = get_config_value(self.config, ['mgms', 'cluster_whisper', 'connection_broker'], True)
+        self.status_ttl = get_config_value(self.config, ['mgms', 'cluster_whisper', 'status_ttl'], DEFAULT_STATUS_TTL)
+        self.batch_window = get_config_value(self.config, ['mgms', 'cluster_whisper', 'batch_window'], 0)
+        self.batch_max_files = get_config_value(self.config, ['mgms', 'cluster_whisper', 'batch_max_files'], DEFAULT_BATCH_MAX_FILES)
+        self.batch_max_minutes = get_config_value(self.config, ['mgms', 'cluster_whisper', 'batch_max_minutes'], DEFAULT_BATCH_MAX_MINUTES)
+        self.upload_format = get_config_value(self.config, ['mgms', 'cluster_whisper', 'upload_format'], 'flac')
+        self.upload_retention = get_config_value(self.config, ['mgms', 'cluster_whisper', 'upload_retention'], DEFAULT_UPLOAD_RETENTION)
 
         # generate a persistent job name
         self.jobid = generate_persistent_name('CLUSTER_WHISPER', self.input_file, 
@@ -48,20 +124,38 @@ class Cluster_Whisper(LWLW):
                                               self.transcript_text, self.transcript_json,
                                               self.amp_diarization)
 
-        # connect to the HPC cluster
-        self.ssh = paramiko.SSHClient()
-        self.ssh.load_system_host_keys()
-        self.ssh.connect(self.hpchost, username=self.hpcuser)
+        # connect to the HPC cluster.  With the broker, all of the waiting
+        # jobs share one connection instead of each making their own.  The
+        # local transport uses a local work directory and scheduler instead.
+        self.remote = open_transport(transport, self.hpchost, self.hpcuser, broker=broker)
+
+        # jobs which are (or were) part of a batch are tracked locally
+        self.batches = BatchRegistry('cluster_whisper', workdir_key(self.hpchost, self.hpcworkdir))
+        self.polls = PollSchedule('cluster_whisper', self.jobid, rate=EXPECTED_RATE, overhead=EXPECTED_OVERHEAD)
 
 
     def exists(self):
         """return information about job or None if it doesn't exist"""        
-        sftp = self.ssh.open_sftp()
-        if not valid_job(sftp, self.hpcworkdir, self.jobid):
-            return None
-        done, total = determine_job_status(sftp, self.hpcworkdir, self.jobid)    
-        hpcjobid = get_hpc_job_id(sftp, self.hpcworkdir)
-        stext = "FINISHED" if done == total else "IN_PROGRESS"
+        (batchid, batch) = self.batches.batch_of(self.jobid)
+        if batch is not None:
+            return self.batch_job_status(batchid, batch)
+
+        status = get_workdir_status(self.remote, self.hpchost, self.hpcworkdir, self.status_ttl)
+        if status is not None and self.jobid in status['jobs']:
+            done, total = status['jobs'][self.jobid]
+            failed = len(status.get('failed', {}).get(self.jobid, []))
+            hpcjobid = status['hpcjobid']
+        else:
+            # a scan from before this job was submitted won't have it, so
+            # look for it directly
+            if not valid_job(self.remote, self.hpcworkdir, self.jobid):
+                return None
+            done, failed, total = determine_job_status(self.remote, self.hpcworkdir, self.jobid)    
+            hpcjobid = get_hpc_job_id(self.remote, self.hpcworkdir)
+        if failed:
+            stext = "FAILED"
+        else:
+            stext = "FINISHED" if done == total else "IN_PROGRESS"
         return {
             'status': stext,
             'done': done,
@@ -70,103 +164,288 @@ class Cluster_Whisper(LWLW):
         }
 
 
+    def batch_job_status(self, batchid, batch):
+        "return information about a job in a batch"
+        job = {'status': "IN_PROGRESS", 'done': 0, 'total': 1, 'hpcjobid': None, 'batch': batchid}
+        if batch['failed']:
+            job['status'] = "FAILED"
+        elif not batch['submitted']:
+            job['status'] = "QUEUED"
+        else:
+            name = batch['files'][self.jobid]
+            status = get_workdir_status(self.remote, self.hpchost, self.hpcworkdir, self.status_ttl)
+            if status is not None:
+                job['done'] = int(f"{name}.whisper.json" in status.get('results', {}).get(batchid, []))
+                failed = f"{name}.whisper.failed" in status.get('failed', {}).get(batchid, [])
+                job['hpcjobid'] = status['hpcjobid']
+            else:
+                job['done'] = int(remote_exists(self.remote, f"{self.hpcworkdir}/{batchid}/{name}.whisper.json"))
+                failed = remote_exists(self.remote, f"{self.hpcworkdir}/{batchid}/{name}.whisper.failed")
+            if failed:
+                job['status'] = "FAILED"
+            elif job['done']:
+                job['status'] = "FINISHED"
+        return job
+
+
     def submit(self):
         "Upload the audio file to S3 and submit the transcription job"
+        if self.batch_window > 0:
+            return self.submit_batched()
      
-        sftp = self.ssh.open_sftp()
-        sftp.chdir(self.hpcworkdir)    
-        
         # create the job directory in the hpc workspace...
         jobname = self.jobid
-        sftp.mkdir(jobname)
-        sftp.chdir(jobname)
+        jobdir = f"{self.hpcworkdir}/{jobname}"
+        self.remote.mkdir(jobdir)
         logging.info(f"Created job directory {jobname}")
 
+        # copy the individual files to the job directory
+        name = self.link_audio(jobdir, Path(self.input_file).stem, self.stage_audio())
+
+        if self.submit_job(jobdir, [name], self.model, self.language, self.prompt):
+            self.polls.start(media_duration(self.input_file))
+            return LWLW.WAIT
+        self.cleanup()
+        return LWLW.ERROR
+
+
+    def submit_batched(self):
+        """Add the audio file to an open batch of jobs with the same parameters,
+           so the whisper model is only loaded once for all of them.  The batch
+           is submitted when it is full or its window has passed."""
+        f = Path(self.input_file)
+        duration = audio_duration(f)
+        key = [self.model, self.language, self.prompt]
+        # the upload can take a while, so it is done before the batch registry
+        # is locked, leaving only the link to the batch directory for later
+        stored = self.stage_audio()
+        with self.batches.locked() as state:
+            batchid = self.find_open_batch(state, key, duration)
+            if batchid is None:
+                batchid = f"BATCH-{uuid.uuid4()}"
+                self.remote.mkdir(f"{self.hpcworkdir}/{batchid}")
+                logging.info(f"Created batch directory {batchid}")
+                state['batches'][batchid] = {'key': key, 'opened': time.time(), 'files': {}, 
+                                             'duration': 0, 'submitted': False, 'failed': False}
+            batch = state['batches'][batchid]
+
+            # the job id keeps the names of files from different jobs apart
+            logging.info(f"Adding {f} to batch {batchid}")
+            name = self.link_audio(f"{self.hpcworkdir}/{batchid}", f"{self.jobid}-{f.stem}", stored)
+            batch['files'][self.jobid] = name
+            batch['duration'] += duration
+            state['jobs'][self.jobid] = batchid
+
+            if self.batch_is_full(batch):
+                self.submit_batch(batchid, batch)
+            return LWLW.ERROR if batch['failed'] else LWLW.WAIT
+
+
+    def find_open_batch(self, state, key, duration):
+        "Return the id of an unsubmitted batch which the job can join, or None"
+        for batchid, batch in state['batches'].items():
+            if (batch['key'] == key and not batch['submitted']
+                and time.time() - batch['opened'] < self.batch_window
+                and not self.batch_is_full(batch)
+                and (not self.batch_max_minutes or batch['duration'] + duration <= self.batch_max_minutes * 60)):
+                return batchid
+        return None
+
+
+    def batch_is_full(self, batch):
+        return (len(batch['files']) >= self.batch_max_files
+                or (self.batch_max_minutes and batch['duration'] >= self.batch_max_minutes * 60))
+
+
+    def submit_batch(self, batchid, batch):
+        "Submit all of the files in the batch as one job"
+        (model, language, prompt) = batch['key']
+        logging.info(f"Submitting batch {batchid} with {len(batch['files'])} files")
+        ok = self.submit_job(f"{self.hpcworkdir}/{batchid}", sorted(batch['files'].values()), model, language, prompt)
+        batch['submitted'] = True
+        batch['failed'] = not ok
+        if ok:
+            # the files are transcribed one after another, so every job in
+            # the batch is expected to take as long as the whole batch
+            for jobid in batch['files']:
+                self.polls.for_job(jobid).start(batch['duration'])
+
+
+    def submit_due_batch(self):
+        "Submit the job's batch if its window has passed, returning whether it failed"
+        with self.batches.locked() as state:
+            batchid = state['jobs'][self.jobid]
+            batch = state['batches'][batchid]
+            if not batch['submitted'] and time.time() - batch['opened'] >= self.batch_window:
+                self.submit_batch(batchid, batch)
+            return batch['failed']
+
+
+    def stage_audio(self):
+        """Convert and upload the input audio to the shared .uploads directory,
+           keyed by its content, unless it is already there, and return the
+           name it is stored as"""
+        f = Path(self.input_file)
+        (ext, codec) = UPLOAD_FORMATS[self.upload_format]
+        ext = ext or f.suffix
+        stored = f"{file_sha256(f)}{ext}"
+        uploads = f"{self.hpcworkdir}/.uploads"
+        try:
+            self.remote.stat(f"{uploads}/{stored}")
+            logging.info(f"{f} has already been uploaded as {stored}")
+            # keep it from being removed while this job uses it
+            self.remote.utime(f"{uploads}/{stored}")
+        except FileNotFoundError:
+            try:
+                self.remote.mkdir(uploads)
+            except (OSError, RemoteError):
+                # another job may have just created it (the broker doesn't
+                # report that as an OSError), anything else is a real failure
+                if not remote_exists(self.remote, uploads):
+                    raise
+            with TemporaryDirectory() as tmpdir:
+                audio = f
+                if codec:
+                    audio = Path(tmpdir, f"audio{ext}")
+                    logging.info(f"Converting {f} to {self.upload_format}")
+                    subprocess.run(['ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-i', str(f), '-vn', *codec, str(audio)],
+                                   check=True)
+                logging.info(f"Uploading {f} as {stored}")
+                self.resume_upload(audio, f"{uploads}/{stored}")
+        return stored
+
+
+    def link_audio(self, jobdir, name, stored):
+        """Link the staged audio into the job directory as name (plus the
+           extension of the upload format), and return the file name"""
+        ext = Path(stored).suffix
+        self.remote.symlink(f"../.uploads/{stored}", f"{jobdir}/{name}{ext}")
+        return f"{name}{ext}"
+
+
+    def resume_upload(self, local_file, remote_file):
+        """Upload a file to a partial file next to remote_file, resuming from
+           wherever an earlier attempt stopped, and move it into place once its
+           checksum matches.  The partial file belongs to this job, so jobs
+           uploading the same audio at once don't write into each other's."""
+        partial = f"{remote_file}.{self.jobid}.part"
+        checksum = file_sha256(local_file)
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            try:
+                self.remote.resume_put(str(local_file), partial)
+            except (OSError, RemoteError) as e:
+                logging.warning(f"Upload attempt {attempt} of {local_file} failed: {e}")
+                continue
+            (rc, stdout, _) = self.remote.run(f"sha256sum {shlex.quote(partial)}")
+            if rc == 0 and str(stdout, encoding='utf-8').split()[0] == checksum:
+                self.remote.rename(partial, remote_file)
+                return
+            # a partial file from a different conversion can't be resumed
+            logging.warning(f"Checksum of {partial} doesn't match, uploading it again")
+            self.remote.unlink(partial)
+        raise Exception(f"Cannot upload {local_file} after {UPLOAD_ATTEMPTS} attempts")
+
+
+    def prune_uploads(self):
+        "Remove uploaded audio which no job has used for the retention period"
+        uploads = f"{self.hpcworkdir}/.uploads"
+        try:
+            for item in self.remote.listdir(uploads):
+                if time.time() - item['mtime'] > self.upload_retention * 3600:
+                    logging.debug(f"Removing old upload {item['name']}")
+                    self.remote.unlink(f"{uploads}/{item['name']}")
+        except OSError as e:
+            logging.debug(f"Cannot prune uploads: {e}")
+
+
+    def submit_job(self, jobdir, manifest, model, language, prompt):
+        "Write the whisper.job for the files in the job directory and submit it, returning whether it worked"
         # copy the submit script to the queue if it isn't already there...
         try:
-            sftp.stat(self.hpcworkdir + "/.submit")
+            self.remote.stat(self.hpcworkdir + "/.submit")
         except:
             # if we get here then .submit doesn't exist...
             logging.info("Copying .submit script")
-            with sftp.open(self.hpcworkdir + "/.submit", "w") as f:
-                f.write(sftp.open(self.hpcsubmit).read())
-
+            self.remote.write(self.hpcworkdir + "/.submit", self.remote.read(self.hpcsubmit))
 
-        # copy the individual files to the job directory
         config = {
-            'manifest': [],
-            'language': self.language,
-            'prompt': self.prompt,
-            'model': self.model
+            'manifest': manifest,
+            'language': language,
+            'prompt': prompt,
+            'model': model
         }        
-        
-        f = Path(self.input_file)
-        logging.info(f"Uploading {f}")
-        sftp.put(str(f.resolve()), f.name)
-        config['manifest'].append(f.name)
 
         logging.info("Creating job file")
         # write the whisper.job parameters file.
-        file = sftp.file('whisper.job', 'w', -1)
-        yaml.safe_dump(config, file)
+        self.remote.write(f"{jobdir}/whisper.job", yaml.safe_dump(config).encode('utf-8'))
 
         # tell the system we've got something new to do
         logging.info("Submitting the job to HPC")        
         command = f'bash -c "{self.hpcscript} {self.hpcworkdir}; echo \\$?"'
         logging.debug(f"Submit command: {command}")
-        (_, stdout, stderr) = self.ssh.exec_command(command)
+        (_, stdout, stderr) = self.remote.run(command)
+        stderr = str(stderr, encoding='utf-8', errors='replace')
         # the last line of stdout should be the return code from the command.
-        sout = [x.strip() for x in stdout.readlines()]
+        sout = [x.strip() for x in str(stdout, encoding='utf-8', errors='replace').splitlines()]
         if not sout or sout[-1] != '0':
-            logging.error("Submission to HPC failed:\n" + "".join(stderr.readlines())) 
-            self.cleanup()
-            return LWLW.ERROR
+            logging.error("Submission to HPC failed:\n" + stderr) 
+            return False
         else:
-            logging.debug("Submission stdout:\n" + '\n'.join(sout) + "\nstderr:\n" + "".join(stderr.readlines()))
-            return LWLW.WAIT
+            logging.debug("Submission stdout:\n" + '\n'.join(sout) + "\nstderr:\n" + stderr)
+            return True
 
 
     def check(self):
+        "Check on the status of the running job when a poll is due"
+        return self.polls.poll(self.check_job, ready=self.finished_in_scan)
+
+
+    def finished_in_scan(self):
+        """Return whether the status scan shows that this job is finished or
+           failed.  The scan is shared by all of the waiting jobs, so this
+           costs at most one round trip per status_ttl for all of them."""
+        status = get_workdir_status(self.remote, self.hpchost, self.hpcworkdir, self.status_ttl)
+        if status is None:
+            return False
+        (batchid, batch) = self.batches.batch_of(self.jobid)
+        if batch is not None:
+            name = batch['files'][self.jobid]
+            return (f"{name}.whisper.json" in status.get('results', {}).get(batchid, [])
+                    or f"{name}.whisper.failed" in status.get('failed', {}).get(batchid, []))
+        (done, total) = status['jobs'].get(self.jobid, (0, 1))
+        return done == total or bool(status.get('failed', {}).get(self.jobid))
+
+
+    def check_job(self):
         "Check on the status of the running job"
         job = self.exists()
         if job is None:
-            logging.error(f"The job {self.job_name} should exist but it doesn't!")
+            logging.error(f"The job {self.jobid} should exist but it doesn't!")
             return LWLW.ERROR
         status = job['status']
-        if status == 'IN_PROGRESS':
+        if status == 'QUEUED':
+            return LWLW.ERROR if self.submit_due_batch() else LWLW.WAIT
+        elif status == 'IN_PROGRESS':
             return LWLW.WAIT
+        elif status == 'FAILED':
+            self.log_failure(job)
+            return LWLW.ERROR
         elif status == "FINISHED":
             # retrieve the result file and put it where it belongs locally
             jobinfo = None
             try:
-                sftp = self.ssh.open_sftp()
-                jobinfo = yaml.safe_load(sftp.open(f"{self.hpcworkdir}/{self.jobid}/whisper.job").read())
-                # get the whisper output...
-                whisper_transcript_raw = sftp.open(f"{self.hpcworkdir}/{self.jobid}/{jobinfo['manifest'][0]}.whisper.json").read()
-                whisper_transcript = json.loads(str(whisper_transcript_raw, encoding='utf-8'))
-
-                if self.transcript_json:
-                    with open(self.transcript_json, "wb") as f:
-                        f.write(whisper_transcript_raw)
-
-                if self.transcript_text:
-                    with open(self.transcript_text, "w") as f:
-                        f.write(whisper_transcript['text'])
-
-                # the rest of the bits require a whisper json file on disk
-                with NamedTemporaryFile() as tf:
-                    tf.write(whisper_transcript_raw)
-                    tf.flush()
-                
-                    if self.web_vtt:
-                        generate_webvtt(tf.name, self.web_vtt, self.vtt_phrase_gap, self.vtt_max_duration)
-
-                    if self.amp_transcript:
-                        generate_amp_transcript(tf.name, self.amp_transcript, self.input_file)
-
-                    if self.amp_diarization:
-                        generate_amp_diarization(tf.name, self.amp_diarization, self.input_file)
-
+                if 'batch' in job:
+                    name = self.batches.batch_of(self.jobid)[1]['files'][self.jobid]
+                    result_file = f"{self.hpcworkdir}/{job['batch']}/{name}.whisper.json"
+                else:
+                    jobinfo = yaml.safe_load(self.remote.read(f"{self.hpcworkdir}/{self.jobid}/whisper.job"))
+                    result_file = f"{self.hpcworkdir}/{self.jobid}/{jobinfo['manifest'][0]}.whisper.json"
+                # get the whisper output, converting it as it arrives
+                outputs = WhisperOutputs(self.input_file, web_vtt=self.web_vtt, amp_transcript=self.amp_transcript,
+                                         transcript_text=self.transcript_text, amp_diarization=self.amp_diarization,
+                                         phrase_gap=self.vtt_phrase_gap, max_duration=self.vtt_max_duration)
+                text = self.fetch_result(result_file, outputs)
+                outputs.write(text)
                 return LWLW.OK
             except Exception as e:
                 logging.error(f"jobinfo: {jobinfo}, jobid: {self.jobid}, workdir: {self.hpcworkdir}")
@@ -176,26 +455,111 @@ class Cluster_Whisper(LWLW):
             return LWLW.ERROR
 
 
+    def log_failure(self, job):
+        "Log why the job failed, with the error the cluster left in the .whisper.failed file if there is one"
+        try:
+            if 'batch' in job:
+                batch = self.batches.batch_of(self.jobid)[1]
+                if batch['failed']:
+                    logging.error(f"The batch {job['batch']} of job {self.jobid} could not be submitted")
+                    return
+                jobdir = f"{self.hpcworkdir}/{job['batch']}"
+                names = [batch['files'][self.jobid]]
+            else:
+                jobdir = f"{self.hpcworkdir}/{self.jobid}"
+                names = yaml.safe_load(self.remote.read(f"{jobdir}/whisper.job"))['manifest']
+            for name in names:
+                if remote_exists(self.remote, f"{jobdir}/{name}.whisper.failed"):
+                    error = str(self.remote.read(f"{jobdir}/{name}.whisper.failed"), encoding='utf-8', errors='replace')
+                    logging.error(f"Whisper failed to transcribe {name} for job {self.jobid}: {error}")
+        except Exception as e:
+            logging.error(f"The job {self.jobid} failed, and the reason can't be read: {e}")
+
+
+    def fetch_result(self, result_file, outputs):
+        """Download the whisper result file (to transcript_json if it is
+           wanted) and parse it as it is downloaded, adding its segments to
+           the outputs.  Returns the text of the transcript."""
+        info = self.remote.stat(result_file)
+        size = info['size']
+        # the result was finished when it was written, not when it was polled
+        self.polls.completed(info['mtime'])
+        (pipe_read, pipe_write) = os.pipe()
+        download_error = []
+
+        def download():
+            try:
+                with open(pipe_write, "wb") as pipe, open(self.transcript_json or os.devnull, "wb") as copy:
+                    offset = 0
+                    while offset < size:
+                        data = self.remote.read(result_file, offset, DOWNLOAD_BLOCK_SIZE)
+                        if not data:
+                            break
+                        pipe.write(data)
+                        copy.write(data)
+                        offset += len(data)
+            except Exception as e:
+                download_error.append(e)
+
+        downloader = threading.Thread(target=download)
+        downloader.start()
+        text = None
+        try:
+            with open(pipe_read, encoding='utf-8') as f:
+                for key, value in iter_json_members(f):
+                    if key == 'text':
+                        text = value
+                    elif key == 'segments':
+                        for seg in value:
+                            outputs.add_segment(seg)
+                # let the download finish copying the file
+                f.read()
+        finally:
+            # closing the pipe stops the download if parsing failed
+            downloader.join()
+        if download_error:
+            raise download_error[0]
+        if text is None:
+            raise ValueError(f"No text in {result_file}")
+        return text
+
+
     def cleanup(self):
         "Remove the job and generatd data"
-        sftp = self.ssh.open_sftp()
-        if not valid_job(sftp, self.hpcworkdir, self.jobid):
+        # only a job in a batch needs to change the registry
+        if self.batches.batch_of(self.jobid)[0] is None:
+            return self.cleanup_job()
+        with self.batches.locked() as state:
+            batchid = state['jobs'].get(self.jobid)
+            if batchid is not None:
+                # only remove this job's files unless it's the last one in the batch
+                batch = state['batches'][batchid]
+                name = batch['files'].pop(self.jobid)
+                batchdir = f"{self.hpcworkdir}/{batchid}"
+                if batch['files']:
+                    logging.warning(f"Purging {name} files from batch directory {batchdir}")
+                    for item in self.remote.listdir(batchdir):
+                        if item['name'].startswith(name):
+                            self.remote.unlink(f"{batchdir}/{item['name']}")
+                else:
+                    logging.warning(f"Purging batch directory at {batchdir}")
+                    remove_tree(self.remote, batchdir)
+                    del state['batches'][batchid]
+                del state['jobs'][self.jobid]
+                self.prune_uploads()
+                return
+        self.cleanup_job()
+
+
+    def cleanup_job(self):
+        "Remove the directory of a job which isn't in a batch"
+        if not valid_job(self.remote, self.hpcworkdir, self.jobid):
             logging.error(f"Cannot purge job: Jobid {self.jobid} is not valid")
             return
         jobdir = f"{self.hpcworkdir}/{self.jobid}"
         logging.warning(f"Purging job directory at {jobdir}")
-        file_list = recursive_list(sftp, jobdir)
-        for f in file_list:
-            if f.endswith("/"):
-                logging.debug(f"RMDIR: {f}")
-                sftp.rmdir(f)
-            else:
-                logging.debug(f"UNLINK: {f}")
-                sftp.unlink(f)
-        # remove the job directory
-        logging.debug(f"UNLINK {jobdir}")
-        sftp.rmdir(jobdir)
-
+        remove_tree(self.remote, jobdir)
+        self.prune_uploads()
 
 
 def main():
@@ -234,17 +598,17 @@ def main():
 
 
 
-def valid_job(sftp: paramiko.SFTPClient, workdir, jobid):
+def valid_job(remote, workdir, jobid):
     "return true or false if the jobid is valid"
     try:
         # make sure the job directory exists
         jobdir = f"{workdir}/{jobid}"
-        s = sftp.stat(jobdir)
-        if not S_ISDIR(s.st_mode):
+        s = remote.stat(jobdir)
+        if not S_ISDIR(s['mode']):
             logging.debug(f"{jobdir} isn't a directory")
             return False
         # make sure we have a whisper.job file
-        s = sftp.stat(f"{jobdir}/whisper.job")
+        s = remote.stat(f"{jobdir}/whisper.job")
         return True
     except Exception as e:
         logging.debug(f"Couldn't check for valid job: {e}")
@@ -252,147 +616,251 @@ def valid_job(sftp: paramiko.SFTPClient, workdir, jobid):
     
 
 
-def recursive_list(sftp, path):
+def remove_tree(remote, path):
+    "Remove the remote directory and everything in it"
+    file_list = recursive_list(remote, path)
+    for f in file_list:
+        if f.endswith("/"):
+            logging.debug(f"RMDIR: {f}")
+            remote.rmdir(f)
+        else:
+            logging.debug(f"UNLINK: {f}")
+            remote.unlink(f)
+    # remove the job directory
+    logging.debug(f"UNLINK {path}")
+    remote.rmdir(path)
+
+
+def recursive_list(remote, path):
     """Return a list of all of the (file) paths rooted at the given path"""
     results = []
     logging.debug(f"Scanning {path}")    
-    for item in sftp.listdir_attr(path):        
-        if S_ISDIR(item.st_mode):
-            results.extend(recursive_list(sftp, f"{path}/{item.filename}"))            
-            results.append(f"{path}/")
+    for item in remote.listdir(path):        
+        if S_ISDIR(item['mode']):
+            results.extend(recursive_list(remote, f"{path}/{item['name']}"))            
+            results.append(f"{path}/{item['name']}/")
         else:                
-            results.append(f"{path}/{item.filename}")
+            results.append(f"{path}/{item['name']}")
     return results
 
 
-def determine_job_status(sftp, hpcworkdir, jobid):
-    "read the whisper.job file to get the manifest and determine status"
-    job = yaml.safe_load(sftp.open(f"{hpcworkdir}/{jobid}/whisper.job").read())    
+def determine_job_status(remote, hpcworkdir, jobid):
+    "read the whisper.job file to get the manifest and determine status as (done, failed, total)"
+    job = yaml.safe_load(remote.read(f"{hpcworkdir}/{jobid}/whisper.job"))    
     done = 0
+    failed = 0
     for n in job['manifest']:
-        try:
-            sftp.stat(f"{hpcworkdir}/{jobid}/{n}.whisper.json")
+        if remote_exists(remote, f"{hpcworkdir}/{jobid}/{n}.whisper.json"):
             done += 1
-        except:
-            pass
-    return done, len(job['manifest'])
+        elif remote_exists(remote, f"{hpcworkdir}/{jobid}/{n}.whisper.failed"):
+            failed += 1
+    return done, failed, len(job['manifest'])
 
 
-def get_hpc_job_id(sftp, hpcworkdir):
-    "Get the HPC job id"
+def remote_exists(remote, path):
+    "Return whether the remote file exists"
     try:
-        job = yaml.safe_load(sftp.open(f"{hpcworkdir}/jobinfo.yaml").read())
-        return job['jobid']
-    except Exception:        
+        remote.stat(path)
+        return True
+    except (OSError, RemoteError):
+        return False
+
+
+def get_workdir_status(remote, hpchost, hpcworkdir, ttl):
+    """Return the status of every job in the work directory as a dict with
+       the hpcjobid, a dict of jobs to (done, total), and dicts of jobs to
+       their result and failure marker files.  All of the waiting
+       jobs on this host share a scan for ttl seconds.  Returns None if the
+       work directory can't be scanned."""
+    cache_file = status_cache_file(hpchost, hpcworkdir)
+    # whoever gets the lock first refreshes the scan, and the rest use it
+    with open(str(cache_file) + ".lock", "w") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            cache = json.loads(cache_file.read_text())
+            if time.time() - cache['time'] < ttl:
+                return cache['status']
+        except (OSError, ValueError, KeyError):
+            pass
+        status = scan_workdir(remote, hpcworkdir)
+        if status is not None:
+            tmpfile = cache_file.with_name(f".{cache_file.name}.{os.getpid()}")
+            tmpfile.write_text(json.dumps({'time': time.time(), 'status': status}))
+            os.replace(tmpfile, cache_file)
+        return status
+
+
+def status_cache_file(hpchost, hpcworkdir):
+    return Path(get_work_dir("cluster_whisper"), f"status-{workdir_key(hpchost, hpcworkdir)}.json")
+
+
+def scan_workdir(remote, hpcworkdir):
+    "Scan the work directory with the remote helper and return the status of all of the jobs"
+    (rc, stdout, stderr) = remote.run(f"python3 -c {shlex.quote(STATUS_SCRIPT)} {shlex.quote(hpcworkdir)}")
+    if rc != 0:
+        logging.warning(f"Cannot scan {hpcworkdir}: {str(stderr, encoding='utf-8', errors='replace')}")
         return None
+    scan = json.loads(stdout)
+    status = {'hpcjobid': None, 'jobs': {}, 'results': {}, 'failed': {}}
+    try:
+        status['hpcjobid'] = yaml.safe_load(scan['jobinfo'])['jobid']
+    except Exception:
+        pass
+    for jobid, job in scan['jobs'].items():
+        try:
+            manifest = yaml.safe_load(job['job'])['manifest']
+        except Exception:
+            logging.debug(f"Skipping job {jobid} with a bad whisper.job")
+            continue
+        done = len([n for n in manifest if f"{n}.whisper.json" in job['results']])
+        status['jobs'][jobid] = (done, len(manifest))
+        status['results'][jobid] = job['results']
+        status['failed'][jobid] = job['failed']
+    return status
 
 
-# these functions are shamelessly stolen from our whisper mgm
+def workdir_key(hpchost, hpcworkdir):
+    "Return a short key for the local files about a remote work directory"
+    return hashlib.sha256(f"{hpchost}:{hpcworkdir}".encode('utf-8')).hexdigest()[:16]
 
 
+def audio_duration(audio_file):
+    "Return the duration of a wav file in seconds, or 0 if it can't be read"
+    try:
+        with wave.open(str(audio_file)) as w:
+            return w.getnframes() / w.getframerate()
+    except Exception:
+        return 0
 
-def generate_webvtt(whisper_json, output_vtt, phrase_gap, max_duration):
-    "Generate a VTT without underlines and with reasonable timestamps"
-    # original version parsed the output VTT, but it makes more sense to
-    # just use the json that was generated and generate it fresh.    
-    data = read_json_file(whisper_json)
-    # the output of whisper's cli puts all of the words into their segments
-    # but we need a single word list for words2phrases
-    words = []
-    for s in data['segments']:
-        words.extend(s['words'])
 
-    # also, for some reason whisper likes to prepend spaces to the words so
-    # let's strip that too
-    for w in words:
-        w['word'] = w['word'].strip()
+def get_hpc_job_id(remote, hpcworkdir):
+    "Get the HPC job id"
+    try:
+        job = yaml.safe_load(remote.read(f"{hpcworkdir}/jobinfo.yaml"))
+        return job['jobid']
+    except Exception:        
+        return None
 
-    phrases = words2phrases(words, phrase_gap=phrase_gap, 
-                            max_duration=max_duration)
-    
-    with open(output_vtt, "w") as o:
-        o.write(gen_vtt(phrases))
-
-
-def generate_amp_transcript(whisper_file, amp_file, input_media):
-    # convert the native json transcript to an amp transcript
-    data = read_json_file(whisper_file)
-    amp_transcript = {
-        'media': {
-            'filename': input_media,
-            'duration': 0
-        },
-        'results': {
-            'transcript': data['text'].strip(),
-            'words': []
-        }
-    }                
-    duration = 0
-    offset = 0
-    for seg in data['segments']:
+
+# these functions are shamelessly stolen from our whisper mgm, and build all
+# of the outputs in a single pass over the whisper segments.
+
+class WhisperOutputs:
+    "Convert the segments of a whisper result to the requested output files"
+    def __init__(self, input_media, web_vtt=None, amp_transcript=None, transcript_text=None,
+                 amp_diarization=None, phrase_gap=1.5, max_duration=3):
+        self.input_media = input_media
+        self.web_vtt = web_vtt
+        self.amp_transcript = amp_transcript
+        self.transcript_text = transcript_text
+        self.amp_diarization = amp_diarization
+        self.phrase_gap = phrase_gap
+        self.max_duration = max_duration
+        # words for words2phrases, and the amp transcript words
+        self.vtt_words = []
+        self.amp_words = []
+        self.offset = 0
+        self.duration = 0
+        # diarization segments, and the one being built
+        self.segments = []
+        self.seg_start = None
+        self.seg_end = None
+
+
+    def add_segment(self, seg):
+        "Add a whisper segment to the outputs"
         for word in seg['words']:
+            # whisper prepends a space to every word
             xword = word['word'][1:]
-            amp_transcript['results']['words'].append({
+            self.amp_words.append({
                 'type': "pronunciation",
                 'text': xword,
                 'start': word['start'],
                 'end': word['end'],
-                'offset': offset
-            })                        
-            tword = amp_transcript['results']['transcript'][offset:offset + len(xword)]
-            if tword != xword:
-                logging.warning(f"Transcript mismatch @{offset}: word='{xword}', transcript='{tword}'")
-            else:
-                logging.debug(f"Transcript correct: @{offset}: word={xword}, transcript={tword}")
-            offset += len(word['word'])
-            duration = max(duration, word['end'])
-    
-    amp_transcript['results']['duration'] = duration 
-    amp_transcript['media']['duration'] = duration
-    write_json_file(amp_transcript, amp_file)
-
-
-def generate_amp_diarization(whisper_json, amp_diarization, input_media):
-    "Generate an amp diarization file from the input"
-    d = {
-        'media': {'filename': input_media,
-                  'duration': 0},
-        'numSpeakers': 1,
-        'segments': []
-    }
-
-    data = read_json_file(whisper_json)
-    seg_start, seg_end = None, None
-    for seg in data['segments']:
-        if seg_start is None:
+                'offset': self.offset
+            })
+            self.offset += len(word['word'])
+            self.duration = max(self.duration, word['end'])
+            self.vtt_words.append(dict(word, word=word['word'].strip()))
+
+        if self.seg_start is None:
             # new diarization segment
-            seg_start = seg['start']
-            seg_end = seg['end']
-        elif int(seg_end * 10) == int(seg['start'] * 10):
+            self.seg_start = seg['start']
+            self.seg_end = seg['end']
+        elif int(self.seg_end * 10) == int(seg['start'] * 10):
             # within 1/10th second we're the same, so continuation
-            seg_end = seg['end']
+            self.seg_end = seg['end']
         else:
             # there's a gap, so so write this one and start a new one
-            d['segments'].append({'label': None,
-                                  'start': seg_start,
-                                  'end': seg_end,
+            self.segments.append({'label': None,
+                                  'start': self.seg_start,
+                                  'end': self.seg_end,
                                   'speakerLabel': 'spk_0'})
-            seg_start = seg['start']
-            seg_end = seg['end']
-
-    if seg_start is not None:
-        d['segments'].append({'label': None,
-                              'start': seg_start,
-                              'end': seg['end'],
-                              'speakerLabel': 'spk_0'})
-
-    d['media']['duration'] = seg_end
-
-    write_json_file(d, amp_diarization)
-
-
-
-
+            self.seg_start = seg['start']
+            self.seg_end = seg['end']
+
+
+    def write(self, text):
+        "Write the outputs once all of the segments have been added"
+        if self.transcript_text:
+            with open(self.transcript_text, "w") as f:
+                f.write(text)
+        if self.web_vtt:
+            self.write_webvtt()
+        if self.amp_transcript:
+            self.write_amp_transcript(text)
+        if self.amp_diarization:
+            self.write_amp_diarization()
+
+
+    def write_webvtt(self):
+        "Generate a VTT without underlines and with reasonable timestamps"
+        # original version parsed the output VTT, but it makes more sense to
+        # just use the json that was generated and generate it fresh.    
+        phrases = words2phrases(self.vtt_words, phrase_gap=self.phrase_gap, 
+                                max_duration=self.max_duration)
+        with open(self.web_vtt, "w") as o:
+            o.write(gen_vtt(phrases))
+
+
+    def write_amp_transcript(self, text):
+        # convert the native json transcript to an amp transcript
+        transcript = text.strip()
+        for word in self.amp_words:
+            offset = word['offset']
+            tword = transcript[offset:offset + len(word['text'])]
+            if tword != word['text']:
+                logging.warning(f"Transcript mismatch @{offset}: word='{word['text']}', transcript='{tword}'")
+        amp_transcript = {
+            'media': {
+                'filename': self.input_media,
+                'duration': self.duration
+            },
+            'results': {
+                'transcript': transcript,
+                'words': self.amp_words,
+                'duration': self.duration
+            }
+        }
+        write_json_file(amp_transcript, self.amp_transcript)
+        write_word_columns(self.amp_transcript, self.amp_words)
+
+
+    def write_amp_diarization(self):
+        "Generate an amp diarization file from the input"
+        segments = list(self.segments)
+        if self.seg_start is not None:
+            segments.append({'label': None,
+                             'start': self.seg_start,
+                             'end': self.seg_end,
+                             'speakerLabel': 'spk_0'})
+        d = {
+            'media': {'filename': self.input_media,
+                      'duration': self.seg_end},
+            'numSpeakers': 1,
+            'segments': segments
+        }
+        write_json_file(d, self.amp_diarization)
 
 
 if __name__ == "__main__":
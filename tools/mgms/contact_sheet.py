@@ -4,7 +4,7 @@ import argparse
 import logging
 
 import amp.logging
-from amp.schema.contact_sheet import ContactSheet
+from thumbnail_cache import create_contact_sheet
 from amp.fileutils import read_json_file
 
 def main():
@@ -21,7 +21,7 @@ def main():
     args = parser.parse_args()
     amp.logging.setup_logging("contact_sheet", args.debug)
     logging.info(f"Starting with args {args}")
-    sheet = ContactSheet(args.input_video, args.contact_sheet, args.columns, args.width, args.margin, args.padding)
+    sheet = create_contact_sheet(args.input_video, args.contact_sheet, args.columns, args.width, args.margin, args.padding)
     data = read_json_file(args.amp_input)
     if args.mode == "vocr":
         sheet.create_vocr(data)
@@ -5,7 +5,7 @@ import logging
 import math
 
 import amp.logging
-from amp.schema.contact_sheet import ContactSheet
+from thumbnail_cache import create_contact_sheet
 
 
 def main():
@@ -23,7 +23,7 @@ def main():
 	amp.logging.setup_logging("contact_sheet_frame", args.debug)
 	logging.info(f"Starting with args {args}")
 
-	sheet = ContactSheet(args.input_video, args.contact_sheet, args.columns, args.width, args.margin, args.padding)
+	sheet = create_contact_sheet(args.input_video, args.contact_sheet, args.columns, args.width, args.margin, args.padding)
 	
 	# if only frame_interval is provided, extract frames based on the interval
 	if args.frame_interval and not args.frame_quantity:
@@ -0,0 +1,18 @@
+# Content hashes of local files.
+#
+# Uploads to the HPC cluster and S3 are stored under the sha256 of their
+# content, so jobs with the same audio share one copy.
+
+import hashlib
+
+# size of the blocks a file is read in
+BLOCK_SIZE = 1024 * 1024
+
+
+def file_sha256(filename):
+    "Return the sha256 hex digest of a local file"
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
@@ -0,0 +1,295 @@
+# Incremental reading and writing of very large JSON documents.
+#
+# Transcripts and segmentations for multi-day recordings can have millions of
+# words, and loading them with read_json_file builds every one of them as a
+# Python object before anything can be done.  These functions let an MGM
+# walk one big array in a document (such as results.words) an item at a
+# time, read everything else in the document without that array, pick
+# several values and arrays out of a document in one pass, and write a
+# document whose big array comes from a generator, so memory use stays
+# bounded by the size of an item rather than the size of the document.
+
+import json
+import re
+import uuid
+
+CHUNK_SIZE = 1 << 16
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+_structure = re.compile(r'["\[\]{}]')
+_string_end = re.compile(r'["\\]')
+_number_start = set('-0123456789')
+_number_chars = re.compile(r'[0-9.eE+-]*')
+
+
+def iter_json_array(filename, path):
+    "Yield the items of the array at the dotted path in the JSON file"
+    keys = path.split('.')
+    with open(filename, encoding='utf-8') as f:
+        yield from _find_array(_Reader(f), keys)
+
+
+def read_json_without(filename, *paths):
+    "Read the JSON file, replacing the arrays at the dotted paths with empty lists"
+    with open(filename, encoding='utf-8') as f:
+        return _read_without(_Reader(f), [p.split('.') for p in paths])
+
+
+def iter_json_members(f):
+    """Yield the (key, value) members of the JSON object in the text file
+       object f as they are read.  Array values are generators of their items,
+       which have to be used before getting the next member."""
+    reader = _Reader(f)
+    for key in reader.members():
+        if reader.peek() == '[':
+            items = reader.items()
+            yield (key, items)
+            # skip whatever the caller didn't use
+            for _ in items:
+                pass
+        else:
+            yield (key, reader.value())
+
+
+def walk_json(filename, handlers):
+    """Read the JSON file in one pass, calling the handler for each dotted path
+       in handlers with the value there.  The value of an array is a generator
+       of its items, which the handler should use before returning.  Returns
+       the set of paths which were found; everything else is skipped."""
+    found = set()
+    with open(filename, encoding='utf-8') as f:
+        _walk(_Reader(f), "", handlers, found)
+    return found
+
+
+def write_json_stream(doc, filename, path, items, indent=None):
+    """Write the document to the JSON file, with the array at the dotted path
+       written from the items iterable one item at a time"""
+    with JsonStreamWriter(doc, filename, path, indent) as writer:
+        for item in items:
+            writer.write(item)
+
+
+class JsonStreamWriter:
+    """A JSON file being written whose array at the dotted path is written one
+       item at a time with write(), for when one pass over the input produces
+       several outputs.  The rest of the document is written by close(), or
+       at the end of a with statement."""
+    def __init__(self, doc, filename, path, indent=None):
+        keys = path.split('.')
+        marker = f"json_stream-{uuid.uuid4()}"
+        # copy the dicts along the path so the caller's document isn't changed
+        doc = dict(doc)
+        node = doc
+        for key in keys[:-1]:
+            node[key] = dict(node[key])
+            node = node[key]
+        node[keys[-1]] = marker
+        (head, self.tail) = json.dumps(doc, indent=indent, default=lambda x: x.__dict__).split(json.dumps(marker), 1)
+        # json.dumps makes a new encoder for every call with a default
+        self.encoder = json.JSONEncoder(default=lambda x: x.__dict__)
+        self.f = open(filename, "w", encoding='utf-8')
+        self.f.write(head)
+        self.f.write("[")
+        self.first = True
+
+
+    def write(self, item):
+        if not self.first:
+            self.f.write(",")
+        self.f.write(self.encoder.encode(item))
+        self.first = False
+
+
+    def close(self):
+        self.f.write("]")
+        self.f.write(self.tail)
+        self.f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # leave the file incomplete, so it isn't mistaken for a result
+            self.f.close()
+
+
+def _find_array(reader, keys):
+    for key in reader.members():
+        if key == keys[0]:
+            if len(keys) == 1:
+                yield from reader.items()
+            else:
+                yield from _find_array(reader, keys[1:])
+            return
+        reader.skip()
+    raise KeyError(keys[0])
+
+
+def _walk(reader, prefix, handlers, found):
+    for key in reader.members():
+        path = prefix + str(key)
+        if path in handlers:
+            found.add(path)
+            if reader.peek() == '[':
+                items = reader.items()
+                handlers[path](items)
+                # skip whatever the handler didn't use
+                for _ in items:
+                    pass
+            else:
+                handlers[path](reader.value())
+        elif reader.peek() == '{' and any(p.startswith(path + ".") for p in handlers):
+            _walk(reader, path + ".", handlers, found)
+        else:
+            reader.skip()
+
+
+def _read_without(reader, paths):
+    if reader.peek() != '{':
+        return reader.value()
+    obj = {}
+    for key in reader.members():
+        subpaths = [p[1:] for p in paths if p[0] == key]
+        if [] in subpaths:
+            reader.skip()
+            obj[key] = []
+        elif subpaths:
+            obj[key] = _read_without(reader, subpaths)
+        else:
+            obj[key] = reader.value()
+    return obj
+
+
+class _Reader:
+    "A JSON tokenizer which only keeps a window of the file in memory"
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+
+    def _more(self, size=None):
+        "Read more of the file into the buffer, returning False at the end"
+        if self.eof:
+            return False
+        data = self.f.read(size or CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+
+    def peek(self):
+        "Return the next non-whitespace character without consuming it"
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Unexpected end of JSON document")
+
+
+    def _next(self, expected):
+        "Consume the next non-whitespace character, which must be in expected"
+        c = self.peek()
+        if c not in expected:
+            raise ValueError(f"Expected one of {expected!r} but found {c!r} in JSON document")
+        self.pos += 1
+        return c
+
+
+    def value(self):
+        "Decode and consume the next value"
+        self.peek()
+        while True:
+            try:
+                (value, end) = _decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may continue in the file,
+                # even if it decoded:  "0." decodes as 0 and "1e" as 1
+                if self.eof or not (self.buf[self.pos] in _number_start and
+                                    _number_chars.match(self.buf, end).end() == len(self.buf)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # grow the buffer geometrically so big values aren't reparsed too often
+            self._more(max(CHUNK_SIZE, len(self.buf) - self.pos))
+
+
+    def skip(self):
+        "Consume the next value without decoding it"
+        if self.peek() not in '[{"':
+            self.value()
+            return
+        depth = 0
+        while True:
+            m = _structure.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                if not self._more():
+                    raise ValueError("Unexpected end of JSON document")
+                continue
+            self.pos = m.end()
+            c = m.group()
+            if c == '"':
+                self._skip_string()
+            elif c in '[{':
+                depth += 1
+            else:
+                depth -= 1
+            if depth == 0:
+                return
+
+
+    def _skip_string(self):
+        "Consume the rest of a string whose opening quote has been consumed"
+        while True:
+            m = _string_end.search(self.buf, self.pos)
+            # an escape at the very end of the buffer needs the next character too
+            if m is None or (m.group() == '\\' and m.end() >= len(self.buf)):
+                self.pos = m.start() if m else len(self.buf)
+                if not self._more():
+                    raise ValueError("Unexpected end of JSON document")
+                continue
+            if m.group() == '"':
+                self.pos = m.end()
+                return
+            self.pos = m.end() + 1
+
+
+    def members(self):
+        """Yield the keys of the object at the current position.  The caller
+           has to consume each value before getting the next key."""
+        self._next('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._next(':')
+            yield key
+            if self._next(',}') == '}':
+                return
+
+
+    def items(self):
+        "Yield the decoded items of the array at the current position"
+        self._next('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self._next(',]') == ']':
+                return
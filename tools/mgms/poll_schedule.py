@@ -0,0 +1,268 @@
+#!/usr/bin/env amp_python.sif
+# Adaptive polling for LWLW MGMs.
+#
+# Galaxy reruns a waiting LWLW job on a fixed cadence, and every rerun used
+# to ask the service about the job.  A three hour job was asked about from
+# the start, and a short one could sit finished for a whole interval.
+# Instead, each job keeps a schedule in the AMP work directory:  the first
+# poll is when the job should be nearly done, estimated from the media
+# duration and how long the MGM's recent jobs took, and later polls back off
+# exponentially.  Until the MGM has some history the estimate is only a
+# guess, so the first poll is after the shortest interval instead.  Until a
+# poll is due, check() returns WAIT without contacting the service.
+#
+# A completion notification makes a poll due right away.  It is an empty
+# file named for the job in the notification directory, created by running
+# "poll_schedule.py notify <jobid>" (from an S3 event handler, or the
+# service's completion hook on a shared file system).  MGMs can also give
+# their own cheap completion test, such as a shared status scan or whether
+# the output object is in S3.
+
+import argparse
+import copy
+import fcntl
+import json
+import logging
+import math
+import os
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+from amp.config import load_amp_config, get_config_value, get_work_dir
+from amp.lwlw import LWLW
+
+# fraction of the expected duration before the first poll
+FIRST_POLL = 0.9
+
+# the first interval after the expected duration, as a fraction of it
+BACKOFF_START = 0.1
+
+# number of finished jobs used for the estimates
+HISTORY_SIZE = 50
+
+# seconds before the schedule of an abandoned job is removed
+STALE_AGE = 7 * 24 * 3600
+
+
+class PollSchedule:
+    """The poll schedule of a job.  Without history, a job of the MGM is
+       expected to take overhead seconds plus rate seconds per second of media."""
+    def __init__(self, mgm, jobid, rate=0, overhead=60):
+        self.mgm = mgm
+        self.jobid = jobid
+        self.rate = rate
+        self.overhead = overhead
+        config = load_amp_config()
+        self.enabled = get_config_value(config, ['mgms', 'poll_schedule', 'enabled'], True)
+        self.min_interval = get_config_value(config, ['mgms', 'poll_schedule', 'min_interval'], 10)
+        self.max_interval = get_config_value(config, ['mgms', 'poll_schedule', 'max_interval'], 900)
+        workdir = Path(get_work_dir("poll_schedule"))
+        self.file = workdir / f"{jobid}.json"
+        self.history_file = workdir / f"history-{mgm}.json"
+        self.notification = notification_path(jobid)
+
+
+    def for_job(self, jobid):
+        "Return the schedule of another job of the same MGM, such as one in the same batch"
+        schedule = copy.copy(self)
+        schedule.jobid = jobid
+        schedule.file = self.file.with_name(f"{jobid}.json")
+        schedule.notification = notification_path(jobid)
+        return schedule
+
+
+    def start(self, media_duration=None):
+        "Start the schedule of a job which was just submitted"
+        if not self.enabled:
+            return
+        expected = self.expected_duration(media_duration)
+        first = max(self.min_interval, FIRST_POLL * expected)
+        if not self._history():
+            # the estimate is a guess, and a short job shouldn't wait for it
+            first = self.min_interval
+        now = time.time()
+        state = {'submitted': now,
+                 'duration': media_duration,
+                 'expected': expected,
+                 'polls': 0,
+                 'next': now + first}
+        logging.info(f"Job {self.jobid} is expected to take {expected:.0f}s, first poll in {state['next'] - now:.0f}s")
+        self.notification.unlink(missing_ok=True)
+        self._write(state)
+        prune_schedules(self.file.parent)
+
+
+    def expected_duration(self, media_duration=None):
+        """Return the number of seconds a job is expected to take:  the default
+           estimate, scaled by how the recent jobs compared to theirs"""
+        scales = [elapsed / self.default_duration(duration) for duration, elapsed in self._history()
+                  if self.default_duration(duration) > 0]
+        scale = statistics.median(scales) if scales else 1
+        return max(self.min_interval, scale * self.default_duration(media_duration))
+
+
+    def default_duration(self, media_duration):
+        return self.overhead + self.rate * (media_duration or 0)
+
+
+    def due(self, ready=None):
+        """Return whether the job should be polled now:  if it has no schedule,
+           its next poll time has passed, it has a notification, or the
+           optional ready function says it is finished"""
+        state = self._read()
+        if state is None or time.time() >= state['next']:
+            return True
+        if self.notification.exists():
+            logging.info(f"Job {self.jobid} has a completion notification")
+            return True
+        try:
+            if ready is not None and ready():
+                logging.info(f"Job {self.jobid} looks finished")
+                return True
+        except Exception as e:
+            logging.debug(f"Cannot tell if job {self.jobid} is finished: {e}")
+        logging.debug(f"Job {self.jobid} isn't due for a poll for {state['next'] - time.time():.0f}s")
+        return False
+
+
+    def poll(self, check, ready=None):
+        "Run the check function if a poll is due and update the schedule from its LWLW result"
+        if not self.due(ready):
+            return LWLW.WAIT
+        rc = check()
+        if rc == LWLW.WAIT:
+            self.waited()
+        else:
+            self.finished(record=rc == LWLW.OK)
+        return rc
+
+
+    def waited(self):
+        "Schedule the next poll after one which found the job still running"
+        state = self._read()
+        if state is None:
+            return
+        now = time.time()
+        if now < state['next']:
+            # an early poll (from a notification, or right after the job
+            # was submitted) doesn't move the schedule
+            self.notification.unlink(missing_ok=True)
+            return
+        interval = max(self.min_interval, BACKOFF_START * state['expected']) * 2 ** state['polls']
+        state['polls'] += 1
+        state['next'] = now + min(self.max_interval, interval)
+        self.notification.unlink(missing_ok=True)
+        self._write(state)
+
+
+    def completed(self, timestamp):
+        "Note when the service says the job finished, which may be well before it was polled"
+        state = self._read()
+        if state is not None:
+            state['completed'] = timestamp
+            self._write(state)
+
+
+    def finished(self, record=True):
+        "Remove the schedule of a job, recording how long it took if it worked"
+        state = self._read()
+        if state is not None and record:
+            elapsed = max(0, state.get('completed', time.time()) - state['submitted'])
+            logging.info(f"Job {self.jobid} took {elapsed:.0f}s (expected {state['expected']:.0f}s) and {state['polls'] + 1} polls")
+            with self._history_lock():
+                history = self._history()
+                history.append((state['duration'], elapsed))
+                _write_json(self.history_file, history[-HISTORY_SIZE:])
+        self.file.unlink(missing_ok=True)
+        self.notification.unlink(missing_ok=True)
+
+
+    def _read(self):
+        try:
+            return json.loads(self.file.read_text())
+        except (OSError, ValueError):
+            return None
+
+
+    def _write(self, state):
+        _write_json(self.file, state)
+
+
+    def _history(self):
+        try:
+            return [tuple(h) for h in json.loads(self.history_file.read_text())]
+        except (OSError, ValueError):
+            return []
+
+
+    def _history_lock(self):
+        lockfile = open(str(self.history_file) + ".lock", "w")
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        # closing the file releases the lock
+        return lockfile
+
+
+def notification_path(jobid):
+    "Return the path of the completion notification of a job"
+    return Path(get_work_dir("poll_schedule"), "notify", jobid)
+
+
+def notify(jobid):
+    "Note that a job is finished, so it is polled right away"
+    path = notification_path(jobid)
+    path.parent.mkdir(exist_ok=True)
+    path.touch()
+
+
+def s3_object_exists(s3_client, bucket, key):
+    "Return whether an S3 object exists, which is a completion test for jobs that write their output to S3"
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        return True
+    except Exception as e:
+        logging.debug(f"No s3://{bucket}/{key}: {e}")
+        return False
+
+
+def prune_schedules(workdir):
+    "Remove the schedules and notifications of jobs which were abandoned"
+    cutoff = time.time() - STALE_AGE
+    for path in [*workdir.glob("*.json"), *workdir.glob("notify/*")]:
+        try:
+            if not path.name.startswith("history-") and path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+
+def media_duration(filename):
+    "Return the duration of a media file in seconds, or None if it can't be determined"
+    try:
+        p = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', str(filename)],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8', check=True)
+        duration = float(p.stdout.strip())
+        return duration if math.isfinite(duration) else None
+    except Exception as e:
+        logging.debug(f"Cannot get the duration of {filename}: {e}")
+        return None
+
+
+def _write_json(filename, data):
+    tmpfile = filename.with_name(f".{filename.name}.{os.getpid()}")
+    tmpfile.write_text(json.dumps(data))
+    os.replace(tmpfile, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LWLW poll schedules")
+    parser.add_argument("command", choices=['notify'], help="Command")
+    parser.add_argument("jobid", nargs="+", help="Job ids (the persistent job names)")
+    args = parser.parse_args()
+    for jobid in args.jobid:
+        notify(jobid)
+
+
+if __name__ == "__main__":
+    main()
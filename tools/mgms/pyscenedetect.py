@@ -2,15 +2,19 @@
 
 import datetime
 import argparse
+import json
+import subprocess
+import numpy as np
 
 # Standard PySceneDetect imports:
-from scenedetect.video_manager import VideoManager
+from scenedetect import open_video
 from scenedetect.scene_manager import SceneManager
 # For caching detection metrics and saving/loading to a stats file
-from scenedetect.stats_manager import StatsManager
+from scenedetect.stats_manager import StatsManager, COLUMN_NAME_FRAME_NUMBER, COLUMN_NAME_TIMECODE
 
 # For content-aware scene detection:
 from scenedetect.detectors.content_detector import ContentDetector
+from scenedetect.frame_timecode import FrameTimecode
 
 import logging
 import amp.logging
@@ -21,6 +25,10 @@ def main():
     parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
     parser.add_argument("input_video", help="Input video file")
     parser.add_argument("--threshold", type=int, default=30, help="Detection sensitivity threshold")
+    parser.add_argument("--frame_skip", type=int, default=0, help="Number of frames to skip between each frame checked for shot boundaries")
+    parser.add_argument("--downscale", type=int, default=0, help="Downscale factor for frames, 0 to pick one from the video resolution")
+    parser.add_argument("--backend", choices=['opencv', 'pyav'], default='opencv', help="Video decoding backend")
+    parser.add_argument("--engine", choices=['content', 'histogram'], default='content', help="Shot detection engine")
     parser.add_argument("amp_shots", help="AMP Shots Generated")
     parser.add_argument("frame_stats", help="Frame Statistics")
     args = parser.parse_args()
@@ -28,7 +36,11 @@ def main():
     logging.info(f"Starting with args {args}")
 
     # Get a list of scenes as tuples (start, end) 
-    shots = find_shots(args.input_video, args.frame_stats, args.threshold)
+    if args.engine == 'histogram':
+        shots = find_shots_histogram(args.input_video, args.frame_stats, args.threshold)
+    else:
+        shots = find_shots(args.input_video, args.frame_stats, args.threshold, 
+                           frame_skip=args.frame_skip, downscale=args.downscale, backend=args.backend)
 
     # Print for debugging purposes
     for shot in shots:
@@ -47,29 +59,33 @@ def get_duration(shots):
     return get_seconds_from_timecode(tc)
 
 # Find a list of shots using pyscenedetect api
-def find_shots(video_path, stats_file, threshold):
-    video_manager = VideoManager([video_path])
-    stats_manager = StatsManager()
-    # Construct our SceneManager and pass it our StatsManager.
-    scene_manager = SceneManager(stats_manager)
-
-    # Add ContentDetector algorithm (each detector's constructor
-    # takes detector options, e.g. threshold).
-    scene_manager.add_detector(ContentDetector(threshold=threshold))
-    base_timecode = video_manager.get_base_timecode()
+def find_shots(video_path, stats_file, threshold, frame_skip=0, downscale=0, backend='opencv'):
     scene_list = []
     try:
-        # Set downscale factor to improve processing speed.
-        video_manager.set_downscale_factor()
+        # the pyav backend can use the codec's own decoding threads; the
+        # scene manager always decodes on a separate thread into a queue.
+        if backend == 'pyav':
+            video = open_video(video_path, backend=backend, threading_mode='AUTO')
+        else:
+            video = open_video(video_path, backend=backend)
+        # PySceneDetect can't collect frame statistics when frames are skipped
+        stats_manager = StatsManager() if not frame_skip else None
+        # Construct our SceneManager and pass it our StatsManager.
+        scene_manager = create_scene_manager(threshold, downscale, stats_manager=stats_manager)
 
-        # Start video_manager.
-        video_manager.start()
+        # Perform scene detection on the video.  When frames are skipped the
+        # cuts are only accurate to within frame_skip frames.
+        scene_manager.detect_scenes(video=video, frame_skip=frame_skip)
 
-        # Perform scene detection on video_manager.
-        scene_manager.detect_scenes(frame_source=video_manager)
+        # Obtain list of detected scenes.  A video without any cuts is one
+        # scene, rather than an empty list.
+        scene_list = scene_manager.get_scene_list(start_in_scene=True)
 
-        # Obtain list of detected scenes.
-        scene_list = scene_manager.get_scene_list(base_timecode)
+        # Check the cuts found at the coarse frame rate at full frame rate.
+        if frame_skip and scene_list:
+            cuts = refine_cuts(video, [s[0] for s in scene_list[1:]], threshold, downscale, frame_skip + 1)
+            logging.info(f"Refined {len(scene_list) - 1} candidate cuts to {len(cuts)} cuts")
+            scene_list = cuts_to_scenes(cuts, scene_list[0][0], scene_list[-1][1])
 
         # Each scene is a tuple of (start, end) FrameTimecodes.
         logging.debug('List of shots obtained:')
@@ -81,16 +97,147 @@ def find_shots(video_path, stats_file, threshold):
                 scene[1].get_timecode(), scene[1].get_frames(),))
 
         # Save a list of stats to a csv
-        if stats_manager.is_save_required():
-            with open(stats_file, 'w') as stats_file:
-                stats_manager.save_to_csv(stats_file, base_timecode)
+        if stats_manager is None:
+            logging.warning(f"Frame statistics can't be collected when frames are skipped, so {stats_file} only has the header")
+            write_stats_header(stats_file, threshold)
+        elif stats_manager.is_save_required():
+            stats_manager.save_to_csv(csv_file=stats_file)
     except Exception as err:
         logging.exception(f"Failed to find shots for: video: {video_path}, stats: {stats_file}, threshold: {threshold}")   
-    finally:
-        video_manager.release()
 
     return scene_list
 
+# Create a scene manager with a content detector
+def create_scene_manager(threshold, downscale, stats_manager=None, min_scene_len=15):
+    scene_manager = SceneManager(stats_manager)
+    # Set downscale factor to improve processing speed.
+    if downscale:
+        scene_manager.auto_downscale = False
+        scene_manager.downscale = downscale
+    else:
+        scene_manager.auto_downscale = True
+    # Add ContentDetector algorithm (each detector's constructor
+    # takes detector options, e.g. threshold).
+    scene_manager.add_detector(ContentDetector(threshold=threshold, min_scene_len=min_scene_len))
+    return scene_manager
+
+# Re-check each candidate cut at full frame rate in a small window around it.
+# Candidates which don't turn out to be cuts at full frame rate are dropped.
+def refine_cuts(video, candidates, threshold, downscale, window):
+    cuts = []
+    for candidate in candidates:
+        start = max(candidate.get_frames() - window, 0)
+        video.seek(start)
+        # the window is shorter than the normal minimum scene length, so the
+        # detector has to be allowed to report a cut anywhere in it.
+        scene_manager = create_scene_manager(threshold, downscale, min_scene_len=0)
+        scene_manager.detect_scenes(video=video, end_time=candidate.get_frames() + window)
+        found = [s[0] for s in scene_manager.get_scene_list()[1:]]
+        if not found:
+            logging.debug(f"Dropping candidate cut at {candidate.get_timecode()}")
+            continue
+        # take the cut closest to the candidate, but never one we already have.
+        cut = min(found, key=lambda x: abs(x.get_frames() - candidate.get_frames()))
+        if not cuts or cut.get_frames() > cuts[-1].get_frames():
+            cuts.append(cut)
+    return cuts
+
+# Write a frame statistics csv with only the header the StatsManager would write
+def write_stats_header(stats_file, threshold):
+    metrics = sorted(ContentDetector(threshold=threshold).get_metrics())
+    with open(stats_file, "w") as f:
+        f.write(",".join([COLUMN_NAME_FRAME_NUMBER, COLUMN_NAME_TIMECODE, *metrics]) + "\n")
+
+# Turn a list of cuts into a list of (start, end) scenes.  Without any cuts
+# the whole video is one scene.
+def cuts_to_scenes(cuts, start, end):
+    scenes = []
+    for cut in cuts:
+        scenes.append((start, cut))
+        start = cut
+    scenes.append((start, end))
+    return scenes
+
+# Find a list of shots by comparing color histograms of tiny thumbnails.
+# This is much cheaper than the ContentDetector and works well for footage
+# where the shots are separated by hard cuts.  The threshold is the percentage
+# of the histogram which has to change between two frames to be a cut.
+def find_shots_histogram(video_path, stats_file, threshold, width=32, height=18, levels=4, min_scene_len=15):
+    scene_list = []
+    try:
+        fps = get_frame_rate(video_path)
+        frame_size = width * height * 3
+        # number of bits to drop from each channel to get the requested levels
+        shift = 8 - int(np.log2(levels))
+        cuts = []
+        stats = []
+        with subprocess.Popen(['ffmpeg', '-i', video_path, '-an',
+                               '-vf', f"scale={width}:{height}",
+                               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               stdin=subprocess.DEVNULL) as p:
+            logging.info(f"Raw video command: {p.args}")
+            frame_num = 0
+            last_cut = 0
+            previous = None
+            while len(data := p.stdout.read(frame_size)) == frame_size:
+                # quantize each channel and build a joint RGB histogram
+                pixels = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3) >> shift
+                bins = (pixels[:, 0].astype(np.int32) * levels + pixels[:, 1]) * levels + pixels[:, 2]
+                histogram = np.bincount(bins, minlength=levels ** 3) / (width * height)
+                if previous is not None:
+                    # half of the L1 distance is the fraction of pixels which moved bins
+                    delta = np.abs(histogram - previous).sum() * 50
+                    stats.append((frame_num, delta))
+                    if delta >= threshold and frame_num - last_cut >= min_scene_len:
+                        cuts.append(FrameTimecode(frame_num, fps))
+                        last_cut = frame_num
+                previous = histogram
+                frame_num += 1
+        if p.returncode:
+            raise Exception(f"ffmpeg failed with return code {p.returncode}")
+
+        scene_list = cuts_to_scenes(cuts, FrameTimecode(0, fps), FrameTimecode(frame_num, fps))
+        logging.info(f"Found {len(cuts)} cuts in {frame_num} frames")
+
+        # Save the frame stats in the same layout the StatsManager uses
+        with open(stats_file, "w") as f:
+            f.write("Frame Number,Timecode,hist_delta\n")
+            for frame_num, delta in stats:
+                f.write(f"{frame_num + 1},{FrameTimecode(frame_num, fps).get_timecode()},{delta}\n")
+    except Exception as err:
+        logging.exception(f"Failed to find shots for: video: {video_path}, stats: {stats_file}, threshold: {threshold}")
+
+    return scene_list
+
+# Get the video frame rate with ffprobe.  Some containers and streams report
+# an average frame rate of 0/0, so fall back to the stream's base frame rate
+# and then to the one PySceneDetect reports, which is also used if ffprobe
+# fails.
+def get_frame_rate(video_path):
+    try:
+        p = subprocess.run(["ffprobe", "-print_format", "json", "-show_streams", 
+                            "-select_streams", "v:0", video_path],
+                            encoding='utf-8', check=True, stdout=subprocess.PIPE,
+                            stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        stream = json.loads(p.stdout)['streams'][0]
+    except Exception as e:
+        logging.warning(f"Cannot get the frame rate of {video_path} with ffprobe: {e}")
+        stream = {}
+    for key in ('avg_frame_rate', 'r_frame_rate'):
+        try:
+            num, den = stream[key].split('/')
+            fps = float(num) / float(den)
+            if fps > 0:
+                return fps
+        except (KeyError, ValueError, ZeroDivisionError):
+            pass
+        if stream:
+            logging.warning(f"Unusable {key} {stream.get(key)!r} for {video_path}")
+    fps = open_video(video_path).frame_rate
+    logging.info(f"Using the frame rate {fps} from PySceneDetect for {video_path}")
+    return fps
+
 def get_seconds_from_timecode(time_string):
     dt = datetime.datetime.strptime(time_string, "%H:%M:%S.%f")
     a_timedelta = dt - datetime.datetime(1900, 1, 1)
@@ -0,0 +1,33 @@
+# Assign diarization speakers to transcript words.
+#
+# Checking every diarization segment for every word is O(words x segments),
+# which gets slow for long recordings with lots of speaker turns.  Instead,
+# the words and segments are both swept in time order, keeping a heap of the
+# segments which have started, so each word and segment is only handled once.
+
+import heapq
+
+
+def assign_speakers(times, segments):
+    """Return the speaker for each of the times, or None if no segment covers
+       it.  Segments are dicts with start, end, and speaker.  When segments
+       overlap the first one in the list wins, just like a linear search."""
+    speakers = [None] * len(times)
+    if not segments:
+        return speakers
+    order = sorted(range(len(segments)), key=lambda i: segments[i]['start'])
+    # heap of the indexes of segments which have started.  The earliest
+    # listed segment is on top, and ones which have ended are dropped when
+    # they get there since the times only increase.
+    active = []
+    next_segment = 0
+    for i in sorted(range(len(times)), key=lambda i: times[i]):
+        t = times[i]
+        while next_segment < len(order) and segments[order[next_segment]]['start'] <= t:
+            heapq.heappush(active, order[next_segment])
+            next_segment += 1
+        while active and segments[active[0]]['end'] < t:
+            heapq.heappop(active)
+        if active:
+            speakers[i] = segments[active[0]]['speaker']
+    return speakers
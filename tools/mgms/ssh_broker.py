@@ -0,0 +1,415 @@
+#!/usr/bin/env amp_python.sif
+# Shared SSH connections for MGMs which poll a remote host.
+#
+# Every LWLW poll is a new process, and each one used to make its own SSH
+# connection (with a full key exchange) and open new SFTP channels for every
+# call, so hundreds of waiting jobs meant a storm of handshakes on the login
+# node.  Instead, the first process which needs a host starts a broker
+# process which holds one authenticated transport to it and listens on a
+# unix socket in the AMP work directory.  Processes send their requests to
+# the broker, which runs each client's requests on its own SFTP channel over
+# the shared transport and reconnects when the transport drops.  The broker
+# exits after it has been idle for a while.
+#
+# RemoteSession is the set of remote operations, and BrokerClient proxies the
+# same operations to the broker.
+
+import argparse
+import base64
+import fcntl
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import paramiko
+from amp.config import get_work_dir
+
+# seconds the broker stays up without any clients
+IDLE_TIMEOUT = 600
+
+# seconds to wait for a newly started broker to listen
+START_TIMEOUT = 15
+
+# size of the blocks used to copy files
+BLOCK_SIZE = 1024 * 1024
+
+# exceptions which mean the connection, rather than the request, failed.
+# Not EOFError, which paramiko also raises for SFTP errors on a live channel.
+CONNECTION_ERRORS = (paramiko.SSHException, ConnectionError, socket.timeout)
+
+# operations which can be run again if the connection fails partway through.
+# The others (like run, which submits jobs) might have happened already.
+IDEMPOTENT_OPS = {'stat', 'listdir', 'read', 'resume_put'}
+
+
+class RemoteError(Exception):
+    "A remote operation failed for a reason other than an OS error"
+
+
+def connect_remote(host, user, broker=True):
+    "Return a RemoteSession or BrokerClient for the host"
+    if broker:
+        return BrokerClient(host, user)
+    return RemoteSession(SSHConnection(host, user))
+
+
+class SSHConnection:
+    "An SSH transport to a host which reconnects when it is dropped"
+    def __init__(self, host, user):
+        self.host = host
+        self.user = user
+        self.ssh = None
+        self.lock = threading.Lock()
+
+
+    def transport(self):
+        "Return an active transport, connecting if necessary"
+        with self.lock:
+            if self.ssh is None or not self.ssh.get_transport() or not self.ssh.get_transport().is_active():
+                if self.ssh is not None:
+                    logging.info(f"Connection to {self.user}@{self.host} was lost, reconnecting")
+                    self.ssh.close()
+                logging.debug(f"Connecting to {self.user}@{self.host}")
+                self.ssh = paramiko.SSHClient()
+                self.ssh.load_system_host_keys()
+                self.ssh.connect(self.host, username=self.user)
+            return self.ssh.get_transport()
+
+
+    def close(self):
+        with self.lock:
+            if self.ssh is not None:
+                self.ssh.close()
+                self.ssh = None
+
+
+class RemoteSession:
+    """Remote file and command operations on one SFTP channel of a shared
+       connection.  Idempotent operations which fail because the connection
+       was lost are retried once on a new connection."""
+    def __init__(self, connection):
+        self.connection = connection
+        self._sftp = None
+
+
+    def sftp(self):
+        if self._sftp is None:
+            self._sftp = paramiko.SFTPClient.from_transport(self.connection.transport())
+        return self._sftp
+
+
+    def call(self, op, *args):
+        "Run the named operation"
+        if op.startswith('_') or op in ('call', 'sftp', 'close'):
+            raise RemoteError(f"Unknown operation {op}")
+        method = getattr(self, op)
+        try:
+            return method(*args)
+        except CONNECTION_ERRORS as e:
+            self._sftp = None
+            if op not in IDEMPOTENT_OPS:
+                raise
+            logging.info(f"Retrying {op} after connection failure: {e}")
+            return method(*args)
+
+
+    def close(self):
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+
+
+    def stat(self, path):
+        "Return a dict of the mode, size and mtime of the path"
+        s = self.sftp().stat(path)
+        return {'mode': s.st_mode, 'size': s.st_size, 'mtime': s.st_mtime}
+
+
+    def listdir(self, path):
+        "Return a list of dicts with the name, mode, size and mtime of each entry in the directory"
+        return [{'name': s.filename, 'mode': s.st_mode, 'size': s.st_size, 'mtime': s.st_mtime}
+                for s in self.sftp().listdir_attr(path)]
+
+
+    def read(self, path, offset=0, size=-1):
+        "Return the contents of the file, or size bytes of it starting at offset"
+        with self.sftp().open(path, "rb") as f:
+            end = f.stat().st_size
+            if size >= 0:
+                end = min(end, offset + size)
+            f.seek(offset)
+            # request all of the blocks at once instead of one at a time
+            f.prefetch(end)
+            return f.read(max(0, end - offset))
+
+
+    def write(self, path, data, append=False):
+        "Write (or append) the data to the file"
+        with self.sftp().open(path, "ab" if append else "wb") as f:
+            f.set_pipelined(True)
+            f.write(data)
+
+
+    def put(self, local_path, path):
+        "Copy a local file to the remote path"
+        self.sftp().put(local_path, path)
+
+
+    def resume_put(self, local_path, path):
+        """Copy the local file to the remote path, continuing from the end of
+           the remote file if it was partially copied before.  Since it only
+           appends what is missing, it is safe to retry."""
+        sftp = self.sftp()
+        try:
+            offset = sftp.stat(path).st_size
+        except FileNotFoundError:
+            offset = 0
+        with open(local_path, "rb") as src, sftp.open(path, "ab") as dst:
+            dst.set_pipelined(True)
+            src.seek(offset)
+            while True:
+                data = src.read(BLOCK_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+
+
+    def symlink(self, target, path):
+        "Create a symbolic link at path pointing to target"
+        self.sftp().symlink(target, path)
+
+
+    def utime(self, path):
+        "Set the modification time of the path to now"
+        self.sftp().utime(path, None)
+
+
+    def mkdir(self, path):
+        self.sftp().mkdir(path)
+
+
+    def rmdir(self, path):
+        self.sftp().rmdir(path)
+
+
+    def unlink(self, path):
+        self.sftp().unlink(path)
+
+
+    def rename(self, path, new_path):
+        self.sftp().posix_rename(path, new_path)
+
+
+    def run(self, command):
+        "Run a command, returning the exit status, stdout and stderr"
+        channel = self.connection.transport().open_session()
+        try:
+            channel.exec_command(command)
+            stdout = channel.makefile("rb").read()
+            stderr = channel.makefile_stderr("rb").read()
+            return (channel.recv_exit_status(), stdout, stderr)
+        finally:
+            channel.close()
+
+
+class BrokerClient:
+    "Proxy for a RemoteSession in the broker for the host, starting the broker if necessary"
+    def __init__(self, host, user):
+        self.host = host
+        self.user = user
+        self.socket_path = broker_socket_path(host, user)
+        self.sock = None
+        self.rfile = None
+
+
+    def __getattr__(self, op):
+        if op.startswith('_'):
+            raise AttributeError(op)
+        return lambda *args: self.call(op, *args)
+
+
+    def call(self, op, *args):
+        "Send the operation to the broker and return its result"
+        request = (json.dumps({'op': op, 'args': [_encode(a) for a in args]}) + "\n").encode('utf-8')
+        for attempt in (1, 2):
+            sent = False
+            try:
+                if self.sock is None:
+                    self._connect()
+                self.sock.sendall(request)
+                sent = True
+                line = self.rfile.readline()
+                if not line:
+                    raise ConnectionError("Broker closed the connection")
+                break
+            except ConnectionError as e:
+                # the broker may have exited because it was idle.  Once the
+                # request was sent it may have been run, so only idempotent
+                # operations are sent again.
+                self.close()
+                if attempt == 2 or (sent and op not in IDEMPOTENT_OPS):
+                    raise
+                logging.debug(f"Reconnecting to broker: {e}")
+        response = json.loads(line)
+        if 'error' in response:
+            error = response['error']
+            if error.get('errno') is not None:
+                raise OSError(error['errno'], error['message'])
+            if error.get('oserror'):
+                # like SFTP failures without an errno, such as mkdir of an
+                # existing directory
+                raise OSError(error['message'])
+            raise RemoteError(f"{error['type']}: {error['message']}")
+        return _decode(response['result'])
+
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+        self.sock = None
+        self.rfile = None
+
+
+    def _connect(self):
+        "Connect to the broker, starting it if it isn't running"
+        try:
+            self._open_socket()
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        logging.debug(f"Starting SSH broker for {self.user}@{self.host}")
+        with open(str(self.socket_path) + ".log", "a") as log:
+            subprocess.Popen([sys.executable, __file__, self.host, self.user, str(self.socket_path)],
+                             stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+        deadline = time.time() + START_TIMEOUT
+        while True:
+            try:
+                self._open_socket()
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    raise ConnectionError(f"SSH broker for {self.user}@{self.host} didn't start")
+                time.sleep(0.1)
+
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.socket_path))
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+
+
+def broker_socket_path(host, user):
+    "Return the path of the broker socket for the host"
+    return Path(get_work_dir("ssh_broker"), f"{user}@{host}.sock")
+
+
+def _encode(value):
+    "Make a value JSON safe"
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and '$bytes' in value:
+        return base64.b64decode(value['$bytes'])
+    return value
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, connection):
+        self.connection = connection
+        self.clients = 0
+        self.last_active = time.time()
+        self.lock = threading.Lock()
+        super().__init__(socket_path, BrokerHandler)
+
+
+    def idle_watch(self):
+        "Shut the server down when it has been idle too long"
+        while True:
+            time.sleep(10)
+            with self.lock:
+                if self.clients == 0 and time.time() - self.last_active > IDLE_TIMEOUT:
+                    logging.info("Broker is idle, exiting")
+                    break
+        self.shutdown()
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    "Run the requests of one client on its own session"
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.clients += 1
+        session = RemoteSession(server.connection)
+        try:
+            for line in self.rfile:
+                with server.lock:
+                    server.last_active = time.time()
+                try:
+                    request = json.loads(line)
+                    result = session.call(request['op'], *[_decode(a) for a in request['args']])
+                    response = {'result': _encode(result)}
+                except Exception as e:
+                    if isinstance(e, OSError) and e.errno is not None:
+                        response = {'error': {'type': type(e).__name__, 'message': e.strerror, 'errno': e.errno}}
+                    elif isinstance(e, OSError):
+                        response = {'error': {'type': type(e).__name__, 'message': str(e), 'oserror': True}}
+                    else:
+                        response = {'error': {'type': type(e).__name__, 'message': str(e)}}
+                self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+        finally:
+            session.close()
+            with server.lock:
+                server.clients -= 1
+                server.last_active = time.time()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSH connection broker")
+    parser.add_argument("host")
+    parser.add_argument("user")
+    parser.add_argument("socket_path")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s [%(levelname)-8s] (%(process)d) %(message)s", level=logging.INFO)
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+
+    # only one broker can serve a socket.  If another one has the lock then
+    # it is already running or starting.
+    lockfile = open(args.socket_path + ".lock", "w")
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return
+    if os.path.exists(args.socket_path):
+        os.unlink(args.socket_path)
+    old_umask = os.umask(0o077)
+    server = BrokerServer(args.socket_path, SSHConnection(args.host, args.user))
+    os.umask(old_umask)
+    logging.info(f"Broker for {args.user}@{args.host} listening on {args.socket_path}")
+    threading.Thread(target=server.idle_watch, daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(args.socket_path)
+        server.connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# Shared on-disk cache for contact sheet thumbnails.
+#
+# Workflows frequently build several contact sheets (frame, shot, faces, vocr)
+# for the same video, and each one used to decode its thumbnails from scratch.
+# The cache lives in the per-user AMP work directory and is keyed by
+# (media hash, timestamp, width), so any later ContactSheet run on the same
+# media can reuse the thumbnails that have already been extracted.
+#
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+from amp.config import load_amp_config, get_config_value, get_work_dir
+from amp.schema.contact_sheet import ContactSheet
+
+# default cache size in megabytes
+DEFAULT_CACHE_SIZE = 512
+
+# how much of the start and the end of the media is hashed to identify it
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def media_hash(filename):
+    "Return a hash identifying the media file, without reading all of it"
+    # Galaxy datasets don't change once they're written, so the size plus the
+    # head and tail of the file are enough to tell them apart and it's much
+    # cheaper than hashing a multi-gigabyte video.
+    size = os.path.getsize(filename)
+    h = hashlib.sha256(str(size).encode())
+    with open(filename, "rb") as f:
+        h.update(f.read(HASH_CHUNK_SIZE))
+        if size > 2 * HASH_CHUNK_SIZE:
+            f.seek(-HASH_CHUNK_SIZE, os.SEEK_END)
+            h.update(f.read(HASH_CHUNK_SIZE))
+    return h.hexdigest()
+
+
+class ThumbnailCache:
+    def __init__(self, cache_dir=None, max_size=DEFAULT_CACHE_SIZE):
+        "Create a cache in cache_dir which holds at most max_size megabytes"
+        self.cache_dir = Path(cache_dir if cache_dir else get_work_dir("thumbnail_cache"))
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size * 1024 * 1024
+
+
+    def path(self, mhash, timestamp, width, suffix):
+        "Return the cache path for the thumbnail"
+        # timestamps are stored in milliseconds so float noise doesn't cause misses
+        return self.cache_dir / f"{mhash}-{round(timestamp * 1000):010d}-{width}{suffix}"
+
+
+    def fetch(self, mhash, timestamp, width, output_file):
+        "Copy a cached thumbnail to output_file, returning whether it was found"
+        cfile = self.path(mhash, timestamp, width, Path(output_file).suffix)
+        try:
+            shutil.copyfile(cfile, output_file)
+            # touching the file marks it as recently used for eviction.
+            os.utime(cfile)
+            logging.debug(f"Thumbnail cache hit: {cfile}")
+            return True
+        except FileNotFoundError:
+            return False
+
+
+    def store(self, mhash, timestamp, width, thumbnail_file):
+        "Add a thumbnail to the cache and evict old entries if it is too big"
+        if not Path(thumbnail_file).exists():
+            return
+        cfile = self.path(mhash, timestamp, width, Path(thumbnail_file).suffix)
+        # copy to a temporary name and rename it so other processes never see
+        # a partially written thumbnail
+        tmpfile = cfile.with_name(f".{cfile.name}.{os.getpid()}")
+        shutil.copyfile(thumbnail_file, tmpfile)
+        os.replace(tmpfile, cfile)
+        self.evict()
+
+
+    def evict(self):
+        "Remove the least recently used thumbnails until the cache fits"
+        with self._lock():
+            entries = []
+            total = 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            if total <= self.max_size:
+                return
+            # trim down to 90% so we aren't evicting on every store
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size * 0.9:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+            logging.debug(f"Thumbnail cache trimmed to {total} bytes")
+
+
+    @contextmanager
+    def _lock(self):
+        "Hold an exclusive lock on the cache directory"
+        with open(self.cache_dir / ".lock", "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class CachedContactSheet(ContactSheet):
+    "A ContactSheet which reuses thumbnails from a ThumbnailCache"
+    def __init__(self, input_file, output_file, number_of_columns=4, photow=300, margin=10, padding=3, cache=None):
+        super().__init__(input_file, output_file, number_of_columns, photow, margin, padding)
+        self.cache = cache if cache is not None else ThumbnailCache()
+        self.media_hash = media_hash(input_file)
+        self.width = photow
+
+
+    def extract_frame(self, time, output_file):
+        "Extract the thumbnail at the given time, using the cache if possible"
+        if self.cache.fetch(self.media_hash, time, self.width, output_file):
+            return
+        super().extract_frame(time, output_file)
+        try:
+            self.cache.store(self.media_hash, time, self.width, output_file)
+        except Exception as e:
+            # a broken cache shouldn't keep the contact sheet from being made
+            logging.warning(f"Cannot cache thumbnail at {time}: {e}")
+
+
+def create_contact_sheet(input_file, output_file, number_of_columns=4, photow=300, margin=10, padding=3):
+    "Create a ContactSheet which uses the thumbnail cache unless it is disabled in the config"
+    config = load_amp_config()
+    cache_size = get_config_value(config, ['mgms', 'contact_sheet', 'thumbnail_cache_size'], DEFAULT_CACHE_SIZE)
+    if not cache_size:
+        return ContactSheet(input_file, output_file, number_of_columns, photow, margin, padding)
+    return CachedContactSheet(input_file, output_file, number_of_columns, photow, margin, padding,
+                              cache=ThumbnailCache(max_size=cache_size))
@@ -0,0 +1,278 @@
+# Columnar sidecar files for AMP transcript words.
+#
+# Every MGM downstream of a speech to text tool reparses the transcript JSON
+# and rebuilds a dict for each word.  Transcript producers also write the
+# words as columns next to the JSON (the transcript filename plus
+# SIDECAR_SUFFIX):  an uncompressed .npz with an array for each word field
+# and a deduplicated string table for the types and texts.  Consumers memory
+# map the arrays instead of parsing the JSON.
+#
+# The sidecar records the size and modification time of the JSON it was
+# made from, so a stale one is ignored, and consumers fall back to streaming
+# the JSON whenever there isn't a current sidecar.
+
+import itertools
+import logging
+import math
+import os
+import struct
+import zipfile
+from array import array
+
+from json_stream import iter_json_array
+
+try:
+    import numpy as np
+except ImportError:
+    # not every container which produces transcripts has numpy, and the
+    # sidecar is only an optimization
+    np = None
+
+SIDECAR_SUFFIX = ".words.npz"
+SIDECAR_VERSION = 1
+
+# the word fields which can be stored in columns
+WORD_KEYS = {'type', 'text', 'start', 'end', 'offset', 'score'}
+
+# number of words converted from the arrays at a time
+BLOCK_SIZE = 65536
+
+
+def sidecar_path(transcript_file):
+    "Return the path of the transcript's sidecar"
+    return str(transcript_file) + SIDECAR_SUFFIX
+
+
+def write_word_columns(transcript_file, words=None):
+    """Write the sidecar for the (already written) transcript file, reading the
+       words from the file if they aren't given.  Returns whether it was written"""
+    columns = WordColumnsBuilder()
+    try:
+        for word in words if words is not None else iter_json_array(transcript_file, "results.words"):
+            columns.add(word)
+    except Exception as e:
+        logging.warning(f"Cannot read the words for the sidecar of {transcript_file}: {e}")
+        return False
+    return columns.save(transcript_file)
+
+
+def read_words(transcript_file, missing_ok=False):
+    """Return an iterator over the transcript's words, from its sidecar if
+       there's a current one.  A transcript without results.words raises
+       KeyError, or has no words if missing_ok."""
+    columns = load_word_columns(transcript_file)
+    if columns is not None:
+        logging.debug(f"Reading {len(columns)} words from {sidecar_path(transcript_file)}")
+        return columns.words()
+    words = iter_json_array(transcript_file, "results.words")
+    # the first item is read here so a missing array is found now rather
+    # than by whoever uses the words.  Finding the array is the only place
+    # iter_json_array raises KeyError.
+    try:
+        first = next(words)
+    except StopIteration:
+        return iter([])
+    except KeyError:
+        if not missing_ok:
+            raise
+        logging.warning("Warning: Results or words missing from AMP Json")
+        return iter([])
+    return itertools.chain([first], words)
+
+
+def load_word_columns(transcript_file):
+    "Return the WordColumns from the transcript's sidecar, or None if there isn't a current one"
+    path = sidecar_path(transcript_file)
+    if np is None or not os.path.exists(path):
+        return None
+    try:
+        arrays = _mmap_npz(path)
+        (version, size, mtime) = arrays['version'].tolist()
+        stat = os.stat(transcript_file)
+        if version != SIDECAR_VERSION or size != stat.st_size or mtime != stat.st_mtime_ns:
+            logging.info(f"Ignoring stale transcript sidecar {path}")
+            return None
+        return WordColumns(arrays)
+    except Exception as e:
+        logging.warning(f"Cannot read transcript sidecar {path}: {e}")
+        return None
+
+
+class WordColumns:
+    "The memory mapped word columns of a transcript"
+    def __init__(self, arrays):
+        self.type = arrays['type']
+        self.text = arrays['text']
+        self.start = arrays['start']
+        self.end = arrays['end']
+        self.offset = arrays['offset']
+        self.score_type = arrays['score_type']
+        self.score = arrays['score']
+        data = arrays['strings'].tobytes()
+        ends = arrays['string_ends'].tolist()
+        self.strings = [data[s:e].decode('utf-8') for s, e in zip([0] + ends[:-1], ends)]
+
+
+    def __len__(self):
+        return len(self.text)
+
+
+    def words(self):
+        "Yield the words as the dicts they were in the transcript JSON"
+        strings = self.strings
+        for block in range(0, len(self), BLOCK_SIZE):
+            columns = [c[block:block + BLOCK_SIZE].tolist() for c in (self.type, self.text, self.start, self.end,
+                                                                       self.offset, self.score_type, self.score)]
+            for wtype, text, start, end, offset, score_type, score in zip(*columns):
+                word = {'type': strings[wtype], 'text': strings[text]}
+                if not math.isnan(start):
+                    word['start'] = start
+                if not math.isnan(end):
+                    word['end'] = end
+                if score_type >= 0:
+                    word['score'] = {'type': strings[score_type], 'value': score}
+                if offset >= 0:
+                    word['offset'] = offset
+                yield word
+
+
+class WordColumnsBuilder:
+    "Collect transcript words into columns for a sidecar"
+    def __init__(self):
+        self.strings = {}
+        self.columns = {'type': array('i'), 'text': array('i'), 'start': array('d'), 'end': array('d'),
+                        'offset': array('q'), 'score_type': array('i'), 'score': array('d')}
+        # words which can't be stored exactly make the whole sidecar unusable
+        self.valid = True
+
+
+    def _string(self, value):
+        if not isinstance(value, str):
+            raise TypeError(f"{value!r} is not a string")
+        return self.strings.setdefault(value, len(self.strings))
+
+
+    def add(self, word):
+        "Add a word to the columns"
+        if not self.valid:
+            return
+        try:
+            if not WORD_KEYS.issuperset(word.keys()):
+                raise ValueError(f"Unexpected word fields {set(word.keys()) - WORD_KEYS}")
+            row = {'type': self._string(word['type']),
+                   'text': self._string(word['text']),
+                   'start': float(word['start']) if 'start' in word else math.nan,
+                   'end': float(word['end']) if 'end' in word else math.nan,
+                   'offset': -1,
+                   'score_type': -1,
+                   'score': math.nan}
+            if 'offset' in word:
+                if not isinstance(word['offset'], int) or word['offset'] < 0:
+                    raise ValueError(f"Bad offset {word['offset']!r}")
+                row['offset'] = word['offset']
+            if 'score' in word:
+                if set(word['score'].keys()) != {'type', 'value'}:
+                    raise ValueError(f"Bad score {word['score']!r}")
+                row['score_type'] = self._string(word['score']['type'])
+                row['score'] = float(word['score']['value'])
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logging.info(f"Transcript words can't be stored in a sidecar: {e}")
+            self.valid = False
+            return
+        for k, v in row.items():
+            self.columns[k].append(v)
+
+
+    def add_columns(self, types, texts, starts, ends, offsets, score_types, scores):
+        """Add words given as columns of the same length:  strings for the
+           types, texts and score types (None for no score), floats for the
+           times and scores (NaN for none), and ints for the offsets (-1 for
+           none).  This skips checking each word, for producers which already
+           have their words in columns."""
+        if not self.valid:
+            return
+        string = self._string
+        try:
+            # look up each distinct string once
+            for (key, values) in (('type', types), ('text', texts)):
+                indexes = {value: string(value) for value in dict.fromkeys(values)}
+                self.columns[key].extend(map(indexes.__getitem__, values))
+            self.columns['start'].extend(starts)
+            self.columns['end'].extend(ends)
+            self.columns['offset'].extend(offsets)
+            self.columns['score_type'].extend(-1 if t is None else string(t) for t in score_types)
+            self.columns['score'].extend(scores)
+        except (ValueError, TypeError, OverflowError) as e:
+            logging.info(f"Transcript words can't be stored in a sidecar: {e}")
+            self.valid = False
+            return
+        if len({len(c) for c in self.columns.values()}) != 1:
+            logging.info("Transcript word columns have different lengths")
+            self.valid = False
+
+
+    def collect(self, words):
+        "Add the words to the columns as they pass through"
+        for word in words:
+            self.add(word)
+            yield word
+
+
+    def save(self, transcript_file):
+        "Write the sidecar for the (already written) transcript file.  Returns whether it was written"
+        path = sidecar_path(transcript_file)
+        try:
+            # a sidecar from an earlier run would be stale now
+            if os.path.exists(path):
+                os.unlink(path)
+            if np is None or not self.valid:
+                return False
+            stat = os.stat(transcript_file)
+            encoded = [s.encode('utf-8') for s in self.strings]
+            arrays = {'version': np.array([SIDECAR_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64),
+                      'strings': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                      'string_ends': np.cumsum([len(s) for s in encoded], dtype=np.int64),
+                      'type': np.array(self.columns['type'], dtype=np.int32),
+                      'text': np.array(self.columns['text'], dtype=np.int32),
+                      'start': np.array(self.columns['start'], dtype=np.float64),
+                      'end': np.array(self.columns['end'], dtype=np.float64),
+                      'offset': np.array(self.columns['offset'], dtype=np.int64),
+                      'score_type': np.array(self.columns['score_type'], dtype=np.int32),
+                      'score': np.array(self.columns['score'], dtype=np.float64)}
+            # write to a temporary name so a reader never sees a partial sidecar
+            tmpfile = f"{path}.{os.getpid()}.tmp"
+            with open(tmpfile, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmpfile, path)
+            logging.debug(f"Wrote {len(self.columns['text'])} words to {path}")
+            return True
+        except Exception as e:
+            # the JSON is still fine without a sidecar
+            logging.warning(f"Cannot write transcript sidecar {path}: {e}")
+            return False
+
+
+def _mmap_npz(path):
+    "Memory map the arrays in an uncompressed .npz file"
+    arrays = {}
+    with zipfile.ZipFile(path) as z, open(path, "rb") as f:
+        for info in z.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{info.filename} is compressed")
+            # the member's data follows its local file header
+            f.seek(info.header_offset + 26)
+            (name_length, extra_length) = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            if np.lib.format.read_magic(f) == (1, 0):
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+            else:
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+            if fortran_order or dtype.hasobject:
+                raise ValueError(f"{info.filename} can't be memory mapped")
+            name = info.filename[:-len(".npy")]
+            if math.prod(shape):
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape)
+            else:
+                # mmap can't map an empty region
+                arrays[name] = np.empty(shape, dtype=dtype)
+    return arrays
@@ -5,6 +5,8 @@ import logging
 import amp.logging
 from amp.vtt_helper import words2phrases, gen_vtt
 from amp.fileutils import read_json_file
+from speaker_assignment import assign_speakers
+from transcript_columns import read_words
 
 # Reads the AMP Transcript and Segment inputs and convert them to Web VTT output.
 def main(): 
@@ -33,14 +35,13 @@ def main():
 		pass
 
 	# Read the transcript and convert it into something that words2phrases wants.
-	amp_transcript = read_json_file(args.stt_file)
+	# Newlines in the transcript split it into blocks which are phrased separately.
+	# The words come from the transcript's sidecar, or are streamed from the JSON.
+	blocks = []
 	words = []
-	phrases = []
-	for w in amp_transcript['results']['words']:
+	for w in read_words(args.stt_file):
 		if words and  w['text'] in ('\r', '\n'):
-			logging.debug(words)
-			phrases.extend(words2phrases(words, phrase_gap=args.phrase_gap, max_duration=args.max_duration))
-			logging.debug(phrases[-1])
+			blocks.append(words)
 			words = []
 			continue
 		w['text'] = w['text'].strip()
@@ -57,17 +58,23 @@ def main():
 			words[-1]['word'] += w['text']
 			continue
 
-		speaker = [x['speaker'] for x in diarization_segments if x['start'] <= w['start'] <= x['end']]
-		speaker = speaker[0] if speaker else None
 		words.append({
 			'start': w['start'],
 			'end': w['end'],
 			'word': w['text'].strip(),
-			'speaker': speaker
+			'speaker': None
 		})
-		#print(words[-1])
-	
 	if words:
+		blocks.append(words)
+
+	# Find the speaker for every word in one pass over the diarization
+	all_words = [w for words in blocks for w in words]
+	for w, speaker in zip(all_words, assign_speakers([w['start'] for w in all_words], diarization_segments)):
+		w['speaker'] = speaker
+
+	phrases = []
+	for words in blocks:
+		logging.debug(words)
 		phrases.extend(words2phrases(words, phrase_gap=args.phrase_gap, max_duration=args.max_duration))
 	with open(args.vtt_file, "w") as f:
 		f.write(gen_vtt(phrases))
@@ -0,0 +1,25 @@
+#!/usr/bin/env amp_python.sif
+import argparse
+import logging
+import amp.logging
+from vocabulary_tagging import get_words, build_index, save_index
+
+# Compile a list of words to flag into a vocabulary index which can be used
+# in place of the list by vocabulary_tagging.py and vocabulary_tagging_batch.py
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
+    parser.add_argument("words_to_flag_file", help="List of words/phrases to flag, one per line")
+    parser.add_argument("vocabulary_index", help="Output vocabulary index file")
+    args = parser.parse_args()
+    amp.logging.setup_logging("vocabulary_compile", args.debug)
+    logging.info(f"Starting with args {args}")
+
+    words_to_flag = get_words(args.words_to_flag_file)
+    save_index(build_index(words_to_flag.values()), args.vocabulary_index)
+    logging.info(f"Compiled {len(words_to_flag)} words/phrases into {args.vocabulary_index}")
+    logging.info("Finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,16 @@ import csv
 import json
 import argparse
 import logging
+import zlib
 import amp.logging
 from amp.timeutils import secondToTimestamp
+from transcript_columns import read_words
+
+# Precompiled vocabulary index files start with this
+INDEX_MAGIC = b"AMPVOCAB\x01"
+
+# Trie key for the phrases ending at a node; phrase parts are never empty
+PHRASE_END = ""
 
 def main():
     parser = argparse.ArgumentParser()
@@ -16,20 +24,12 @@ def main():
     amp.logging.setup_logging("vocabulary_tagging", args.debug)
     logging.info(f"Starting with args {args}")
 
-    # Get a list of words to flag
-    words_to_flag = get_words(args.words_to_flag_file) 
-    logging.debug(f"Words to flag: {', '.join(words_to_flag)}")
+    # Get the vocabulary, either precompiled or from the list of words to flag
+    vocabulary = load_vocabulary(args.words_to_flag_file)
+    logging.debug(f"Vocabulary has {len(vocabulary['exact'])} words/phrases to flag")
 
     # Search for matching words/phrases
-    matching_words = list()
-    with open(args.amp_transcript, 'r') as f:
-        transcript_dict = json.load(f)
-        # Check to see if we have a valid transcript.  If so, find the matches. 
-        if "results" in transcript_dict.keys() and "words" in transcript_dict["results"].keys():
-            transcript_words = transcript_dict["results"]["words"]
-            matching_words = match_words(words_to_flag.values(), transcript_words)
-        else:
-            logging.warning("Warning: Results or words missing from AMP Json")
+    matching_words = tag_transcript(vocabulary, args.amp_transcript)
 
     # Print the output
     logging.debug(f"Matching Words: {matching_words}")    
@@ -37,40 +37,78 @@ def main():
     logging.info("Finished.")
     exit(0)
 
+# Find the words/phrases to flag in the given AMP transcript file.  The words
+# come from its sidecar or are streamed from the file, so long transcripts
+# don't have to fit in memory.
+def tag_transcript(vocabulary, amp_transcript):
+    return match_index(vocabulary, read_words(amp_transcript, missing_ok=True))
+
 def match_words(words_to_flag, transcript_words):
+    return match_index(build_index(words_to_flag), transcript_words)
+
+def match_index(vocabulary, transcript_words):
     matching_words = list()
-    # Iterate through the transcript
+    exact = vocabulary['exact']
+    trie = vocabulary['trie']
+    # Walk the transcript once, following the phrase trie from each word.  The
+    # partial matches are (trie node, first word, exact rank of the first word)
+    partials = list()
     for word in transcript_words:
-        if word["text"]=="punctuation":
-            continue
         cleaned_word = clean_word(word["text"])
-        # Iterate through all the words to flag
-        for flag_word in words_to_flag:
-            if flag_word["whole_phrase"] == cleaned_word:
-                matching_words.append({'start': word["start"], 'text': flag_word["whole_phrase"]})
-                break
-            elif flag_word["whole_phrase"].startswith(cleaned_word) and len(flag_word["parts"])>1:
-                # For multiple word phrases, find the starting index and iterate through the list
-                index = transcript_words.index(word)
-                found_match = True
-                index_part = 1
-                phrase_matches = list()
-                # Iterate through the word list
-                for i in range(index + 1, index + len(flag_word["parts"])):
-                    next_word = transcript_words[i]
-                    logging.debug("Phrase: "  + next_word["text"] + " : " + flag_word["parts"][index_part])
-                    # If the word doesn't match, neither does the phrase.  Break here
-                    if clean_word(next_word["text"]) != flag_word["parts"][index_part]:
-                        found_match = False
-                        break
-                    index_part +=1
-                    phrase_matches.append(next_word)
-                # If we found a complete match, store the value
-                if found_match:
-                    match = {'start': word["start"], 'text': flag_word["whole_phrase"]}
-                    matching_words.append(match)
+        # An empty word ends all of the phrases in progress
+        next_partials = list()
+        for node, first_word, exact_rank in partials if cleaned_word else []:
+            node = node.get(cleaned_word)
+            if node is not None:
+                next_partials.append((node, first_word, exact_rank))
+        if word["text"] != "punctuation":
+            # A word which is a whole phrase stops the search, so only phrases
+            # which come before it in the vocabulary can also match here.
+            exact_rank = exact.get(cleaned_word)
+            node = trie.get(cleaned_word) if cleaned_word else None
+            if node is not None:
+                next_partials.append((node, word, exact_rank))
+            if exact_rank is not None:
+                matching_words.append({'start': word["start"], 'text': cleaned_word})
+        for node, first_word, exact_rank in next_partials:
+            for rank, whole_phrase in node.get(PHRASE_END, []):
+                if exact_rank is None or rank < exact_rank:
+                    matching_words.append({'start': first_word["start"], 'text': whole_phrase})
+        partials = next_partials
     return matching_words
 
+# Build the vocabulary index for the words to flag:  a dict of whole phrases
+# to their vocabulary position for exact matches, and a trie of the parts of
+# the multiple word phrases.  Each trie node is a dict of the next part to the
+# child node, and the PHRASE_END key holds the [position, whole phrase] list 
+# for the phrases which end at that node.
+def build_index(words_to_flag):
+    exact = dict()
+    trie = dict()
+    for rank, flag_word in enumerate(words_to_flag):
+        exact.setdefault(flag_word["whole_phrase"], rank)
+        if len(flag_word["parts"]) > 1:
+            node = trie
+            for part in flag_word["parts"]:
+                node = node.setdefault(part, dict())
+            node.setdefault(PHRASE_END, list()).append([rank, flag_word["whole_phrase"]])
+    return {'exact': exact, 'trie': trie}
+
+# Load a vocabulary index from either a precompiled index or a list of words
+def load_vocabulary(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+            logging.info(f"Loading precompiled vocabulary index {filename}")
+            return json.loads(zlib.decompress(f.read()))
+    return build_index(get_words(filename).values())
+
+# Write a vocabulary index so it can be loaded without parsing the word list.
+# The index is zlib compressed JSON, which is safe to load from any dataset.
+def save_index(vocabulary, filename):
+    with open(filename, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(zlib.compress(json.dumps(vocabulary, separators=(',', ':')).encode('utf-8'), 9))
+
 # Write the CSV.  Sorted by text then start time
 def write_csv(output_file, matching_words):
     with open(output_file, 'w') as csvfile:  
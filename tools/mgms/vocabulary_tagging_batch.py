@@ -0,0 +1,57 @@
+#!/usr/bin/env amp_python.sif
+import argparse
+import logging
+import multiprocessing
+from pathlib import Path
+import amp.logging
+from vocabulary_tagging import load_vocabulary, tag_transcript, write_csv
+
+# The vocabulary is loaded once before the worker processes are forked, so
+# they all share the same copy.
+vocabulary = None
+
+# Tag every AMP transcript in a directory against one vocabulary, writing a
+# CSV for each transcript with the same name into the output directory.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Number of parallel workers")
+    parser.add_argument("--pattern", default="*.json", help="Glob pattern for the transcripts in the transcript directory")
+    parser.add_argument("words_to_flag_file", help="List of words/phrases to flag or a precompiled vocabulary index")
+    parser.add_argument("transcript_dir", help="Directory of AMP transcripts")
+    parser.add_argument("output_dir", help="Directory for the output CSV files")
+    args = parser.parse_args()
+    amp.logging.setup_logging("vocabulary_tagging_batch", args.debug)
+    logging.info(f"Starting with args {args}")
+
+    global vocabulary
+    vocabulary = load_vocabulary(args.words_to_flag_file)
+    logging.info(f"Vocabulary has {len(vocabulary['exact'])} words/phrases to flag")
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [(str(t), str(output_dir / (t.stem + ".csv"))) for t in sorted(Path(args.transcript_dir).glob(args.pattern))]
+    logging.info(f"Tagging {len(jobs)} transcripts with {args.workers} workers")
+    
+    failed = 0
+    with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+        for transcript, ok in pool.imap_unordered(tag_file, jobs):
+            if not ok:
+                failed += 1
+    logging.info(f"Finished.  {len(jobs) - failed} transcripts tagged, {failed} failed.")
+    exit(1 if failed else 0)
+
+# Tag a single transcript, returning the transcript and whether it worked
+def tag_file(job):
+    (transcript, output_csv) = job
+    try:
+        write_csv(output_csv, tag_transcript(vocabulary, transcript))
+        logging.debug(f"Tagged {transcript} into {output_csv}")
+        return transcript, True
+    except Exception as e:
+        logging.error(f"Failed to tag {transcript}: {e}")
+        return transcript, False
+
+
+if __name__ == "__main__":
+    main()
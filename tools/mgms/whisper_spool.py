@@ -0,0 +1,192 @@
+#!/usr/bin/env amp_python.sif
+# Local stand-in for the HPC whisper service.
+#
+# cluster_whisper submits work by running the hpcscript with the work
+# directory.  With the local transport, this script can be the hpcscript:
+# it starts a worker (unless one is already running) and returns right away,
+# like a batch scheduler would.  The worker processes the whisper.job
+# manifests in the work directory, oldest first, writing each file's
+# <name>.whisper.json just like the service on the cluster, and exits once
+# there's nothing left to do.
+#
+# The fake engine writes a deterministic transcript of one word per half
+# second of audio, optionally taking a fraction of real time to do it, so the
+# submit/poll/fetch cycle can be benchmarked without a model.  The
+# faster-whisper engine transcribes on the CPU with CTranslate2.
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import wave
+from pathlib import Path
+
+import yaml
+
+# seconds the worker waits for more work before exiting
+IDLE_TIMEOUT = 5
+
+# faster-whisper names for the whisper cli model names
+MODEL_NAMES = {'turbo': 'large-v3-turbo'}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
+    parser.add_argument("--engine", choices=['fake', 'faster-whisper'], default='fake', help="Transcription engine")
+    parser.add_argument("--fake_rtf", type=float, default=0, help="Fraction of the audio duration the fake engine takes")
+    parser.add_argument("--worker", default=False, action="store_true", help="Process the jobs instead of starting a worker")
+    parser.add_argument("workdir", help="Work directory with the jobs")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s [%(levelname)-8s] (%(process)d) %(message)s",
+                        level=logging.DEBUG if args.debug else logging.INFO)
+
+    if not args.worker:
+        # like submitting to a scheduler:  start the worker and return.  If a
+        # worker is already running it will notice the lock and exit.
+        with open(Path(args.workdir, ".worker.log"), "a") as log:
+            subprocess.Popen([sys.executable, __file__, "--worker", "--engine", args.engine, "--fake_rtf", str(args.fake_rtf),
+                              *(["--debug"] if args.debug else []), args.workdir],
+                             stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+        exit(0)
+
+    engine = FakeEngine(args.fake_rtf) if args.engine == 'fake' else FasterWhisperEngine()
+    lockfile = open(Path(args.workdir, ".worker.lock"), "w")
+    while True:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.debug("Another worker is running")
+            return
+        write_yaml(Path(args.workdir, "jobinfo.yaml"), {'jobid': os.getpid()})
+        idle_since = time.time()
+        while time.time() - idle_since < IDLE_TIMEOUT:
+            if process_next(args.workdir, engine):
+                idle_since = time.time()
+            else:
+                time.sleep(0.2)
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        # a job submitted just before the lock was released would have had
+        # its worker exit, so look once more before going away
+        if not pending_files(args.workdir):
+            logging.info("No more work, exiting")
+            return
+
+
+def pending_files(workdir):
+    "Return a list of (job directory, file, job parameters) without results, oldest jobs first"
+    pending = []
+    jobs = [d for d in Path(workdir).iterdir() if d.is_dir() and not d.name.startswith('.') and (d / "whisper.job").exists()]
+    for jobdir in sorted(jobs, key=lambda d: (d / "whisper.job").stat().st_mtime):
+        try:
+            job = yaml.safe_load((jobdir / "whisper.job").read_text())
+        except Exception as e:
+            logging.warning(f"Skipping {jobdir}: {e}")
+            continue
+        for name in job['manifest']:
+            if not (jobdir / f"{name}.whisper.json").exists() and not (jobdir / f"{name}.whisper.failed").exists():
+                pending.append((jobdir, name, job))
+    return pending
+
+
+def process_next(workdir, engine):
+    "Transcribe the next file without a result, returning False if there isn't one"
+    pending = pending_files(workdir)
+    if not pending:
+        return False
+    (jobdir, name, job) = pending[0]
+    logging.info(f"Transcribing {jobdir.name}/{name}")
+    start = time.time()
+    try:
+        result = engine.transcribe(jobdir / name, job.get('model', 'medium'), job.get('language', 'auto'), job.get('prompt'))
+    except Exception as e:
+        logging.exception(f"Cannot transcribe {jobdir.name}/{name}")
+        (jobdir / f"{name}.whisper.failed").write_text(str(e))
+        return True
+    # the result appears all at once, since its existence means it's done
+    tmpfile = jobdir / f".{name}.whisper.json.tmp"
+    tmpfile.write_text(json.dumps(result))
+    os.replace(tmpfile, jobdir / f"{name}.whisper.json")
+    logging.info(f"Finished {jobdir.name}/{name} in {time.time() - start:.2f}s")
+    return True
+
+
+def write_yaml(filename, data):
+    tmpfile = filename.with_name(f".{filename.name}.tmp")
+    tmpfile.write_text(yaml.safe_dump(data))
+    os.replace(tmpfile, filename)
+
+
+def audio_duration(audio_file):
+    "Return the duration of the audio in seconds"
+    try:
+        with wave.open(str(audio_file)) as w:
+            return w.getnframes() / w.getframerate()
+    except Exception:
+        pass
+    p = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', str(audio_file)],
+                       stdout=subprocess.PIPE, encoding='utf-8', check=True)
+    return float(p.stdout.strip())
+
+
+class FakeEngine:
+    "Deterministic transcripts of one word per half second"
+    def __init__(self, rtf=0):
+        self.rtf = rtf
+
+
+    def transcribe(self, audio_file, model, language, prompt):
+        duration = audio_duration(audio_file)
+        time.sleep(duration * self.rtf)
+        segments = []
+        text = ""
+        t = 0
+        n = 0
+        while t + 0.5 <= duration or n == 0:
+            words = []
+            # five words to a segment, with a gap after every other segment
+            for _ in range(5):
+                if t + 0.5 > duration and n > 0:
+                    break
+                words.append({'word': f" word{n}", 'start': round(t, 3), 'end': round(t + 0.4, 3), 'probability': 1.0})
+                text += f" word{n}"
+                t += 0.5
+                n += 1
+            segments.append({'id': len(segments), 'start': words[0]['start'], 'end': words[-1]['end'],
+                             'text': "".join(w['word'] for w in words), 'words': words})
+            if len(segments) % 2 == 0:
+                t += 1
+        return {'text': text, 'segments': segments, 'language': language if language != 'auto' else 'en'}
+
+
+class FasterWhisperEngine:
+    "Transcription with faster-whisper on the CPU"
+    def __init__(self):
+        # faster-whisper is only needed for this engine
+        from faster_whisper import WhisperModel
+        self.model_class = WhisperModel
+        self.models = {}
+
+
+    def transcribe(self, audio_file, model, language, prompt):
+        model = MODEL_NAMES.get(model, model)
+        if model not in self.models:
+            logging.info(f"Loading model {model}")
+            self.models[model] = self.model_class(model, device="cpu", compute_type="int8")
+        (segments, info) = self.models[model].transcribe(str(audio_file), language=None if language == 'auto' else language,
+                                                         initial_prompt=prompt, word_timestamps=True)
+        result = {'text': "", 'segments': [], 'language': info.language}
+        for seg in segments:
+            result['text'] += seg.text
+            result['segments'].append({'id': seg.id, 'start': seg.start, 'end': seg.end, 'text': seg.text,
+                                       'words': [{'word': w.word, 'start': w.start, 'end': w.end, 'probability': w.probability}
+                                                 for w in seg.words]})
+        return result
+
+
+if __name__ == "__main__":
+    main()